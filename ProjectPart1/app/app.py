@@ -1,5 +1,5 @@
-from fastapi import FastAPI, HTTPException
-from typing import Optional
+from fastapi import FastAPI, HTTPException, Body, Query
+from typing import List, Optional, Union
 from pydantic import BaseModel, validator
 from uuid import uuid4
 
@@ -155,6 +155,58 @@ def validateUpdate(data:dict)   -> bool:
                 return False
     return True
 
+
+# BATCH VIEW: at most `maxLimit` providerIDs per request
+maxLimit = 1000
+
+
+# `fields` as a comma-separated string or a list of names, None for all
+def parseFields(fields):
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    elif not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated string or a list of names")
+    return [field.strip() for field in fields if field.strip()]
+
+
+# keep only `fields`, providerID is always included
+def project(provider:dict, fields) -> dict:
+    if fields is None:
+        return provider
+    return {key:provider[key] for key in ["providerID", *fields] if key in provider}
+
+
+# providerIDs from repeated and/or comma-separated values, in first
+# occurrence order, without duplicates
+def parseIDs(values) -> list:
+    ids = {}
+    for value in values or ():
+        for providerID in value.split(","):
+            if providerID.strip():
+                ids[providerID.strip()] = None
+    return list(ids)
+
+
+# the providers of `ids` that exist, in that order, and the IDs that do not
+def batchProviders(data:dict, ids:list, fields:list = None) -> tuple:
+    if not ids:
+        raise ValueError("providerID is required")
+    if len(ids) > maxLimit:
+        raise ValueError("at most %d providerIDs per request" % maxLimit)
+
+    providers = []
+    missing = []
+    for providerID in ids:
+        provider = data.get(providerID)
+        if provider is None:
+            missing.append(providerID)
+            continue
+        providers.append(project(provider, fields))
+    return providers, missing
+
+
 #*--------------------------*#
 #*       VIEW provider      *#
 #*--------------------------*#
@@ -194,6 +246,63 @@ async def view_Provider(providerID: str = None, name: str = None)    ->dict:
         return {"response":"no arguments provided"}
 
 
+#*-----------------------------*#
+#*     BATCH VIEW providers    *#
+#*-----------------------------*#
+
+# GET /batch?providerID=a&providerID=b,c, or POST /batch with a JSON array
+# of providerIDs or {"providerID": [...], "fields": [...]}. `fields` may be
+# a list or a comma-separated string.
+
+batchBodyDetail = 'body must be a JSON array of providerIDs or {"providerID": [...], "fields": [...]}'
+
+@app.get("/batch", tags=['backend'])
+async def batch_Provider_Backend(providerID: List[str] = Query(None), fields: str = None) -> dict:
+    try:
+        try:
+            providers, missing = batchProviders(data, parseIDs(providerID), parseFields(fields))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            "response":"success",
+            "data":providers,
+            "missing":missing
+        }
+    except HTTPException as e:
+        return {"response":e}
+
+
+@app.post("/batch", tags=['backend'])
+async def batch_Provider_Post_Backend(body: Union[List[str], dict] = Body(...), fields: str = None) -> dict:
+    try:
+        ids = body
+        if isinstance(body, dict):
+            ids = body.get("providerID")
+            fields = body.get("fields", fields)
+        if isinstance(ids, str):
+            ids = [ids]
+        if not isinstance(ids, list) or not all(isinstance(providerID, str) for providerID in ids):
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+        try:
+            fields = parseFields(fields)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+
+        try:
+            providers, missing = batchProviders(data, parseIDs(ids), fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            "response":"success",
+            "data":providers,
+            "missing":missing
+        }
+    except HTTPException as e:
+        return {"response":e}
+
+
 #*-----------------------------*#
 #*       VIEW ALL provider     *#
 #*-----------------------------*#
@@ -1,7 +1,9 @@
 import json
+import base64
+from bisect import bisect_left, bisect_right
 from os import read
-from fastapi import FastAPI, HTTPException
-from typing import Optional
+from fastapi import FastAPI, HTTPException, Body, Query
+from typing import List, Optional, Union
 from pydantic import BaseModel, validator
 from uuid import uuid4
 
@@ -75,6 +77,108 @@ def writeData(data, jFile=jsonFileName):
         json.dump(data, jf, indent=4)
 
 
+# PAGINATION: listings are ordered by (sort value, providerID), which is
+# unique, so pages are stable and the cursor is simply the last entry of the
+# previous page, base64-encoded
+sortFields = ("providerID", "name", "organization", "department", "location", "active")
+maxLimit = 1000
+
+
+def sortKey(value) -> tuple:
+    if value is None:
+        return (0, "")
+    return (1, str(value).casefold())
+
+
+def encodeCursor(entry:tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(entry).encode()).decode()
+
+
+# a cursor is compared against the sort keys, so anything but a number
+# and two strings is refused here rather than failing in bisect
+def decodeCursor(cursor:str) -> tuple:
+    try:
+        (flag, value), providerID = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if isinstance(flag, bool) or not isinstance(flag, (int, float)) or not isinstance(value, str) or not isinstance(providerID, str):
+        raise ValueError("invalid cursor")
+    return ((flag, value), providerID)
+
+
+# `fields` as a comma-separated string or a list of names, None for all
+def parseFields(fields):
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    elif not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated string or a list of names")
+    return [field.strip() for field in fields if field.strip()]
+
+
+# keep only `fields`, providerID is always included
+def project(provider:dict, fields) -> dict:
+    if fields is None:
+        return provider
+    return {key:provider[key] for key in ["providerID", *fields] if key in provider}
+
+
+# one page of `data` and the cursor for the next one, or None
+def pageProviders(data:dict, limit:int, cursor:str = None, sort:str = "providerID", fields:list = None) -> tuple:
+    if not 1 <= limit <= maxLimit:
+        raise ValueError("limit must be between 1 and %d" % maxLimit)
+    descending = sort.startswith("-")
+    sortField = sort.lstrip("-")
+    if sortField not in sortFields:
+        raise ValueError("sort must be one of " + ", ".join(sortFields))
+
+    entries = sorted((sortKey(providerID if sortField == "providerID" else provider.get(sortField)), providerID)
+                     for providerID, provider in data.items())
+    if descending:
+        end = bisect_left(entries, decodeCursor(cursor)) if cursor else len(entries)
+        start = max(end - limit, 0)
+        page = entries[start:end][::-1]
+        more = start > 0
+    else:
+        start = bisect_right(entries, decodeCursor(cursor)) if cursor else 0
+        page = entries[start:start + limit]
+        more = start + limit < len(entries)
+
+    providers = {providerID:project(data[providerID], fields) for _, providerID in page}
+    nextCursor = encodeCursor(page[-1]) if page and more else None
+    return providers, nextCursor
+
+
+# BATCH VIEW: providerIDs from repeated and/or comma-separated values, in
+# first occurrence order, without duplicates
+def parseIDs(values) -> list:
+    ids = {}
+    for value in values or ():
+        for providerID in value.split(","):
+            if providerID.strip():
+                ids[providerID.strip()] = None
+    return list(ids)
+
+
+# the providers of `ids` that exist, in that order, and the IDs that do not
+def batchProviders(data:dict, ids:list, fields:list = None) -> tuple:
+    if not ids:
+        raise ValueError("providerID is required")
+    if len(ids) > maxLimit:
+        raise ValueError("at most %d providerIDs per request" % maxLimit)
+
+    providers = []
+    missing = []
+    for providerID in ids:
+        provider = data.get(providerID)
+        if provider is None:
+            missing.append(providerID)
+            continue
+        providers.append(project(provider, fields))
+    return providers, missing
+
+
 # fetch keys from JSON file
 def getKeys(jFile=jsonFileName):
     with open(jFile) as jf:
@@ -122,18 +226,88 @@ async def view_Provider(providerID: str = None, name: str = None)    ->dict:
         return {"response":"no arguments provided"}
 
 
+#*-----------------------------*#
+#*     BATCH VIEW providers    *#
+#*-----------------------------*#
+
+# GET /batch?providerID=a&providerID=b,c, or POST /batch with a JSON array
+# of providerIDs or {"providerID": [...], "fields": [...]}. `fields` may be
+# a list or a comma-separated string.
+
+batchBodyDetail = 'body must be a JSON array of providerIDs or {"providerID": [...], "fields": [...]}'
+
+@app.get("/batch", tags=['backend'])
+async def batch_Provider_Backend(providerID: List[str] = Query(None), fields: str = None) -> dict:
+    try:
+        # one read of data.json for every ID
+        data = readData()
+        try:
+            providers, missing = batchProviders(data, parseIDs(providerID), parseFields(fields))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            "response":"success",
+            "data":providers,
+            "missing":missing
+        }
+    except HTTPException as e:
+        return {"response":e}
+
+
+@app.post("/batch", tags=['backend'])
+async def batch_Provider_Post_Backend(body: Union[List[str], dict] = Body(...), fields: str = None) -> dict:
+    try:
+        ids = body
+        if isinstance(body, dict):
+            ids = body.get("providerID")
+            fields = body.get("fields", fields)
+        if isinstance(ids, str):
+            ids = [ids]
+        if not isinstance(ids, list) or not all(isinstance(providerID, str) for providerID in ids):
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+        try:
+            fields = parseFields(fields)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+
+        # one read of data.json for every ID
+        data = readData()
+        try:
+            providers, missing = batchProviders(data, parseIDs(ids), fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            "response":"success",
+            "data":providers,
+            "missing":missing
+        }
+    except HTTPException as e:
+        return {"response":e}
+
+
 #*-----------------------------*#
 #*       VIEW ALL provider     *#
 #*-----------------------------*#
 
 @app.get("/viewall", tags=['backend'])
-async def viewall_Provider_Backend() -> dict:
-    data = readData()
+async def viewall_Provider_Backend(limit: int = 100, cursor: str = None, sort: str = "providerID", fields: str = None) -> dict:
+    try:
+        data = readData()
+        try:
+            providers, nextCursor = pageProviders(data, limit, cursor, sort, parseFields(fields))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-    return {
-        "response":"success",
-        "data":data
-    }
+        return {
+            "response":"success",
+            "data":providers,
+            "nextCursor":nextCursor,
+            "total":len(data)
+        }
+    except HTTPException as e:
+        return {"response":e}
 
 
 #*---------------------------*#
@@ -0,0 +1,83 @@
+import re
+
+
+#*--------------------------*#
+#*      ADDRESS PARSING     *#
+#*--------------------------*#
+
+# Free-text addresses like "Street 5, Town 2, Bengaluru, Karnataka" are split
+# at write time into street, town, city and state, stored on the record as
+# "addressParts" and indexed like any other filter field (see index.py).
+#
+# Parsing works from the end of the address:
+#
+#   state      last part, if it is a known state or union territory
+#   city       next part if it is a known city, or follows a known state
+#              and does not look like a locality; else the `location` field
+#   town       next part, if a locality or more than one part is left
+#   street     whatever is left, joined back together
+#
+# Known names come out in their canonical spelling, anything else as
+# written with whitespace collapsed. A known city also gives its state.
+
+addressFields = ("street", "town", "city", "state")
+
+states = [
+    "Andhra Pradesh", "Arunachal Pradesh", "Assam", "Bihar", "Chhattisgarh", "Goa", "Gujarat", "Haryana",
+    "Himachal Pradesh", "Jharkhand", "Karnataka", "Kerala", "Madhya Pradesh", "Maharashtra", "Manipur",
+    "Meghalaya", "Mizoram", "Nagaland", "Odisha", "Punjab", "Rajasthan", "Sikkim", "Tamil Nadu", "Telangana",
+    "Tripura", "Uttar Pradesh", "Uttarakhand", "West Bengal", "Andaman and Nicobar Islands", "Chandigarh",
+    "Dadra and Nagar Haveli and Daman and Diu", "Delhi", "Jammu and Kashmir", "Ladakh", "Lakshadweep", "Puducherry",
+]
+
+cityStates = {
+    "Bengaluru": "Karnataka", "Bangalore": "Karnataka", "Mysuru": "Karnataka", "Mysore": "Karnataka", "Mangaluru": "Karnataka",
+    "Hubballi": "Karnataka", "Mumbai": "Maharashtra", "Pune": "Maharashtra", "Nagpur": "Maharashtra", "Nashik": "Maharashtra",
+    "Thane": "Maharashtra", "New Delhi": "Delhi", "Chennai": "Tamil Nadu", "Coimbatore": "Tamil Nadu", "Madurai": "Tamil Nadu",
+    "Hyderabad": "Telangana", "Kolkata": "West Bengal", "Ahmedabad": "Gujarat", "Surat": "Gujarat", "Vadodara": "Gujarat",
+    "Jaipur": "Rajasthan", "Lucknow": "Uttar Pradesh", "Kanpur": "Uttar Pradesh", "Noida": "Uttar Pradesh",
+    "Gurugram": "Haryana", "Gurgaon": "Haryana", "Kochi": "Kerala", "Thiruvananthapuram": "Kerala", "Bhopal": "Madhya Pradesh",
+    "Indore": "Madhya Pradesh", "Patna": "Bihar", "Bhubaneswar": "Odisha", "Visakhapatnam": "Andhra Pradesh",
+    "Vijayawada": "Andhra Pradesh", "Guwahati": "Assam", "Panaji": "Goa", "Dehradun": "Uttarakhand", "Ranchi": "Jharkhand",
+    "Raipur": "Chhattisgarh", "Ludhiana": "Punjab", "Amritsar": "Punjab", "Shimla": "Himachal Pradesh", "Srinagar": "Jammu and Kashmir",
+}
+
+stateNames = {state.casefold():state for state in states}
+cityNames = {city.casefold():city for city in cityStates}
+
+# "Town 2", "City 4", "Koramangala Layout", "Sector 21", ...
+localityPattern = re.compile(r"\b(town|city|village|nagar|layout|colony|sector|block|area|extension|puram|pet|halli)\b", re.IGNORECASE)
+pincodePattern = re.compile(r"\s*\b\d{6}$")
+
+
+def clean(part:str) -> str:
+    return " ".join(part.split())
+
+
+# {"street", "town", "city", "state"}, unknown components are None
+def parseAddress(address, location=None) -> dict:
+    parts = [clean(pincodePattern.sub("", part)) for part in address.split(",")] if isinstance(address, str) else []
+    parts = [part for part in parts if part]
+    street = town = city = state = None
+
+    if parts and parts[-1].casefold() in stateNames:
+        state = stateNames[parts.pop().casefold()]
+    if parts and parts[-1].casefold() in cityNames:
+        city = cityNames[parts.pop().casefold()]
+    elif parts and state and len(parts) > 1 and not localityPattern.search(parts[-1]):
+        city = parts.pop()
+    if city is None and isinstance(location, str) and clean(location):
+        city = cityNames.get(clean(location).casefold(), clean(location))
+    if state is None and city in cityStates:
+        state = cityStates[city]
+
+    if parts and (len(parts) > 1 or localityPattern.search(parts[-1])):
+        town = parts.pop()
+    if parts:
+        street = ", ".join(parts)
+    return {"street":street, "town":town, "city":city, "state":state}
+
+
+# `provider` with "addressParts" parsed from its address and location
+def withAddress(provider:dict) -> dict:
+    return {**provider, "addressParts":parseAddress(provider.get("address"), provider.get("location"))}
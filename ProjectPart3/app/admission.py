@@ -0,0 +1,168 @@
+import asyncio
+import itertools
+import time
+from heapq import heapify, heappop, heappush
+from .metrics import registry, Counter, Gauge, Histogram, latencyBuckets
+from .serialization import dumps
+
+
+#*--------------------------*#
+#*     ADMISSION CONTROL    *#
+#*--------------------------*#
+
+# ASGI middleware that bounds how much work runs at once. At most
+# `maxActive` requests run at a time, and each class of route has its own
+# limit within that. Requests beyond those limits wait in one queue,
+# bounded at `maxQueue`, and are admitted in priority order as running
+# requests finish:
+#
+#   point   0   lookups by ID or name, /batch, /count, /duplicates
+#   write   1   POST, PUT, DELETE /, /bulk
+#   list    2   pages, filters, search, stats, HTML pages
+#   dump    3   every provider at once: /viewall?limit=0, /export,
+#               /duplicates/report
+#
+# A waiter held back by its own class limit does not block the classes
+# behind it. A full queue sheds its least urgent waiter to make room for a
+# more urgent arrival, otherwise the arrival itself. A request
+# that waits longer than `maxWait` seconds is shed as well. Shed requests
+# get an immediate 503 with Retry-After.
+#
+# Metrics, the change feed streams and static files bypass admission
+# control. A stream may stay open for hours and should not hold a slot.
+
+classPriority = {"point":0, "write":1, "list":2, "dump":3}
+shedDetail = "server busy, retry later"
+
+admissionWait = registry.register(Histogram("admission_wait_seconds", "Time requests waited for admission", latencyBuckets, ("class",)))
+admissionShed = registry.register(Counter("admission_shed_total", "Requests turned away with 503"))
+admissionQueued = registry.register(Gauge("admission_queue_depth", "Requests waiting for admission"))
+admissionActive = registry.register(Gauge("admission_active", "Requests admitted and running"))
+
+
+# route class of a request, or None when it bypasses admission control
+def routeClass(scope):
+    method, path = scope["method"], scope["path"]
+    if method in ("POST", "PUT", "DELETE") and path in ("/", "/bulk"):
+        return "write"
+    if path in ("/batch", "/count", "/duplicates"):
+        return "point"
+    if path == "/":
+        # a lookup by ID or name, or a filtered listing
+        query = scope.get("query_string", b"")
+        if b"providerID=" in query or query.startswith(b"name=") and b"&" not in query:
+            return "point"
+        return "list"
+    if path in ("/export", "/duplicates/report") or (path == "/viewall" and b"limit=0" in scope.get("query_string", b"").split(b"&")):
+        return "dump"
+    if path in ("/list", "/search", "/stats", "/viewall", "/views", "/viewbyID", "/create", "/update", "/delete"):
+        return "list"
+    return None
+
+
+# "list=16,dump=4" -> {"list": 16, "dump": 4}
+def parseLimits(text:str) -> dict:
+    limits = {}
+    for item in text.split(","):
+        kind, _, limit = item.partition("=")
+        if kind.strip():
+            if kind.strip() not in classPriority or not limit.strip().isdigit():
+                raise ValueError("admission limits look like list=16,dump=4, classes are " + ", ".join(classPriority))
+            limits[kind.strip()] = int(limit)
+    return limits
+
+
+class AdmissionControl:
+
+    def __init__(self, app, maxActive=64, maxQueue=256, maxWait=5.0, limits=None, retryAfter=1):
+        self.app = app
+        self.maxActive = maxActive
+        self.maxQueue = maxQueue
+        self.maxWait = maxWait
+        self.limits = {kind:(limits or {}).get(kind, maxActive) for kind in classPriority}
+        self.retryAfter = retryAfter
+        self.active = 0
+        self.activeByClass = {kind:0 for kind in classPriority}
+        # [priority, arrival, class, future], a heap
+        self.waiting = []
+        self.arrivals = itertools.count()
+
+    async def __call__(self, scope, receive, send):
+        kind = routeClass(scope) if scope["type"] == "http" and self.maxActive > 0 else None
+        if kind is None:
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        if not await self.admit(kind):
+            admissionShed.inc()
+            return await self.shed(send)
+        admissionWait.observe(time.perf_counter() - start, kind)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.release(kind)
+
+    # wait for a slot, True once admitted, False when shed
+    async def admit(self, kind) -> bool:
+        entry = [classPriority[kind], next(self.arrivals), kind, asyncio.get_running_loop().create_future()]
+        heappush(self.waiting, entry)
+        self.dispatch()
+        future = entry[3]
+        if not future.done() and len(self.waiting) > self.maxQueue:
+            # full: shed the least urgent waiter, the newest on a tie, so
+            # possibly this one
+            self.drop(max(self.waiting))
+        if not future.done():
+            admissionQueued.set(len(self.waiting))
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.maxWait)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # admitted just as the client went away
+                if future.done() and future.result():
+                    self.release(kind)
+                else:
+                    self.drop(entry)
+                raise
+        if not future.done():
+            self.drop(entry)
+        return future.result()
+
+    # take `entry` out of the queue and shed it
+    def drop(self, entry):
+        if entry in self.waiting:
+            self.waiting.remove(entry)
+            heapify(self.waiting)
+        if not entry[3].done():
+            entry[3].set_result(False)
+        admissionQueued.set(len(self.waiting))
+
+    # admit waiters in priority order while there are slots; one held back
+    # by its class limit lets the ones behind it through
+    def dispatch(self):
+        held = []
+        while self.waiting and self.active < self.maxActive:
+            entry = heappop(self.waiting)
+            kind = entry[2]
+            if self.activeByClass[kind] >= self.limits[kind]:
+                held.append(entry)
+                continue
+            self.active += 1
+            self.activeByClass[kind] += 1
+            entry[3].set_result(True)
+        for entry in held:
+            heappush(self.waiting, entry)
+        admissionActive.set(self.active)
+        admissionQueued.set(len(self.waiting))
+
+    def release(self, kind):
+        self.active -= 1
+        self.activeByClass[kind] -= 1
+        self.dispatch()
+
+    async def shed(self, send):
+        body = dumps({"response":{"status_code":503, "detail":shedDetail, "headers":None}})
+        await send({"type":"http.response.start", "status":503,
+                    "headers":[(b"content-type", b"application/json"), (b"content-length", b"%d" % len(body)),
+                               (b"retry-after", b"%d" % self.retryAfter)]})
+        await send({"type":"http.response.body", "body":body})
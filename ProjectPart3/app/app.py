@@ -1,16 +1,37 @@
-import json
-from os import read
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, Header, Query, HTTPException, WebSocket, WebSocketDisconnect
 from typing import List, Optional
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, ValidationError, validator
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from uuid import uuid4
-
-app=FastAPI()
+from itertools import chain
+import time
+from . import config
+from .store import ProviderStore, notFound, alreadyExists, preconditionFailed, phoneTaken
+from .backends import JsonFileBackend, SharedJsonFileBackend, SqliteBackend
+from .shards import ShardedStore
+from .asyncstore import AsyncProviderStore
+from .metrics import registry, LoopLagMonitor
+from .instrumentation import RequestMetrics, SamplingProfiler
+from .admission import AdmissionControl, parseLimits
+from .paging import defaultLimit, maxLimit, parseSort, parseFields, parseIDs, project
+from .columnar import statsFields
+from .serialization import dumps, loads, FastJSONResponse, successBytes
+from .httpcache import ResponseCache, conditionalResponse, cacheHeaders, notModified
+from .rendering import Fragments, TimedTemplate, streamTemplate
+from .changes import subscribers
+from .dedup import duplicateReport
+
+app=FastAPI(default_response_class=FastJSONResponse) if config.fastJSON else FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
+profiler = SamplingProfiler(config.profileSlowMs / 1000, config.profileInterval, config.profileDir) if config.profileSlowMs > 0 else None
+# inside RequestMetrics, so request latency includes the time queued
+app.add_middleware(AdmissionControl, maxActive=config.admitActive, maxQueue=config.admitQueue, maxWait=config.admitWait,
+                   limits=parseLimits(config.admitLimits), retryAfter=config.retryAfter)
+app.add_middleware(RequestMetrics, router=app.router, profiler=profiler)
 templates = Jinja2Templates(directory="templates")
+templates.env.template_class = TimedTemplate
 
 class Healthcare_Provider(BaseModel):
     active : Optional[bool] = True
@@ -29,8 +50,6 @@ class Healthcare_Provider(BaseModel):
             raise ValueError('Phone must be 10 digits long')
         return val
 
-jsonFileName = "./data.json"
-
 
 # CREATE validation for empty fields
 def validateCreate(data:dict) -> bool:
@@ -56,7 +75,6 @@ def validateCreate(data:dict) -> bool:
 
 # UPDATE validation for data type
 def validateUpdate(data:dict)   -> bool:
-    print(data)
     for keys in data.keys():
         if keys in ("active",):
             if not isinstance(data[keys], bool):
@@ -67,24 +85,77 @@ def validateUpdate(data:dict)   -> bool:
     return True
 
 
-# read JSON file to dict
-def readData(jFile=jsonFileName):
-    with open(jFile) as jf:
-        loadedJsonData = dict(json.load(jf))
-    return loadedJsonData
+if config.shards:
+    # providers live in shard processes, see shards.py
+    store = ShardedStore(config.shards, config.shardDir, spawn=config.workers == 1 or config.prefork)
+else:
+    if config.storageBackend == "sqlite":
+        backend = SqliteBackend(config.sqliteFileName, config.poolSize, config.syncCommit, importFrom=config.jsonFileName)
+    elif config.workers > 1 or config.prefork:
+        # under prefork the master compacts, as it restarts the workers
+        backend = SharedJsonFileBackend(config.jsonFileName, config.syncCommit, config.compactInterval, config.compactThreshold, config.prettyJSON,
+                                        config.snapshotFormat == "binary", compacts=not config.prefork)
+    else:
+        backend = JsonFileBackend(config.jsonFileName, config.commitInterval, config.syncCommit, config.compactInterval, config.compactThreshold, config.prettyJSON, config.snapshotFormat == "binary")
+    store = ProviderStore(backend, config.pollInterval, config.compactRecords, config.changeFeedSize, config.uniquePhones)
+asyncStore = AsyncProviderStore(store, config.ioThreads)
+loopLag = LoopLagMonitor()
+responseCache = ResponseCache(config.responseCacheEntries, config.responseCacheBytes)
+fragments = Fragments(store, templates.env)
+
+# store write errors -> HTTP status
+errorStatus = {notFound:404, alreadyExists:400, preconditionFailed:412, phoneTaken:409}
+
+
+# drop cached responses and fragments built from these providers
+def invalidateCaches(*providerIDs):
+    responseCache.invalidate(*providerIDs)
+    fragments.invalidate(*providerIDs)
+
+
+# success, flagging the providers that look like duplicates of this one
+async def writeResponse(providerID) -> dict:
+    duplicates = await asyncStore.duplicatesOf(providerID)
+    if duplicates:
+        return {"response":"success", "possibleDuplicates":duplicates}
+    return {"response":"success"}
+
 
+# stream a store-backed page, or 304 when the client already has the page
+# for the current version of the store. `context` is called off the loop.
+async def renderPage(request:Request, name:str, context) -> Response:
+    marker, modified = await asyncStore.collectionState()
+    etag = '"%s"' % marker
+    headers = cacheHeaders(etag, modified, config.cacheMaxAge)
+    if notModified(request.headers, etag, modified):
+        return Response(status_code=304, headers=headers)
+    values = await asyncStore.run(context)
+    return StreamingResponse(streamTemplate(templates.get_template(name), {"request":request, **values}),
+                             media_type="text/html", headers=headers)
 
-# write dict to JSON file
-def writeData(data, jFile=jsonFileName):
-    with open(jFile, 'w') as jf:
-        json.dump(data, jf, indent=4)
 
+@app.on_event("startup")
+async def start_Store():
+    store.start()
+    loopLag.start()
+    if profiler is not None:
+        profiler.start()
 
-# fetch keys from JSON file
-def getKeys(jFile=jsonFileName):
-    with open(jFile) as jf:
-        loadedJsonData = dict(json.load(jf))
-    return loadedJsonData.keys()
+
+@app.on_event("shutdown")
+def stop_Store():
+    loopLag.stop()
+    if profiler is not None:
+        profiler.stop()
+    asyncStore.shutdown()
+    store.close()
+
+
+@app.get("/metrics", tags=['root'], response_class=PlainTextResponse)
+def metrics():
+    text = registry.render()
+    loopLag.scraped()
+    return text
 
 
 
@@ -105,51 +176,71 @@ def main_Page(request:Request):
 
 #? FRONTEND
 @app.get("/views", tags=['frontend'],response_class=HTMLResponse)
-def view(request:Request):
-    with open('./data.json') as json_file:
-        data = dict(json.load(json_file))
-    provList = [key for key in data.keys()]
-    nameList = [prov['name'] for prov in data.values()]
-    return templates.TemplateResponse("viewall.html", {"request":request, "providerList":provList, "nameList":nameList})
+async def view(request:Request):
+    return await renderPage(request, "viewall.html", lambda: {"providerOptions":fragments.lazyOptions("providerOptions"),
+                                                              "nameOptions":fragments.lazyOptions("nameOptions")})
 
 
 
 #? BACKEND
 @app.get("/", tags=['backend'])  
-async def view_Provider(providerID: str = None, name: str = None)    ->dict:
-    data = readData()
-    keys = getKeys()
-    
-    if providerID and name:
+async def view_Provider(request: Request, providerID: str = None, name: str = None,
+                        organization: str = None, location: str = None, department: str = None,
+                        speciality: str = None, qualification: str = None, active: Optional[bool] = None,
+                        town: str = None, city: str = None, state: str = None)    ->dict:
+    filters = {"organization":organization, "location":location, "department":department,
+               "speciality":speciality, "qualification":qualification, "active":active,
+               "town":town, "city":city, "state":state}
+    filtered = any(value is not None for value in filters.values())
+
+    if providerID and (name or filtered):
         return {
             "response":"invalid parameter. only one allowed at a time"
         }
     elif providerID:
         try:
-            if providerID not in keys:
+            encoded = await asyncStore.encoded(providerID)
+            if encoded is None:
                 raise HTTPException(status_code=404, detail="providerID not found")
-            return {
-                    "response" : "success",
-                    "data" : data[providerID]
-                }
+            # the provider is already encoded, only the envelope is added
+            blob, etag, modified = encoded
+            return conditionalResponse(request, successBytes(blob), "application/json", etag, modified, config.cacheMaxAge)
         except HTTPException as e:
             return {"response":e}
-    elif name:
-        try:
-            found = False
-            for eachProvider in data.values():
-                if name.lower() == eachProvider['name'].lower():
-                    return {
-                        "response":"success",
-                        "data":eachProvider
-                    }
-            if not found:
+    elif filtered or name:
+        # answered from the secondary indexes, name narrows the match further
+        marker, modified = await asyncStore.collectionState()
+        key = ("query", name, *filters.values())
+
+        async def build():
+            if filtered:
+                providers = await asyncStore.query(name, **filters)
+                return dumps({"response":"success", "count":len(providers), "data":providers})
+            eachProvider = await asyncStore.findByName(name)
+            if eachProvider is None:
                 raise HTTPException(status_code=404, detail="provider name not found")
+            return dumps({"response":"success", "data":eachProvider})
+
+        try:
+            body = await responseCache.fetch(key, marker, build)
         except HTTPException as e:
             return {"response":e}
+        return conditionalResponse(request, body, "application/json", '"%s"' % marker, modified, config.cacheMaxAge)
     else:
         return {"response":"no arguments provided"}
 
+#? BACKEND
+# number of providers matching the filters, counted on the indexes
+@app.get("/count", tags=['backend'])
+async def count_Provider(name: str = None, organization: str = None, location: str = None, department: str = None,
+                         speciality: str = None, qualification: str = None, active: Optional[bool] = None,
+                         town: str = None, city: str = None, state: str = None) -> dict:
+    filters = {"organization":organization, "location":location, "department":department,
+               "speciality":speciality, "qualification":qualification, "active":active,
+               "town":town, "city":city, "state":state}
+    if name is None and all(value is None for value in filters.values()):
+        return {"response":"success", "count":await asyncStore.size()}
+    return {"response":"success", "count":await asyncStore.count(name, **filters)}
 
 #? FRONTEND
 @app.get("/viewbyID", tags = ['frontend'], response_class=HTMLResponse)
@@ -158,15 +249,401 @@ async def web_view_Provider(request:Request, providerID: str = None, name: str =
 
 
 
+#*-----------------------------*#
+#*     BATCH VIEW providers    *#
+#*-----------------------------*#
+
+# Many providers by ID in one request and one pass over the store:
+#
+#   GET  /batch?providerID=a&providerID=b,c&fields=name,phone
+#   POST /batch   ["a", "b", "c"]   or   {"providerID": [...], "fields": [...]}
+#
+# "data" holds the providers found, in the order asked for, and "missing"
+# the IDs that are not there. `fields` may be a list or a comma-separated
+# string.
+
+batchBodyDetail = 'body must be a JSON array of providerIDs or {"providerID": [...], "fields": [...]}'
+
+
+async def batchResponse(ids:list, fields) -> Response:
+    if not ids:
+        raise HTTPException(status_code=400, detail="providerID is required")
+    if len(ids) > maxLimit:
+        raise HTTPException(status_code=400, detail="at most %d providerIDs per request" % maxLimit)
+    if fields is None:
+        # already encoded, joined as they are
+        found = await asyncStore.fetch(ids, encoded=True)
+        blobs = [blob for blob in found if blob is not None]
+    else:
+        found = await asyncStore.fetch(ids)
+        blobs = [dumps(project(provider, fields)) for provider in found if provider is not None]
+    missing = [providerID for providerID, provider in zip(ids, found) if provider is None]
+    body = b'{"response":"success","data":[' + b",".join(blobs) + b'],"missing":' + dumps(missing) + b'}'
+    return Response(body, media_type="application/json")
+
+
+#? BACKEND
+@app.get("/batch", tags=['backend'])
+async def batch_Provider_Backend(providerID: List[str] = Query(None), fields: str = None):
+    try:
+        return await batchResponse(parseIDs(providerID), parseFields(fields))
+    except HTTPException as e:
+        return {"response":e}
+
+
+#? BACKEND
+@app.post("/batch", tags=['backend'])
+async def batch_Provider_Post_Backend(request: Request, fields: str = None):
+    try:
+        try:
+            body = loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+        ids = body
+        if isinstance(body, dict):
+            ids = body.get("providerID")
+            fields = body.get("fields", fields)
+        if isinstance(ids, str):
+            ids = [ids]
+        if not isinstance(ids, list) or not all(isinstance(providerID, str) for providerID in ids):
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+        try:
+            fields = parseFields(fields)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=batchBodyDetail)
+        return await batchResponse(parseIDs(ids), fields)
+    except HTTPException as e:
+        return {"response":e}
+
+
+
 #*-----------------------------*#
 #*       VIEW ALL provider     *#
 #*-----------------------------*#
 
+#? BACKEND
+@app.get("/list", tags=['backend'])
+async def list_Provider_Backend(request: Request, limit: int = defaultLimit, cursor: str = None, sort: str = "providerID", fields: str = None) -> dict:
+    try:
+        marker, modified = await asyncStore.collectionState()
+        key = ("list", limit, cursor, sort, fields)
+
+        async def build():
+            try:
+                sortField, descending = parseSort(sort)
+                providers, nextCursor = await asyncStore.page(limit, cursor, sortField, descending, parseFields(fields))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return dumps({
+                "response":"success",
+                "data":providers,
+                "nextCursor":nextCursor,
+                "total":await asyncStore.size()
+            })
+
+        body = await responseCache.fetch(key, marker, build)
+        return conditionalResponse(request, body, "application/json", '"%s"' % marker, modified, config.cacheMaxAge)
+    except HTTPException as e:
+        return {"response":e}
+
+
 #? FRONTEND
+# limit=0 streams every provider as one table
 @app.get("/viewall", tags=['frontend'], response_class=HTMLResponse)
-async def web_View_Provider(request: Request):
-    data = readData()
-    return templates.TemplateResponse("viewAllProvider.html", {"request":request, "data":data})
+async def web_View_Provider(request: Request, limit: int = defaultLimit, cursor: str = None, sort: str = "providerID"):
+    try:
+        sortField, descending = parseSort(sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if limit == 0:
+        return await renderPage(request, "viewAllProvider.html", lambda: {"rows":fragments.allRows(sortField, descending), "nextCursor":None,
+                                                                         "limit":limit, "sort":sort, "total":len(store)})
+
+    marker, modified = await asyncStore.collectionState()
+    # static URLs in the page depend on the host it was requested from
+    key = ("viewall", str(request.base_url), limit, cursor, sort)
+
+    async def build():
+        try:
+            providers, nextCursor = await asyncStore.page(limit, cursor, sortField, descending)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        context = {"request":request, "rows":fragments.rowsOf(providers), "nextCursor":nextCursor,
+                   "limit":limit, "sort":sort, "total":await asyncStore.size()}
+        return b"".join(streamTemplate(templates.get_template("viewAllProvider.html"), context))
+
+    body = await responseCache.fetch(key, marker, build)
+    return conditionalResponse(request, body, "text/html", '"%s"' % marker, modified, config.cacheMaxAge)
+
+
+
+#*-----------------------------*#
+#*       SEARCH providers      *#
+#*-----------------------------*#
+
+#? BACKEND
+# ranked fuzzy/prefix name search, see search.py
+@app.get("/search", tags=['backend'])
+async def search_Provider_Backend(request: Request, q: str, limit: int = 10, cursor: str = None,
+                                  fields: str = "name,organization,department") -> dict:
+    try:
+        marker, modified = await asyncStore.collectionState()
+        key = ("search", q, limit, cursor, fields)
+
+        async def build():
+            try:
+                results, nextCursor = await asyncStore.search(q, limit, cursor, parseFields(fields))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return dumps({
+                "response":"success",
+                "data":results,
+                "nextCursor":nextCursor
+            })
+
+        body = await responseCache.fetch(key, marker, build)
+        return conditionalResponse(request, body, "application/json", '"%s"' % marker, modified, config.cacheMaxAge)
+    except HTTPException as e:
+        return {"response":e}
+
+
+
+#*-----------------------------*#
+#*     DUPLICATE providers     *#
+#*-----------------------------*#
+
+#? BACKEND
+# providers sharing the phone or the name, organization and address of
+# this one, straight from the index
+@app.get("/duplicates", tags=['backend'])
+async def duplicates_Provider_Backend(providerID: str) -> dict:
+    try:
+        if not await asyncStore.contains(providerID):
+            raise HTTPException(status_code=404, detail="providerID not found")
+        return {"response":"success", "data":await asyncStore.duplicatesOf(providerID)}
+    except HTTPException as e:
+        return {"response":e}
+
+
+#? BACKEND
+# groups of likely duplicates over every provider, see dedup.py. Computed
+# once per change marker, in worker processes.
+@app.get("/duplicates/report", tags=['backend'])
+async def duplicates_Report_Backend(request: Request, threshold: float = 0.9, limit: int = 100) -> dict:
+    try:
+        if not 0 < threshold <= 1:
+            raise HTTPException(status_code=400, detail="threshold must be between 0 and 1")
+        if not 1 <= limit <= maxLimit:
+            raise HTTPException(status_code=400, detail="limit must be between 1 and %d" % maxLimit)
+        marker, modified = await asyncStore.collectionState()
+
+        async def build():
+            report = await asyncStore.run(lambda: duplicateReport(store.iterProviders(), config.dedupWorkers, threshold))
+            return dumps({"response":"success", **report, "total":len(report["groups"]), "groups":report["groups"][:limit]})
+
+        body = await responseCache.fetch(("duplicates", threshold, limit), marker, build)
+        return conditionalResponse(request, body, "application/json", '"%s"' % marker, modified, config.cacheMaxAge)
+    except HTTPException as e:
+        return {"response":e}
+
+
+
+#*-----------------------------*#
+#*       STATS of providers    *#
+#*-----------------------------*#
+
+#? BACKEND
+# facet counts per field. Without filters they come straight off the index
+# counters; filters and groupBy run on the columnar snapshot (columnar.py).
+@app.get("/stats", tags=['backend'])
+async def stats_Provider(fields: str = None, groupBy: str = None, name: str = None,
+                         organization: str = None, location: str = None, department: str = None,
+                         speciality: str = None, qualification: str = None, active: Optional[bool] = None,
+                         town: str = None, city: str = None, state: str = None) -> dict:
+    filters = {"organization":organization, "location":location, "department":department,
+               "speciality":speciality, "qualification":qualification, "active":active,
+               "town":town, "city":city, "state":state}
+    filtered = name is not None or any(value is not None for value in filters.values())
+    try:
+        facetFields = parseFields(fields) or list(statsFields)
+        groupFields = parseFields(groupBy) or []
+        unknown = [field for field in facetFields + groupFields if field not in statsFields]
+        if unknown:
+            raise HTTPException(status_code=400, detail="unknown field " + ", ".join(unknown) + ", use one of " + ", ".join(statsFields))
+
+        if not filtered and not groupFields:
+            return {"response":"success", "total":await asyncStore.size(), "facets":await asyncStore.facets(facetFields)}
+
+        def compute():
+            snapshot = store.columnar(config.statsSnapshotAge)
+            rows = None
+            if filtered:
+                rows = snapshot.rowsOf(store.matching(name, **filters))
+            result = {"response":"success", "total":len(snapshot) if rows is None else len(rows),
+                      "facets":{field:snapshot.facet(field, rows) for field in facetFields}, "asOf":snapshot.marker}
+            if groupFields:
+                result["groups"] = snapshot.groupBy(groupFields, rows)
+            return result
+        return await asyncStore.run(compute)
+    except HTTPException as e:
+        return {"response":e}
+
+
+
+#*-----------------------------*#
+#*       EXPORT providers      *#
+#*-----------------------------*#
+
+# join encoded providers as NDJSON lines or one JSON array, in ~64KB chunks
+def exportChunks(providers, fmt, chunkBytes=65536):
+    buffer = []
+    size = 0
+    if fmt == "json":
+        buffer.append(b"[")
+    for count, line in enumerate(providers):
+        if fmt == "ndjson":
+            line += b"\n"
+        elif count:
+            line = b"," + line
+        buffer.append(line)
+        size += len(line)
+        if size >= chunkBytes:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if fmt == "json":
+        buffer.append(b"]")
+    if buffer:
+        yield b"".join(buffer)
+
+
+#? BACKEND
+@app.get("/export", tags=['backend'])
+def export_Provider_Backend(format: str = "ndjson", since: str = None, name: str = None,
+                            organization: str = None, location: str = None, department: str = None,
+                            speciality: str = None, qualification: str = None, active: Optional[bool] = None,
+                            town: str = None, city: str = None, state: str = None):
+    if format not in ("ndjson", "json"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or json")
+    filters = {"organization":organization, "location":location, "department":department,
+               "speciality":speciality, "qualification":qualification, "active":active,
+               "town":town, "city":city, "state":state}
+
+    # take the marker first: anything changed while streaming is re-sent next time
+    marker = store.changeMarker()
+    ids = None
+    if name is not None or any(value is not None for value in filters.values()):
+        ids = [provider["providerID"] for provider in store.query(name, **filters)]
+    # since a marker, providers deleted after it follow as tombstones
+    # {"providerID":..., "deleted":true}. A deleted provider no longer
+    # matches any filter, so a filtered export gets every tombstone.
+    version = store.versionOf(since)
+    providers = chain(store.iterProviders(ids, since=version, encoded=True), store.deletedSince(version, encoded=True))
+
+    mediaType = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(exportChunks(providers, format), media_type=mediaType, headers={"X-Change-Marker":marker})
+
+
+
+#*-----------------------------*#
+#*         CHANGE FEED         *#
+#*-----------------------------*#
+
+# A subscriber takes the X-Change-Marker of an /export, then asks for what
+# changed after it: /changes long-polls, /changes/stream is Server-Sent
+# Events and /changes/ws a WebSocket. Each event names the marker to resume
+# from. See changes.py.
+
+resyncDetail = "since is older than the change feed or from another run, start over from /export"
+# how often a subscriber looks for other workers' writes while it waits
+sharedFeedPoll = 1.0
+
+
+# [(seq, encoded event)] after `since`, waiting up to `wait` seconds for the
+# first one, or None when the feed cannot fill the gap
+async def changesAfter(since, limit, wait):
+    deadline = time.monotonic() + wait
+    while True:
+        if store.shared:
+            await asyncStore.run(store.refresh)
+        events = await asyncStore.read(store.changes.since, since, limit)
+        remaining = deadline - time.monotonic()
+        if events != [] or remaining <= 0:
+            return events
+        await store.changes.wait(since, min(remaining, sharedFeedPoll) if store.shared else remaining)
+
+
+def markerAfter(since, events) -> str:
+    return events[-1][0] if events else since
+
+
+#? BACKEND
+@app.get("/changes", tags=['backend'])
+async def changes_Provider_Backend(response: Response, since: str = None, limit: int = 100, wait: float = 0):
+    try:
+        if not 1 <= limit <= maxLimit:
+            raise HTTPException(status_code=400, detail="limit must be between 1 and %d" % maxLimit)
+        if since is None:
+            # nothing to catch up on, start from here
+            return {"response":"success", "changes":[], "next":await asyncStore.read(store.changes.marker)}
+        events = await changesAfter(since, limit, min(max(wait, 0), config.changeFeedWait))
+        if events is None:
+            response.status_code = 410
+            raise HTTPException(status_code=410, detail=resyncDetail)
+        body = b'{"response":"success","changes":[' + b",".join(blob for _, blob in events) + b'],"next":' + dumps(markerAfter(since, events)) + b'}'
+        return Response(body, media_type="application/json")
+    except HTTPException as e:
+        return {"response":e, "next":await asyncStore.read(store.changes.marker)}
+
+
+# Server-Sent Events, one per change with its marker as the event id, and a
+# comment line while idle. A subscriber too slow to keep up gets a "reset"
+# event and the stream ends.
+async def changeEvents(request:Request, since):
+    subscribers.inc()
+    try:
+        while not await request.is_disconnected():
+            events = await changesAfter(since, 100, 15)
+            if events is None:
+                yield b"event: reset\ndata: " + dumps({"detail":resyncDetail, "next":await asyncStore.read(store.changes.marker)}) + b"\n\n"
+                return
+            if not events:
+                yield b": idle\n\n"
+                continue
+            yield b"".join(b"id: %s\ndata: %s\n\n" % (marker.encode(), blob) for marker, blob in events)
+            since = markerAfter(since, events)
+    finally:
+        subscribers.dec()
+
+
+#? BACKEND
+@app.get("/changes/stream", tags=['backend'])
+async def stream_Changes_Backend(request: Request, since: str = None, last_event_id: str = Header(None)):
+    since = since or last_event_id or await asyncStore.read(store.changes.marker)
+    return StreamingResponse(changeEvents(request, since), media_type="text/event-stream",
+                             headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no"})
+
+
+# one text message per change, a "reset" message when the subscriber fell
+# too far behind
+@app.websocket("/changes/ws")
+async def socket_Changes_Backend(websocket: WebSocket, since: str = None):
+    await websocket.accept()
+    since = since or await asyncStore.read(store.changes.marker)
+    subscribers.inc()
+    try:
+        while True:
+            events = await changesAfter(since, 100, 15)
+            if events is None:
+                await websocket.send_text(dumps({"op":"reset", "detail":resyncDetail, "next":await asyncStore.read(store.changes.marker)}).decode())
+                await websocket.close()
+                return
+            for _, blob in events:
+                await websocket.send_text(blob.decode())
+            since = markerAfter(since, events)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        subscribers.dec()
 
 
 
@@ -177,40 +654,32 @@ async def web_View_Provider(request: Request):
 #? BACKEND
 @app.post("/", tags=['backend'])
 async def create_Provider_Backend(providerID:str, provider:Healthcare_Provider) -> dict:
-    data = readData()
-    keys = getKeys()
     # Create new provider object with input 
     new_Data = {"providerID":providerID}
     new_Data.update(provider)
 
-    if providerID not in keys:
-        try:
-            if not validateCreate(new_Data):
-                raise HTTPException(status_code=411, detail="Empty fields. Validation Error")
+    try:
+        if not validateCreate(new_Data):
+            raise HTTPException(status_code=411, detail="Empty fields. Validation Error")
 
-            # Append new provider to existing data
-            data[providerID] = new_Data
-            writeData(data)
+        # Append new provider to existing data, fails if the ID was taken meanwhile
+        error = await asyncStore.create(providerID, new_Data)
+        if error:
+            raise HTTPException(status_code=errorStatus[error], detail=error)
+        invalidateCaches(providerID)
 
-            return {"response":"success"}
+        return await writeResponse(providerID)
 
-        except HTTPException as e:
-            return {"response":e}
-    else:
-        try:
-            raise HTTPException(status_code=400, detail="ProviderID already exist")
-        except HTTPException as e: 
-            return {"response":e}
+    except HTTPException as e:
+        return {"response":e}
 
 
 #? FRONTEND
 @app.get("/create", tags=['frontend'], response_class=HTMLResponse)
 async def create_Provider_Frontend(request:Request):
-    keys = getKeys()
-    
     # Generate unique UUID
     provID = uuid4().hex
-    while uuid4 in keys:
+    while await asyncStore.contains(provID):
         provID = uuid4().hex
 
     # Render template with generated UUID
@@ -224,41 +693,42 @@ async def create_Provider_Frontend(request:Request):
 
 #? BACKEND
 @app.put("/", tags=['backend'])
-async def update_Provider_Backend(providerID:str, dataUpdate:dict) -> dict:
+async def update_Provider_Backend(providerID:str, dataUpdate:dict, response: Response, if_match: str = Header(None)) -> dict:
     try:
-        data = readData()
-        keys = getKeys()
-
-        if providerID not in keys:
+        provider = await asyncStore.get(providerID)
+        if provider is None:
             raise HTTPException(status_code=404, detail="providerID not found")
 
         # Remove unnecessary fields
-        dataUpdateValidated = {key : dataUpdate[key] for key in dataUpdate.keys() if key in data[providerID].keys()}
+        dataUpdateValidated = {key : dataUpdate[key] for key in dataUpdate.keys() if key in provider.keys()}
         if "providerID" in dataUpdateValidated.keys():
             del dataUpdateValidated["providerID"]
+        # derived from address and location by the store
+        dataUpdateValidated.pop("addressParts", None)
 
         if not validateUpdate(dataUpdateValidated):
                 raise HTTPException(status_code=411, detail="Wrong input type. Validation Error")
 
-        #update the provider
-        for key,value in dataUpdateValidated.items():
-            data[providerID][key] = value
-        
-        writeData(data)
+        #update the provider, with If-Match only if nobody changed it since
+        error = await asyncStore.update(providerID, dataUpdateValidated, if_match)
+        if error:
+            raise HTTPException(status_code=errorStatus[error], detail=error)
+        invalidateCaches(providerID)
+        response.headers["ETag"] = await asyncStore.etag(providerID)
 
-        return {"response":"success"}
+        return await writeResponse(providerID)
 
     except HTTPException as e:
+        if e.status_code == 412:
+            response.status_code = 412
         return {"response":e}
 
 
 #? FRONTEND
 @app.get("/update", tags=['frontend'], response_class = HTMLResponse)
-def update_Provider_Frontend(request:Request):
-    providerList = getKeys()
-
-    # Render template with keys
-    return templates.TemplateResponse("updateProvider.html", {"request":request, "providerList":providerList})
+async def update_Provider_Frontend(request:Request):
+    # Render template with the cached providerID options
+    return await renderPage(request, "updateProvider.html", lambda: {"providerOptions":fragments.lazyOptions("providerOptions")})
 
 
 
@@ -268,27 +738,135 @@ def update_Provider_Frontend(request:Request):
 
 #? BACKEND
 @app.delete("/", tags=['backend'])
-async def delete_Provider_Backend(providerID:str)   -> dict:
+async def delete_Provider_Backend(providerID:str, response: Response, if_match: str = Header(None))   -> dict:
     try:
-        data = readData()
-        keys = getKeys()
-
-        if providerID not in keys:
+        # delete data from memory and log it
+        error = await asyncStore.delete(providerID, if_match)
+        if error == notFound:
             raise HTTPException(status_code=404, detail="ProviderID not found")
-
-        # delete data from local variable and update to the file
-        del data[providerID]
-        writeData(data)
+        if error:
+            raise HTTPException(status_code=errorStatus[error], detail=error)
+        invalidateCaches(providerID)
 
         return {"response":"success"}
 
     except HTTPException as e:
+        if e.status_code == 412:
+            response.status_code = 412
         return {"response":e}
 
 
 #? FRONTEND
 @app.get("/delete", tags=['frontend'], response_class = HTMLResponse)
 async def delete_Provider_Frontend(request:Request):
-    keys = getKeys()
+    return await renderPage(request, "deleteProvider.html", lambda: {"providerOptions":fragments.lazyOptions("providerOptions")})
+
+
 
-    return templates.TemplateResponse("deleteProvider.html", {"request":request, "providerList":keys})
\ No newline at end of file
+#*---------------------------*#
+#*       BULK operations     *#
+#*---------------------------*#
+
+# validate one bulk item the same way the single-provider handlers do and
+# turn it into a store mutation. Returns (mutation, None) or (None, error).
+# Items are {"op", "providerID", "data"} plus an optional "ifMatch" ETag.
+def prepareBulkItem(item) -> tuple:
+    if not isinstance(item, dict):
+        return None, "item must be an object"
+    op = item.get("op")
+    providerID = item.get("providerID")
+    data = item.get("data") or {}
+    if not isinstance(data, dict):
+        return None, "data must be an object"
+    # the ID becomes a key of data.json, which must be a string
+    if providerID is not None and (not isinstance(providerID, str) or not providerID):
+        return None, "providerID must be a non-empty string"
+
+    if op == "create":
+        providerID = providerID or uuid4().hex
+        try:
+            provider = Healthcare_Provider(**data)
+        except ValidationError as e:
+            return None, e.errors()
+        new_Data = {"providerID":providerID}
+        new_Data.update(provider)
+        if not validateCreate(new_Data):
+            return None, "Empty fields. Validation Error"
+        return ("create", providerID, new_Data), None
+
+    if not providerID:
+        return None, "providerID is required"
+    if op == "update":
+        dataUpdateValidated = {key : data[key] for key in data.keys() if key in Healthcare_Provider.__fields__}
+        if not validateUpdate(dataUpdateValidated):
+            return None, "Wrong input type. Validation Error"
+        return ("update", providerID, dataUpdateValidated), None
+    if op == "delete":
+        return ("delete", providerID, None), None
+    return None, "op must be create, update or delete"
+
+
+# bulk items from a JSON array body or an NDJSON stream
+async def readBulkItems(request:Request) -> list:
+    if "ndjson" in request.headers.get("content-type", ""):
+        items = []
+        pending = b""
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            items.extend(loads(line) for line in lines if line.strip())
+        if pending.strip():
+            items.append(loads(pending))
+        return items
+    items = loads(await request.body())
+    if not isinstance(items, list):
+        raise ValueError("body must be a JSON array")
+    return items
+
+
+#? BACKEND
+@app.post("/bulk", tags=['backend'])
+async def bulk_Provider_Backend(request:Request, atomic: bool = True) -> dict:
+    results = []
+    try:
+        try:
+            items = await readBulkItems(request)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="body must be a JSON array or NDJSON of operations")
+
+        # validate everything before touching the store, off the event loop
+        prepared = await asyncStore.run(lambda: [prepareBulkItem(item) for item in items])
+        ops = []
+        for index, (item, (mutation, error)) in enumerate(zip(items, prepared)):
+            providerID = mutation[1] if mutation else (item.get("providerID") if isinstance(item, dict) else None)
+            results.append({"index":index, "providerID":providerID, "response":"success" if mutation else "error"})
+            if mutation:
+                ops.append((index, mutation))
+            else:
+                results[index]["detail"] = error
+
+        failed = len(ops) != len(items)
+        if failed and atomic:
+            for index, _ in ops:
+                results[index]["response"] = "skipped"
+            raise HTTPException(status_code=411, detail="Validation Error. No operation applied")
+
+        # one lock, one log append, one commit for the whole batch
+        ifMatch = {mutation[1]:items[index]["ifMatch"] for index, mutation in ops if items[index].get("ifMatch")}
+        errors = await asyncStore.mutate([mutation for _, mutation in ops], partial=not atomic, ifMatch=ifMatch)
+        invalidateCaches(*(mutation[1] for (_, mutation), error in zip(ops, errors) if not error))
+        for (index, _), error in zip(ops, errors):
+            if error:
+                results[index]["response"] = "error"
+                results[index]["detail"] = error
+                failed = True
+        if failed and atomic:
+            for index, _ in ops:
+                if results[index]["response"] == "success":
+                    results[index]["response"] = "skipped"
+            raise HTTPException(status_code=409, detail="Conflicting providerIDs, ETags or phones. No operation applied")
+
+        return {"response":"success", "applied":sum(result["response"] == "success" for result in results), "results":results}
+
+    except HTTPException as e:
+        return {"response":e, "applied":0, "results":results}
@@ -0,0 +1,112 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+#*--------------------------*#
+#*    ASYNC PROVIDER STORE  *#
+#*--------------------------*#
+
+# What the async handlers await instead of calling ProviderStore directly.
+# Anything that can touch the disk (every write, and every read when the
+# backend is shared and has to be polled) runs on a bounded pool of
+# `threads` threads, so a slow fsync or a SQLite lock wait never stalls the
+# event loop. Reads of a non-shared store are plain dict lookups and stay
+# on the loop.
+class AsyncProviderStore:
+
+    def __init__(self, store, threads=8):
+        self.store = store
+        self.threads = threads
+        self.executor = None
+
+    # run any blocking callable on the store's pool
+    async def run(self, fn, *args, **kwargs):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="store-io")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def read(self, fn, *args, **kwargs):
+        if self.store.shared:
+            return await self.run(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    # reads that use the indexes. A store loaded from data.snap builds them
+    # in the background after startup, and until then these reads wait for
+    # it, so they go to the pool as well.
+    async def readIndexed(self, fn, *args, **kwargs):
+        if self.store.shared or not self.store.indexed.is_set():
+            return await self.run(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    # READ
+
+    async def size(self) -> int:
+        return await self.read(self.store.__len__)
+
+    async def contains(self, providerID) -> bool:
+        return await self.read(self.store.__contains__, providerID)
+
+    async def get(self, providerID):
+        return await self.read(self.store.get, providerID)
+
+    async def etag(self, providerID):
+        return await self.read(self.store.etag, providerID)
+
+    async def encoded(self, providerID):
+        return await self.read(self.store.encoded, providerID)
+
+    async def collectionState(self) -> tuple:
+        return await self.read(self.store.collectionState)
+
+    async def keys(self) -> list:
+        return await self.read(lambda: list(self.store.keys()))
+
+    async def fetch(self, ids, encoded=False) -> list:
+        return await self.read(self.store.fetch, ids, None, encoded)
+
+    async def findByName(self, name):
+        return await self.readIndexed(self.store.findByName, name)
+
+    async def query(self, name=None, **filters) -> list:
+        return await self.readIndexed(self.store.query, name, **filters)
+
+    async def facets(self, fields) -> dict:
+        return await self.readIndexed(self.store.facets, fields)
+
+    async def duplicatesOf(self, providerID) -> list:
+        return await self.readIndexed(self.store.duplicatesOf, providerID)
+
+    async def count(self, name=None, **filters) -> int:
+        return await self.readIndexed(self.store.count, name, **filters)
+
+    async def search(self, *args, **kwargs) -> tuple:
+        return await self.readIndexed(self.store.search, *args, **kwargs)
+
+    async def page(self, *args, **kwargs) -> tuple:
+        return await self.read(self.store.page, *args, **kwargs)
+
+    # WRITE
+
+    async def create(self, providerID, provider:dict):
+        return await self.run(self.store.create, providerID, provider)
+
+    async def update(self, providerID, fields:dict, ifMatch=None):
+        return await self.run(self.store.update, providerID, fields, ifMatch)
+
+    async def delete(self, providerID, ifMatch=None):
+        return await self.run(self.store.delete, providerID, ifMatch)
+
+    async def mutate(self, ops:list, partial=False, ifMatch=None) -> list:
+        return await self.run(self.store.mutate, ops, partial, ifMatch)
+
+    # in a forked worker: the parent's pool threads did not come along
+    def afterFork(self):
+        self.store.afterFork()
+        self.executor = None
+
+    # wait for in-flight store I/O, the pool is recreated on next use
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
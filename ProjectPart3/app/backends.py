@@ -0,0 +1,558 @@
+import contextlib
+import fcntl
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from .metrics import timed
+from .serialization import dumps, dumpsPretty, loads
+from .snapshot import Snapshot, SnapshotRecords, encodedItems, writeSnapshot
+from .wal import WriteAheadLog, replayLog
+
+log = logging.getLogger(__name__)
+
+
+# read JSON file to dict
+@timed("storage.readData")
+def readData(jFile):
+    with open(jFile, 'rb') as jf:
+        loadedJsonData = dict(loads(jf.read()))
+    return loadedJsonData
+
+
+# write dict to JSON file, compact unless `pretty`. A crash leaves either the
+# old or the new file. Other mappings (CompactRecords, SnapshotRecords) are
+# written a provider at a time instead of decoding them all at once.
+@timed("storage.writeData")
+def writeData(data, jFile, pretty=False):
+    tmpFile = jFile + ".tmp"
+    with open(tmpFile, 'wb') as jf:
+        if pretty:
+            jf.write(dumpsPretty(dict(data)))
+        elif isinstance(data, dict):
+            jf.write(dumps(data))
+        else:
+            jf.write(b"{")
+            for i, (providerID, blob) in enumerate(encodedItems(data)):
+                jf.write((b"," if i else b"") + dumps(providerID) + b":" + blob)
+            jf.write(b"}")
+        jf.flush()
+        os.fsync(jf.fileno())
+    os.replace(tmpFile, jFile)
+
+
+# batches are stored flattened by backends that have no batch entry
+def flattenEntries(entries:list) -> list:
+    flat = []
+    for entry in entries:
+        if entry["op"] == "batch":
+            flat.extend(flattenEntries(entry["ops"]))
+        else:
+            flat.append(entry)
+    return flat
+
+
+#*--------------------------*#
+#*     STORAGE BACKENDS     *#
+#*--------------------------*#
+
+# Persistence under ProviderStore. The store keeps every provider in memory
+# and hands the backend log entries in the write-ahead log format
+# ({"op": "put"|"delete"|"batch", ...}, see wal.py). A mutation runs as
+#
+#     with store.lock:
+#         with backend.transaction():
+#             store applies backend.poll()    (shared backends only)
+#             store checks and applies the mutation in memory
+#             token = backend.write(entries)
+#     backend.durable(token)
+#
+# A `shared` backend can be written by other processes at the same time, so
+# the store also polls it before serving reads.
+class StorageBackend:
+
+    shared = False
+
+    # every provider, keyed by providerID
+    def load(self) -> dict:
+        raise NotImplementedError
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    # persist log entries, returns a token for durable()
+    def write(self, entries:list):
+        raise NotImplementedError
+
+    # wait until the write behind `token` survives a crash
+    def durable(self, token):
+        pass
+
+    # entries written by other processes since the last call, or None when
+    # they can no longer be replayed and the store must load() again
+    def poll(self) -> list:
+        return []
+
+    def start(self, store):
+        pass
+
+    def close(self):
+        pass
+
+    # in a process forked after load() (see prefork.py): replace whatever
+    # the child must not share with its parent
+    def afterFork(self):
+        pass
+
+
+#*--------------------------*#
+#*     JSON FILE BACKEND    *#
+#*--------------------------*#
+
+# data.json snapshot plus the data.json.log write-ahead log. A background
+# thread compacts the log into a fresh snapshot every `compactInterval`
+# seconds, or sooner once it grows past `compactThreshold` bytes.
+#
+# With `binary` the snapshot is data.snap instead (see snapshot.py), imported
+# from data.json on first start. It is memory-mapped, so loading returns
+# right away and records are decoded as they are read; after compaction the
+# store moves onto the new file.
+class JsonFileBackend(StorageBackend):
+
+    def __init__(self, jFile, commitInterval=0.002, syncCommit=True, compactInterval=60.0, compactThreshold=16 * 1024 * 1024, pretty=False, binary=False):
+        self.jFile = jFile
+        self.pretty = pretty
+        self.binary = binary
+        self.snapFile = os.path.splitext(jFile)[0] + ".snap"
+        self.logFile = jFile + ".log"
+        self.rotatedFile = jFile + ".log.1"
+        self.commitInterval = commitInterval
+        self.syncCommit = syncCommit
+        self.compactInterval = compactInterval
+        self.compactThreshold = compactThreshold
+
+        self.wal = None
+        self.store = None
+        self.compactLock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.compactor = None
+
+    def load(self) -> dict:
+        if self.wal is not None:
+            self.wal.sync()
+        data = self.readFile()
+        # a rotated log still on disk means we stopped mid-compaction
+        interrupted = os.path.exists(self.rotatedFile)
+        replayLog(data, self.rotatedFile)
+        replayLog(data, self.logFile)
+        if interrupted:
+            self.writeFile(data)
+            os.remove(self.rotatedFile)
+        if self.wal is None:
+            self.wal = WriteAheadLog(self.logFile, self.commitInterval)
+        return data
+
+    def write(self, entries:list):
+        return self.wal.append(entries[0] if len(entries) == 1 else {"op":"batch", "ops":entries})
+
+    def durable(self, seq):
+        if self.syncCommit:
+            self.wal.waitDurable(seq)
+        if self.compactThreshold and self.wal.bytes >= self.compactThreshold:
+            self.wakeup.set()
+
+    def readFile(self):
+        if not self.binary:
+            return readData(self.jFile)
+        if not os.path.exists(self.snapFile):
+            writeSnapshot(readData(self.jFile), self.snapFile)
+        return SnapshotRecords(Snapshot(self.snapFile))
+
+    def writeFile(self, data):
+        if self.binary:
+            writeSnapshot(data, self.snapFile)
+        else:
+            writeData(data, self.jFile, self.pretty)
+
+    # move `data`, the store's mapping, onto the snapshot just written from
+    # `written`, so changes stop piling up on the old file. Under the store
+    # lock, and not while the store is still indexing the old file.
+    def rebaseLocked(self, data, written):
+        if self.binary and isinstance(written, SnapshotRecords) and self.store.data is data and self.store.indexed.is_set():
+            data.rebase(Snapshot(self.snapFile), written)
+
+    # fold the log into a new snapshot. The log is rotated under the store
+    # lock so the snapshot and the fresh log line up exactly; the slow part,
+    # writing the snapshot, happens after writers are let back in.
+    def compact(self):
+        with self.compactLock:
+            with self.store.lock:
+                if not self.wal.bytes:
+                    return
+                data = self.store.data
+                snapshot = data.copy()
+                self.wal.rotate(self.rotatedFile)
+            self.writeFile(snapshot)
+            os.remove(self.rotatedFile)
+            with self.store.lock:
+                self.rebaseLocked(data, snapshot)
+
+    def runCompactor(self):
+        while not self.stopping:
+            self.wakeup.wait(self.compactInterval)
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            try:
+                self.compact()
+            except Exception:
+                log.exception("compaction of %s failed", self.jFile)
+
+    def start(self, store):
+        self.store = store
+        # reopened after a close()
+        if self.wal is None:
+            self.wal = WriteAheadLog(self.logFile, self.commitInterval)
+        if self.compactor is None:
+            self.stopping = False
+            self.compactor = threading.Thread(target=self.runCompactor, name="provider-compactor", daemon=True)
+            self.compactor.start()
+
+    def close(self):
+        if self.compactor is not None:
+            self.stopping = True
+            self.wakeup.set()
+            self.compactor.join()
+            self.compactor = None
+        if self.store is not None:
+            self.compact()
+        # flushes what is still queued, then stops the committer thread
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+
+#*----------------------------*#
+#*  SHARED JSON FILE BACKEND  *#
+#*----------------------------*#
+
+# JsonFileBackend for several worker processes on one machine. A mutation
+# takes an exclusive flock on data.json.lock, replays what other workers
+# appended to the log since this one last looked, and appends and fsyncs its
+# own line before letting go, so there is no group commit across processes.
+# Compaction also runs under the flock and starts a new log file; workers
+# that see the log's inode change reload snapshot and log. Without
+# `compacts` this process leaves compaction to another one: it neither runs
+# the compactor nor compacts on close (see prefork.py).
+class SharedJsonFileBackend(JsonFileBackend):
+
+    shared = True
+
+    def __init__(self, jFile, syncCommit=True, compactInterval=60.0, compactThreshold=16 * 1024 * 1024, pretty=False, binary=False, compacts=True):
+        super().__init__(jFile, 0, syncCommit, compactInterval, compactThreshold, pretty, binary)
+        self.compacts = compacts
+        self.lockFile = open(jFile + ".lock", 'a')
+        self.lockDepth = 0
+        self.fd = None
+        self.inode = None
+        self.offset = 0
+
+    # exclusive flock, re-entrant within this process (the store lock keeps
+    # other threads out)
+    @contextlib.contextmanager
+    def flock(self):
+        if not self.lockDepth:
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        self.lockDepth += 1
+        try:
+            yield
+        finally:
+            self.lockDepth -= 1
+            if not self.lockDepth:
+                fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+
+    def transaction(self):
+        return self.flock()
+
+    def openLog(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.logFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        stat = os.fstat(self.fd)
+        self.inode = stat.st_ino
+        self.offset = self.bytes = stat.st_size
+
+    def load(self) -> dict:
+        with self.flock():
+            data = self.readFile()
+            if os.path.exists(self.rotatedFile):
+                replayLog(data, self.rotatedFile)
+                replayLog(data, self.logFile)
+                self.writeFile(data)
+                os.remove(self.rotatedFile)
+            else:
+                replayLog(data, self.logFile)
+            self.openLog()
+        return data
+
+    def poll(self) -> list:
+        try:
+            stat = os.stat(self.logFile)
+        except FileNotFoundError:
+            return None
+        if stat.st_ino != self.inode:
+            return None
+        if stat.st_size <= self.offset:
+            return []
+        with open(self.logFile, 'rb') as lf:
+            lf.seek(self.offset)
+            chunk = lf.read(stat.st_size - self.offset)
+        # a line still being written by another worker is picked up next time
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+        self.offset += len(chunk)
+        self.bytes = self.offset
+        return flattenEntries([loads(line) for line in chunk.splitlines() if line.strip()])
+
+    def write(self, entries:list):
+        entry = entries[0] if len(entries) == 1 else {"op":"batch", "ops":entries}
+        line = dumps(entry) + b"\n"
+        os.write(self.fd, line)
+        if self.syncCommit:
+            os.fsync(self.fd)
+        self.offset += len(line)
+        self.bytes = self.offset
+
+    def durable(self, token):
+        if self.compactThreshold and self.bytes >= self.compactThreshold:
+            self.wakeup.set()
+
+    def compact(self):
+        with self.compactLock, self.store.lock, self.flock():
+            self.store.syncLocked()
+            if not self.offset:
+                return
+            self.writeFile(self.store.data)
+            self.rebaseLocked(self.store.data, self.store.data)
+            newLog = self.logFile + ".new"
+            open(newLog, 'w').close()
+            os.replace(newLog, self.logFile)
+            self.openLog()
+
+    def start(self, store):
+        if self.compacts:
+            super().start(store)
+        else:
+            self.store = store
+
+    def close(self):
+        if self.compactor is not None:
+            self.stopping = True
+            self.wakeup.set()
+            self.compactor.join()
+            self.compactor = None
+        if self.store is not None and self.compacts:
+            self.compact()
+
+    # a flock belongs to the open file, which the child shares with its
+    # parent, so the two would never wait for each other
+    def afterFork(self):
+        self.lockFile = open(self.lockFile.name, 'a')
+
+
+#*--------------------------*#
+#*      SQLITE BACKEND      *#
+#*--------------------------*#
+
+sqliteSchema = """
+CREATE TABLE IF NOT EXISTS providers (
+    providerID   TEXT PRIMARY KEY,
+    name         TEXT,
+    organization TEXT,
+    location     TEXT,
+    data         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS providers_name ON providers (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS providers_organization ON providers (organization);
+CREATE INDEX IF NOT EXISTS providers_location ON providers (location);
+CREATE TABLE IF NOT EXISTS changelog (
+    seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    providerID TEXT NOT NULL
+);
+"""
+
+# statements are module constants so every pooled connection's statement
+# cache prepares each of them once
+upsertProvider = "INSERT OR REPLACE INTO providers (providerID, name, organization, location, data) VALUES (?, ?, ?, ?, ?)"
+deleteProvider = "DELETE FROM providers WHERE providerID = ?"
+logChange = "INSERT INTO changelog (providerID) VALUES (?)"
+selectProviders = "SELECT providerID, data FROM providers"
+selectChangeRange = "SELECT MIN(seq), MAX(seq) FROM changelog"
+selectChanges = "SELECT c.seq, c.providerID, p.data FROM changelog c LEFT JOIN providers p ON p.providerID = c.providerID WHERE c.seq > ? ORDER BY c.seq"
+pruneChanges = "DELETE FROM changelog WHERE seq <= ?"
+
+
+# fixed set of connections shared by the threads of one process
+class ConnectionPool:
+
+    def __init__(self, dbFile, size, synchronous="FULL"):
+        self.dbFile = dbFile
+        self.synchronous = synchronous
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put(self.connect())
+
+    def connect(self):
+        conn = sqlite3.connect(self.dbFile, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=" + self.synchronous)
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+# Providers in a SQLite database in WAL mode, safe to share between uvicorn
+# workers. Every write also appends the providerID to `changelog`; the other
+# workers replay the changelog rows past the last one they have seen to keep
+# their in-memory copy current. The changelog is pruned down to
+# `changelogKeep` rows, a worker that falls further behind reloads.
+class SqliteBackend(StorageBackend):
+
+    shared = True
+
+    def __init__(self, dbFile, poolSize=4, syncCommit=True, importFrom=None, changelogKeep=100000, pruneInterval=60.0):
+        self.dbFile = dbFile
+        self.importFrom = importFrom
+        self.changelogKeep = changelogKeep
+        self.pruneInterval = pruneInterval
+
+        self.poolSize = poolSize
+        self.synchronous = "FULL" if syncCommit else "NORMAL"
+        self.pool = ConnectionPool(dbFile, poolSize, self.synchronous)
+        with self.pool.connection() as conn:
+            conn.executescript(sqliteSchema)
+
+        self.lastSeq = 0
+        self.current = None
+        self.stopping = threading.Event()
+        self.pruner = None
+
+    @timed("storage.sqliteLoad")
+    def load(self) -> dict:
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # first start on an empty database: take over the JSON file
+                empty = conn.execute("SELECT COUNT(*) FROM providers").fetchone()[0] == 0
+                if empty and self.importFrom and os.path.exists(self.importFrom):
+                    entries = [{"op":"put", "id":providerID, "data":provider} for providerID, provider in readData(self.importFrom).items()]
+                    self.writeWith(conn, entries)
+                data = {providerID:loads(provider) for providerID, provider in conn.execute(selectProviders)}
+                self.lastSeq = conn.execute(selectChangeRange).fetchone()[1] or 0
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return data
+
+    # BEGIN IMMEDIATE takes the database write lock up front, so the poll,
+    # check and write of a mutation are serialised across all workers
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self.current = conn
+            try:
+                yield
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self.current = None
+
+    def write(self, entries:list):
+        self.writeWith(self.current, entries)
+
+    @timed("storage.sqliteWrite")
+    def writeWith(self, conn, entries:list):
+        entries = flattenEntries(entries)
+        puts = [(e["id"], e["data"].get("name"), e["data"].get("organization"), e["data"].get("location"), dumps(e["data"]).decode())
+                for e in entries if e["op"] == "put"]
+        deletes = [(e["id"],) for e in entries if e["op"] == "delete"]
+        if puts:
+            conn.executemany(upsertProvider, puts)
+        if deletes:
+            conn.executemany(deleteProvider, deletes)
+        conn.executemany(logChange, [(e["id"],) for e in entries])
+        self.lastSeq = conn.execute(selectChangeRange).fetchone()[1]
+
+    def poll(self) -> list:
+        if self.current is not None:
+            return self.pollWith(self.current)
+        with self.pool.connection() as conn:
+            return self.pollWith(conn)
+
+    def pollWith(self, conn) -> list:
+        first, last = conn.execute(selectChangeRange).fetchone()
+        if last is None or last <= self.lastSeq:
+            return []
+        if first > self.lastSeq + 1:
+            return None
+        entries = []
+        for seq, providerID, provider in conn.execute(selectChanges, (self.lastSeq,)):
+            if provider is None:
+                entries.append({"op":"delete", "id":providerID})
+            else:
+                entries.append({"op":"put", "id":providerID, "data":loads(provider)})
+            self.lastSeq = seq
+        return entries
+
+    def runPruner(self):
+        while not self.stopping.wait(self.pruneInterval):
+            try:
+                with self.pool.connection() as conn:
+                    last = conn.execute(selectChangeRange).fetchone()[1]
+                    if last is not None and last > self.changelogKeep:
+                        conn.execute(pruneChanges, (last - self.changelogKeep,))
+            except Exception:
+                log.exception("pruning the changelog of %s failed", self.dbFile)
+
+    def start(self, store):
+        # reopened after a close()
+        if self.pool is None:
+            self.pool = ConnectionPool(self.dbFile, self.poolSize, self.synchronous)
+        if self.pruner is None:
+            self.stopping.clear()
+            self.pruner = threading.Thread(target=self.runPruner, name="changelog-pruner", daemon=True)
+            self.pruner.start()
+
+    # SQLite connections must not cross a fork. The inherited ones are kept
+    # open but unused: closing them could checkpoint the WAL under the parent.
+    # The parent's pruner thread did not come along.
+    def afterFork(self):
+        self.inherited = self.pool
+        self.pool = ConnectionPool(self.dbFile, self.poolSize, self.synchronous)
+        self.pruner = None
+        self.stopping = threading.Event()
+
+    def close(self):
+        if self.pruner is not None:
+            self.stopping.set()
+            self.pruner.join()
+            self.pruner = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
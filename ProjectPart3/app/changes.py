@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from itertools import islice
+from .metrics import registry, Gauge, Counter
+from .serialization import dumps
+
+
+#*--------------------------*#
+#*        CHANGE FEED       *#
+#*--------------------------*#
+
+# Every mutation ProviderStore applies, local or replayed from another
+# worker, becomes an event in a bounded ring buffer:
+#
+#   {"seq": 42, "marker": "1f3a9c2e.42", "op": "create"|"update"|"put"|"delete",
+#    "providerID": ..., "data": <provider after the change, not on delete>,
+#    "at": <unix time>}
+#
+# `seq` is the store version the change produced, so events of one epoch
+# are numbered without gaps and `marker` is the change marker /export and
+# the collection ETags use. A subscriber resumes after the marker of the
+# last event it saw. When that is older than the buffer or from another
+# epoch (a restart or reload) the feed cannot fill the gap, and the
+# subscriber has to start over from /export.
+#
+# Publishing only encodes the event and appends it; readers pull at their
+# own pace from their own position, so a slow subscriber costs the write
+# path nothing and just falls off the end of the buffer.
+
+subscribers = registry.register(Gauge("change_feed_subscribers", "Open change feed streams"))
+published = registry.register(Counter("change_feed_events_total", "Events published to the change feed"))
+
+
+def wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ChangeFeed:
+
+    def __init__(self, capacity:int):
+        self.events = deque(maxlen=capacity)
+        self.epoch = None
+        self.lastSeq = 0
+        self.lock = threading.Lock()
+        # (loop, future) of the readers waiting for the next event
+        self.waiters = []
+
+    # forget everything: the store starts a new epoch
+    def reset(self, epoch:str):
+        with self.lock:
+            self.events.clear()
+            self.epoch = epoch
+            self.lastSeq = 0
+        self.wakeWaiters()
+
+    # called by the store under its lock, with seq one past the last one
+    def publish(self, seq:int, op:str, providerID, provider=None):
+        event = {"seq":seq, "marker":self.markerOf(seq), "op":op, "providerID":providerID}
+        if provider is not None:
+            event["data"] = provider
+        event["at"] = time.time()
+        blob = dumps(event)
+        with self.lock:
+            self.events.append((seq, blob))
+            self.lastSeq = seq
+        published.inc()
+        self.wakeWaiters()
+
+    def wakeWaiters(self):
+        with self.lock:
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+    def markerOf(self, seq:int) -> str:
+        return "%s.%d" % (self.epoch, seq)
+
+    def marker(self) -> str:
+        return self.markerOf(self.lastSeq)
+
+    # [(marker, encoded event)] after `marker`, at most `limit`, or None
+    # when the feed no longer holds all of them. Each marker is the one to
+    # resume from after its event.
+    def since(self, marker, limit:int):
+        epoch, _, seq = (marker or "").partition(".")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self.lock:
+            if seq > self.lastSeq:
+                return None
+            oldest = self.events[0][0] if self.events else self.lastSeq + 1
+            if seq < oldest - 1:
+                return None
+            start = seq - oldest + 1
+            return [(self.markerOf(seq), blob) for seq, blob in islice(self.events, start, start + limit)]
+
+    # wait up to `timeout` seconds for anything after `marker`, True if
+    # something happened
+    async def wait(self, marker, timeout:float) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if marker != self.marker():
+                return True
+            self.waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self.lock:
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+            return False
@@ -0,0 +1,121 @@
+import time
+from array import array
+from collections import Counter
+from itertools import accumulate, chain
+from operator import itemgetter
+from .metrics import timed
+from .index import tokenFields, valueFields, addressIndexFields, foldValue, splitTokens, facetLabel
+
+
+#*--------------------------*#
+#*     COLUMNAR SNAPSHOT    *#
+#*--------------------------*#
+
+# Array-backed copy of the facet fields for ad-hoc group-bys over filtered
+# subsets. Each field is dictionary-encoded: a value becomes a small integer
+# code and a column is an array('I') of codes, one per row. Token fields
+# (qualification, speciality) hold several codes per row, row r owning
+# tokens[offsets[r]:offsets[r + 1]].
+#
+# A snapshot is immutable. ProviderStore builds a new one when the store
+# has changed and the old one is older than the allowed age.
+
+singleFields = valueFields + addressIndexFields
+statsFields = tokenFields + singleFields
+
+
+# the values of `column` at `rows`, in C rather than a Python loop
+def pick(column, rows):
+    if rows is None:
+        return column
+    if len(rows) == 1:
+        return (column[rows[0]],)
+    return itemgetter(*rows)(column) if rows else ()
+
+
+class ColumnarSnapshot:
+
+    @timed("columnar.build")
+    def __init__(self, marker:str, providers):
+        self.marker = marker
+        self.builtAt = time.monotonic()
+        providers = list(providers)
+        self.rows = {provider["providerID"]:row for row, provider in enumerate(providers)}
+        # field -> folded value -> code, and code -> label
+        self.codes = {}
+        self.labels = {}
+        self.columns = {}
+        self.offsets = {}
+        self.tokens = {}
+        # encode per distinct value, then map every row through the result
+        addresses = [provider.get("addressParts") or {} for provider in providers]
+        for field in singleFields:
+            if field in addressIndexFields:
+                values = [parts.get(field) for parts in addresses]
+            else:
+                values = [provider.get(field) for provider in providers]
+            # codes in order of first appearance, labelled with the value as
+            # first written
+            codes = self.codes[field] = {}
+            labels = self.labels[field] = []
+            valueCodes = {}
+            for value in dict.fromkeys(values):
+                key = foldValue(value)
+                if key not in codes:
+                    codes[key] = len(labels)
+                    labels.append(facetLabel(value))
+                valueCodes[value] = codes[key]
+            self.columns[field] = array("I", map(valueCodes.__getitem__, values))
+        for field in tokenFields:
+            values = [provider.get(field) for provider in providers]
+            codes = self.codes[field] = {}
+            encoded = {value:[codes.setdefault(token, len(codes)) for token in splitTokens(value)] for value in dict.fromkeys(values)}
+            lengths = {value:len(tokens) for value, tokens in encoded.items()}
+            self.tokens[field] = array("I", chain.from_iterable(map(encoded.__getitem__, values)))
+            self.offsets[field] = array("I", [0])
+            self.offsets[field].extend(accumulate(map(lengths.__getitem__, values)))
+            self.labels[field] = list(codes)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # rows of the providers in `ids` that this snapshot holds
+    def rowsOf(self, ids) -> list:
+        rows = self.rows
+        return [rows[providerID] for providerID in ids if providerID in rows]
+
+    # codes of `field` for every row, or for `rows`
+    def valuesOf(self, field, rows=None):
+        if field in tokenFields:
+            tokens, offsets = self.tokens[field], self.offsets[field]
+            if rows is None:
+                return tokens
+            return [code for row in rows for code in tokens[offsets[row]:offsets[row + 1]]]
+        return pick(self.columns[field], rows)
+
+    # {value: count} of one field over every row, or over `rows`
+    def facet(self, field, rows=None) -> dict:
+        labels = self.labels[field]
+        return {labels[code]:count for code, count in Counter(self.valuesOf(field, rows)).items()}
+
+    # [{field: value, ..., "count": n}] grouped on every field of `fields`,
+    # largest group first. A row with several tokens counts in each group.
+    def groupBy(self, fields, rows=None) -> list:
+        if all(field in singleFields for field in fields):
+            counts = Counter(zip(*(pick(self.columns[field], rows) for field in fields)))
+        else:
+            if rows is None:
+                rows = range(len(self))
+            counts = Counter()
+            for row in rows:
+                groups = [()]
+                for field in fields:
+                    if field in tokenFields:
+                        values = self.tokens[field][self.offsets[field][row]:self.offsets[field][row + 1]]
+                    else:
+                        values = (self.columns[field][row],)
+                    groups = [group + (value,) for group in groups for value in values]
+                counts.update(groups)
+        labels = [self.labels[field] for field in fields]
+        return [{**{field:labels[i][code] for i, (field, code) in enumerate(zip(fields, group))}, "count":count}
+                for group, count in counts.most_common()]
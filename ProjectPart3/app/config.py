@@ -0,0 +1,112 @@
+import os
+
+# Every setting can be overridden from the environment so the same code runs
+# unchanged in dev (`python main.py`) and behind a process manager.
+
+jsonFileName = os.environ.get("PROVIDER_DATA", "./data.json")
+
+# write-ahead log: commits are grouped over `commitInterval` seconds and,
+# with `syncCommit`, a write only returns once its commit is fsynced
+commitInterval = float(os.environ.get("PROVIDER_COMMIT_INTERVAL", "0.002"))
+syncCommit = os.environ.get("PROVIDER_SYNC_COMMIT", "1") == "1"
+
+# compaction of the log into data.json: every `compactInterval` seconds, or
+# sooner once the log reaches `compactThreshold` bytes
+compactInterval = float(os.environ.get("PROVIDER_COMPACT_INTERVAL", "60"))
+compactThreshold = int(os.environ.get("PROVIDER_COMPACT_THRESHOLD", str(16 * 1024 * 1024)))
+
+# storage backend: "json" (data.json + write-ahead log) or "sqlite". Both
+# can be shared by several uvicorn workers; JSON switches to flock-guarded
+# appends when WEB_CONCURRENCY > 1. On first start the SQLite database
+# imports `jsonFileName`.
+storageBackend = os.environ.get("PROVIDER_STORAGE", "json")
+sqliteFileName = os.environ.get("PROVIDER_SQLITE", "./data.db")
+
+# one pooled SQLite connection per thread that may use it at once
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+poolSize = int(os.environ.get("PROVIDER_POOL_SIZE", str(max(4, workers))))
+
+# with a shared backend, how stale (seconds) a read may be before the store
+# checks for other workers' writes
+pollInterval = float(os.environ.get("PROVIDER_POLL_INTERVAL", "0"))
+
+# threads that run blocking store I/O for the async handlers
+ioThreads = int(os.environ.get("PROVIDER_IO_THREADS", "8"))
+
+# JSON encoding: orjson when installed, compact stdlib json otherwise.
+# `prettyJSON` writes data.json indented for hand inspection, `fastJSON`
+# makes it the default response class for every route.
+prettyJSON = os.environ.get("PROVIDER_PRETTY_JSON", "0") == "1"
+fastJSON = os.environ.get("PROVIDER_FAST_JSON", "1") == "1"
+
+# HTTP caching: Cache-Control max-age of cacheable GETs (0 = revalidate
+# every time) and the bounds of the LRU of rendered responses
+cacheMaxAge = int(os.environ.get("PROVIDER_CACHE_MAX_AGE", "0"))
+responseCacheEntries = int(os.environ.get("PROVIDER_RESPONSE_CACHE_ENTRIES", "1024"))
+responseCacheBytes = int(os.environ.get("PROVIDER_RESPONSE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# /stats group-bys and filtered facets run on a columnar snapshot of the
+# store, rebuilt after a change once it is older than this many seconds
+statsSnapshotAge = float(os.environ.get("PROVIDER_STATS_SNAPSHOT_AGE", "1.0"))
+
+# keep providers column-encoded in memory (see records.py), for datasets
+# where per-worker memory is the limit. Reads decode a dict per provider.
+# Has no effect with a binary snapshot, which already decodes on demand.
+compactRecords = os.environ.get("PROVIDER_COMPACT_RECORDS", "0") == "1"
+
+# format of the JSON backends' snapshot: "json" (data.json) or "binary"
+# (data.snap, memory-mapped for instant startup, see snapshot.py)
+snapshotFormat = os.environ.get("PROVIDER_SNAPSHOT_FORMAT", "json")
+
+# events kept by the change feed (/changes): a subscriber further behind
+# than this has to start over from /export. `changeFeedWait` caps how long
+# a /changes long poll waits for the next event.
+changeFeedSize = int(os.environ.get("PROVIDER_CHANGE_FEED_SIZE", "10000"))
+changeFeedWait = float(os.environ.get("PROVIDER_CHANGE_FEED_WAIT", "30"))
+
+# sampling profiler: with `profileSlowMs` > 0, requests slower than that
+# many milliseconds leave folded stacks (flamegraph input) in `profileDir`,
+# sampled every `profileInterval` seconds. Off by default.
+profileSlowMs = float(os.environ.get("PROVIDER_PROFILE_SLOW_MS", "0"))
+profileInterval = float(os.environ.get("PROVIDER_PROFILE_INTERVAL", "0.005"))
+profileDir = os.environ.get("PROVIDER_PROFILE_DIR", "./profiles")
+
+# reject writes that would give a provider a phone another provider
+# already has (see dedup.py), and the processes a /duplicates/report may
+# use, 0 = one per CPU
+uniquePhones = os.environ.get("PROVIDER_UNIQUE_PHONE", "1") == "1"
+dedupWorkers = int(os.environ.get("PROVIDER_DEDUP_WORKERS", "0"))
+
+# sharding: with `shards` > 0 providers are split by hash of providerID over
+# that many shard processes, each with its own files next to PROVIDER_DATA
+# (see shards.py). They listen on Unix sockets in `shardDir`. A single web
+# worker, or the prefork master, starts them itself, with several uvicorn
+# workers run `python -m app.shards`.
+shards = int(os.environ.get("PROVIDER_SHARDS", "0"))
+shardDir = os.environ.get("PROVIDER_SHARD_DIR", "./shards")
+
+# admission control (see admission.py): at most `admitActive` requests run
+# at once, each class of route also within its `admitLimits` entry. The
+# rest wait by priority (point lookups, writes, listings, full dumps) in a
+# queue of `admitQueue` for up to `admitWait` seconds, then get a 503 with
+# Retry-After: `retryAfter` seconds. `admitActive` 0 turns it off.
+admitActive = int(os.environ.get("PROVIDER_ADMIT_ACTIVE", "64"))
+admitQueue = int(os.environ.get("PROVIDER_ADMIT_QUEUE", "256"))
+admitWait = float(os.environ.get("PROVIDER_ADMIT_WAIT", "5"))
+admitLimits = os.environ.get("PROVIDER_ADMIT_LIMITS", "list=16,dump=4")
+retryAfter = int(os.environ.get("PROVIDER_RETRY_AFTER", "1"))
+
+# production launcher (see prefork.py, `python -m app.prefork`): the
+# master loads the providers once and forks WEB_CONCURRENCY workers onto
+# `host`:`port`, which share them copy-on-write. Every `preforkRefresh`
+# seconds it catches up on the workers' writes, and once they have made
+# `preforkRollChanges` of them, or the log reached `compactThreshold`, it
+# compacts and restarts the workers one by one from its fresh copy. A
+# worker stopping gets `gracefulTimeout` seconds to finish its requests.
+# `prefork` is set by the launcher for the app it imports.
+prefork = os.environ.get("PROVIDER_PREFORK", "0") == "1"
+host = os.environ.get("PROVIDER_HOST", "127.0.0.1")
+port = int(os.environ.get("PORT", "8000"))
+preforkRefresh = float(os.environ.get("PROVIDER_PREFORK_REFRESH", "30"))
+preforkRollChanges = int(os.environ.get("PROVIDER_PREFORK_ROLL_CHANGES", "10000"))
+gracefulTimeout = float(os.environ.get("PROVIDER_GRACEFUL_TIMEOUT", "30"))
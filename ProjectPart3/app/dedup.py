@@ -0,0 +1,215 @@
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+from .metrics import timed
+
+
+#*--------------------------*#
+#*    DUPLICATE DETECTION   *#
+#*--------------------------*#
+
+# Two keys are kept in ProviderIndex for every provider (see index.py):
+#
+#   phone      normalised phone number. Unique: a write may not give a
+#              provider a phone another provider already has (phoneClaims)
+#   identity   blocking key of normalised name + organization + address
+#              tokens. Providers sharing it are flagged as likely
+#              duplicates when one of them is written, but not rejected
+#
+# Normalising drops case, punctuation, honorifics and word order, so
+# "Dr. Cooper, John" at "Town 2, 5 Street" matches "John Cooper" at
+# "Street 5, Town 2".
+#
+# duplicateReport() goes over the whole dataset without comparing every
+# pair. Providers are grouped into blocks by looser keys (phone, identity,
+# and name + city), and only providers within the same block are compared,
+# each against the next `window` in its block. Blocks are scored in
+# parallel worker processes, and pairs scoring at least `threshold` are
+# merged into groups.
+
+wordPattern = re.compile(r"\w+")
+honorifics = {"dr", "mr", "mrs", "ms", "miss", "prof", "sri", "smt", "shri"}
+
+
+def words(value) -> list:
+    return wordPattern.findall(value.casefold()) if isinstance(value, str) else []
+
+
+# digits only, without a leading 0 or +91 in front of ten digits. None when
+# there are no digits.
+def normalizePhone(phone):
+    digits = "".join(re.findall(r"\d", phone if isinstance(phone, str) else str(phone or "")))
+    if len(digits) == 11 and digits.startswith("0") or len(digits) == 12 and digits.startswith("91"):
+        digits = digits[-10:]
+    return digits or None
+
+
+def nameKey(name) -> str:
+    return " ".join(sorted(word for word in words(name) if word not in honorifics))
+
+
+# the comma-separated parts of an address, each as its sorted words, so
+# "Town 2, 1 Street" has the parts of "Street 1, Town 2" but not those of
+# "Street 2, Town 1"
+def addressParts(address) -> frozenset:
+    if not isinstance(address, str):
+        return frozenset()
+    return frozenset(part for part in (" ".join(sorted(words(part))) for part in address.split(",")) if part)
+
+
+def identityKey(provider:dict):
+    name = nameKey(provider.get("name"))
+    if not name:
+        return None
+    return "%s|%s|%s" % (name, " ".join(words(provider.get("organization"))), ",".join(sorted(addressParts(provider.get("address")))))
+
+
+# [False or True per op]: would the op give a provider a phone that another
+# one holds? `holders(phone)` gives the providerIDs holding it now. A
+# provider may keep a phone it already has, even one it shares from before
+# phones were unique. Earlier ops of the batch count as they would leave
+# things: a phone they claim is held, one they delete or change away from
+# is free again.
+def phoneClaims(ops, holders) -> list:
+    # phone per provider as the earlier ops left it, None for none, and
+    # the providers the earlier ops gave each phone to
+    phoneOf = {}
+    claimants = {}
+
+    def move(providerID, phone):
+        claimants.get(phoneOf.get(providerID), set()).discard(providerID)
+        phoneOf[providerID] = phone
+        if phone is not None:
+            claimants.setdefault(phone, set()).add(providerID)
+
+    taken = []
+    for op, providerID, fields in ops:
+        if op == "delete":
+            move(providerID, None)
+            taken.append(False)
+            continue
+        if not fields or "phone" not in fields:
+            taken.append(False)
+            continue
+        phone = normalizePhone(fields["phone"])
+        isTaken = False
+        if phone is not None:
+            owners = holders(phone)
+            claimedInBatch = bool(claimants.get(phone, set()) - {providerID})
+            heldByOther = any(holder != providerID and phoneOf.get(holder, phone) == phone for holder in owners)
+            isTaken = claimedInBatch or (heldByOther and providerID not in owners)
+        if not isTaken:
+            move(providerID, phone)
+        taken.append(isTaken)
+    return taken
+
+
+#*--------------------------*#
+#*     DEDUP REPORT         *#
+#*--------------------------*#
+
+# what a provider is compared by: (providerID, name, organization, address parts, phone)
+def features(provider:dict) -> tuple:
+    return (provider["providerID"], nameKey(provider.get("name")), " ".join(words(provider.get("organization"))),
+            addressParts(provider.get("address")), normalizePhone(provider.get("phone")))
+
+
+# the keys a provider is blocked under, looser than identityKey so that
+# misspelt names still meet their duplicates
+def blockingKeys(provider:dict, entry:tuple):
+    _, name, _, _, phone = entry
+    if phone:
+        yield "phone", phone
+    identity = identityKey(provider)
+    if identity:
+        yield "identity", identity
+    city = (provider.get("addressParts") or {}).get("city") or provider.get("location")
+    if name:
+        yield "name", "%s|%s" % (name, str(city or "").casefold())
+
+
+# 0..1, weighted name, address and organization similarity
+def similarity(a:tuple, b:tuple) -> float:
+    name = SequenceMatcher(None, a[1], b[1]).ratio() if a[1] != b[1] else 1.0
+    union = a[3] | b[3]
+    address = len(a[3] & b[3]) / len(union) if union else 0.0
+    return round(0.4 * name + 0.4 * address + 0.2 * (a[2] == b[2]), 3)
+
+
+# [(providerID, providerID, score, reason)] of the pairs within `blocks`
+# scoring at least `threshold`. Runs in a worker process.
+def scoreBlocks(blocks, threshold, window) -> list:
+    pairs = []
+    for reason, members in blocks:
+        for i, a in enumerate(members):
+            for b in members[i + 1:i + 1 + window]:
+                score = 1.0 if reason == "phone" else similarity(a, b)
+                if score >= threshold:
+                    pairs.append((a[0], b[0], score, reason))
+    return pairs
+
+
+# groups of likely duplicates among `providers`, with the pairs that joined
+# them, most similar first
+@timed("dedup.report")
+def duplicateReport(providers, workers=None, threshold=0.9, window=50, chunkSize=2000) -> dict:
+    start = time.perf_counter()
+    blocks = {}
+    count = 0
+    for provider in providers:
+        count += 1
+        entry = features(provider)
+        for key in blockingKeys(provider, entry):
+            blocks.setdefault(key, []).append(entry)
+    work = [(reason, sorted(members, key=lambda entry:(entry[1], entry[0]))) for (reason, _), members in blocks.items() if len(members) > 1]
+    compared = sum(sum(min(window, len(members) - i - 1) for i in range(len(members))) for _, members in work)
+
+    # chunks of about `chunkSize` comparisons, one task each
+    chunks, chunk, size = [], [], 0
+    for block in work:
+        chunk.append(block)
+        size += len(block[1]) * min(window, len(block[1]))
+        if size >= chunkSize:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(chunks) > 1:
+        # spawned, not forked: the server process runs threads
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(scoreBlocks, chunks, [threshold] * len(chunks), [window] * len(chunks)))
+    else:
+        results = [scoreBlocks(chunk, threshold, window) for chunk in chunks]
+
+    # best score and every reason per pair, then groups by union-find
+    best = {}
+    for pairs in results:
+        for a, b, score, reason in pairs:
+            pair = (a, b) if a < b else (b, a)
+            found = best.get(pair)
+            best[pair] = (max(score, found[0]), found[1] | {reason}) if found else (score, {reason})
+    parent = {}
+
+    def root(providerID):
+        while parent.get(providerID, providerID) != providerID:
+            # path halving
+            parent[providerID] = parent.get(parent[providerID], parent[providerID])
+            providerID = parent[providerID]
+        return providerID
+
+    for a, b in best:
+        parent[root(a)] = root(b)
+    groups = {}
+    for (a, b), (score, reasons) in best.items():
+        groups.setdefault(root(a), []).append({"providerIDs":[a, b], "score":score, "reasons":sorted(reasons)})
+    report = [{"providerIDs":sorted({providerID for pair in pairs for providerID in pair["providerIDs"]}),
+               "score":max(pair["score"] for pair in pairs),
+               "pairs":sorted(pairs, key=lambda pair:-pair["score"])} for pairs in groups.values()]
+    report.sort(key=lambda group:(-group["score"], group["providerIDs"]))
+    return {"providers":count, "blocks":len(work), "compared":compared, "workers":workers if len(chunks) > 1 else 1,
+            "seconds":round(time.perf_counter() - start, 3), "groups":report}
@@ -0,0 +1,173 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.responses import Response
+from .metrics import registry, Gauge, Counter
+from .store import etagMatches
+
+
+#*--------------------------*#
+#*        HTTP CACHING      *#
+#*--------------------------*#
+
+# Conditional GETs: every cacheable response carries an ETag, Last-Modified
+# and Cache-Control. A client that sends back a matching If-None-Match (or,
+# without it, an If-Modified-Since no older than Last-Modified) gets an
+# empty 304.
+#
+# Providers are validated by their content ETag, collection views by the
+# store's change marker, so a 304 never hides a write made in between.
+
+def httpDate(timestamp:float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def cacheControl(maxAge:int) -> str:
+    # 0: the client may keep a copy but has to revalidate it every time
+    if maxAge <= 0:
+        return "no-cache"
+    return "private, max-age=%d" % maxAge
+
+
+def notModified(headers, etag:str, lastModified:float) -> bool:
+    ifNoneMatch = headers.get("if-none-match")
+    if ifNoneMatch is not None:
+        return etagMatches(ifNoneMatch, etag)
+    ifModifiedSince = headers.get("if-modified-since")
+    if ifModifiedSince is None or lastModified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(ifModifiedSince).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have whole-second resolution
+    return int(lastModified) <= since
+
+
+def cacheHeaders(etag:str, lastModified:float, maxAge:int = 0) -> dict:
+    headers = {"ETag":etag, "Cache-Control":cacheControl(maxAge)}
+    if lastModified is not None:
+        headers["Last-Modified"] = httpDate(lastModified)
+    return headers
+
+
+# 200 with `body`, or 304 when the request already holds this version
+def conditionalResponse(request, body:bytes, mediaType:str, etag:str, lastModified:float, maxAge:int = 0) -> Response:
+    headers = cacheHeaders(etag, lastModified, maxAge)
+    if notModified(request.headers, etag, lastModified):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=mediaType, headers=headers)
+
+
+#*--------------------------*#
+#*      RESPONSE CACHE      *#
+#*--------------------------*#
+
+# LRU of encoded response bodies, bounded by entry count and total bytes.
+# Each entry remembers the version (ETag or change marker) it was rendered
+# from and is only served while that is still current, so writes from
+# other workers can never be masked. The write handlers also drop the
+# entries of the providers they touch, plus every collection view, right
+# away through invalidate().
+#
+# fetch() also coalesces misses: identical requests that arrive while a
+# body is being built wait for that build instead of starting their own,
+# so a burst of the same query costs one scan.
+collectionTag = "*"
+
+
+class ResponseCache:
+
+    def __init__(self, maxEntries=1024, maxBytes=32 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        # tag (providerID or collectionTag) -> keys of the entries built from it
+        self.tagged = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = registry.register(Counter("response_cache_hits_total", "Responses served from the response cache"))
+        self.misses = registry.register(Counter("response_cache_misses_total", "Response cache lookups that had to render"))
+        self.bytes = registry.register(Gauge("response_cache_bytes", "Bytes held by the response cache"))
+        self.coalesced = registry.register(Counter("response_cache_coalesced_total", "Misses that waited for an identical build in flight"))
+        # (key, version) -> task building that body
+        self.inflight = {}
+
+    # the cached body for `key` if it was built from `version`, else None
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses.inc()
+                return None
+            self.entries.move_to_end(key)
+            self.hits.inc()
+            return entry[1]
+
+    def put(self, key, version, body:bytes, tags=(collectionTag,)) -> bytes:
+        if len(body) > self.maxBytes:
+            return body
+        with self.lock:
+            self.removeLocked(key)
+            self.entries[key] = (version, body, tags)
+            self.size += len(body)
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                self.removeLocked(next(iter(self.entries)))
+            self.bytes.set(self.size)
+        return body
+
+    # the body for `key` at `version`: cached, or built by awaiting
+    # `build()` once however many requests ask for it meanwhile. The build
+    # runs as its own task, so a caller that goes away does not cancel it
+    # for the others; an exception reaches every caller.
+    async def fetch(self, key, version, build, tags=(collectionTag,)) -> bytes:
+        body = self.get(key, version)
+        if body is not None:
+            return body
+        flight = (key, version)
+        task = self.inflight.get(flight)
+        if task is None:
+            task = self.inflight[flight] = asyncio.ensure_future(self.build(key, version, build, tags))
+            task.add_done_callback(lambda done: self.landed(flight, done))
+        else:
+            self.coalesced.inc()
+        return await asyncio.shield(task)
+
+    async def build(self, key, version, build, tags) -> bytes:
+        return self.put(key, version, await build(), tags)
+
+    def landed(self, flight, task):
+        self.inflight.pop(flight, None)
+        # retrieved here, in case every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    # drop everything built from these providers and every collection view
+    def invalidate(self, *providerIDs):
+        with self.lock:
+            for tag in (collectionTag, *providerIDs):
+                for key in list(self.tagged.get(tag, ())):
+                    self.removeLocked(key)
+            self.bytes.set(self.size)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tagged.clear()
+            self.size = 0
+            self.bytes.set(0)
+
+    def removeLocked(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[1])
+        for tag in entry[2]:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
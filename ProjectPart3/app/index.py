@@ -0,0 +1,194 @@
+#*--------------------------*#
+#*     SECONDARY INDEXES    *#
+#*--------------------------*#
+
+# Kept in sync by ProviderStore on every put/update/delete so lookups never
+# scan the providers.
+#
+#   name                          case-folded name -> providerIDs, plus
+#                                 fuzzy/prefix search over them (search.py)
+#   qualification, speciality     each comma-separated token -> providerIDs
+#   active, department,
+#   organization, location        value -> providerIDs
+#   town, city, state             parsed address component -> providerIDs
+#                                 (see address.py)
+#   phones                        normalised phone -> providerIDs, kept
+#                                 unique by the store (see dedup.py)
+#   identities                    blocking key of name, organization and
+#                                 address -> providerIDs (see dedup.py)
+#
+# Every posting list is a dict used as an insertion-ordered set, so the
+# "first" provider with a name stays the one that was added first. Filters
+# are answered by intersecting posting lists, smallest first. The length of
+# a posting list is the facet count of its value (see facets()).
+
+from .dedup import normalizePhone, identityKey
+from .metrics import timed
+from .search import NameSearch
+
+tokenFields = ("qualification", "speciality")
+valueFields = ("active", "department", "organization", "location")
+addressIndexFields = ("town", "city", "state")
+filterFields = tokenFields + valueFields + addressIndexFields
+
+
+def foldValue(value):
+    if isinstance(value, str):
+        return value.strip().casefold()
+    return value
+
+
+# split a comma-separated field into its normalised tokens
+def splitTokens(value) -> list:
+    if not value:
+        return []
+    return [token for token in (part.strip().casefold() for part in value.split(",")) if token]
+
+
+class ProviderIndex:
+
+    def __init__(self):
+        self.names = {}
+        self.phones = {}
+        self.identities = {}
+        self.postings = {field:{} for field in filterFields}
+        # field -> key -> the value as first written, for facets
+        self.labels = {field:{} for field in filterFields}
+        self.search = NameSearch()
+
+    # (field, key, label) of everything a provider is filed under
+    def entries(self, provider:dict):
+        for field in tokenFields:
+            for token in splitTokens(provider.get(field)):
+                yield field, token, token
+        for field in valueFields:
+            value = provider.get(field)
+            yield field, foldValue(value), value
+        parts = provider.get("addressParts") or {}
+        for field in addressIndexFields:
+            if parts.get(field) is not None:
+                yield field, foldValue(parts[field]), parts[field]
+
+    def add(self, providerID, provider:dict):
+        name = foldValue(provider.get("name"))
+        if name not in self.names:
+            self.search.add(name)
+        self.names.setdefault(name, {})[providerID] = None
+        for keys, key in ((self.phones, normalizePhone(provider.get("phone"))), (self.identities, identityKey(provider))):
+            if key is not None:
+                keys.setdefault(key, {})[providerID] = None
+        for field, key, label in self.entries(provider):
+            self.postings[field].setdefault(key, {})[providerID] = None
+            self.labels[field].setdefault(key, label)
+
+    def remove(self, providerID, provider:dict):
+        name = foldValue(provider.get("name"))
+        discard(self.names, name, providerID)
+        if name not in self.names:
+            self.search.remove(name)
+        discard(self.phones, normalizePhone(provider.get("phone")), providerID)
+        discard(self.identities, identityKey(provider), providerID)
+        for field, key, _ in self.entries(provider):
+            discard(self.postings[field], key, providerID)
+            if key not in self.postings[field]:
+                self.labels[field].pop(key, None)
+
+    def replace(self, providerID, old:dict, new:dict):
+        if old is not None:
+            self.remove(providerID, old)
+        if new is not None:
+            self.add(providerID, new)
+
+    def byName(self, name) -> list:
+        return list(self.names.get(foldValue(name), ()))
+
+    # other providers with the phone or identity key of `provider`, phone
+    # matches first
+    def duplicates(self, providerID, provider:dict) -> list:
+        found = {}
+        for keys, key in ((self.phones, normalizePhone(provider.get("phone"))), (self.identities, identityKey(provider))):
+            found.update(keys.get(key, {}))
+        found.pop(providerID, None)
+        return list(found)
+
+    # providerIDs matching every filter. Token fields accept a comma-separated
+    # list and require all of its tokens.
+    @timed("index.query")
+    def query(self, name=None, **filters) -> list:
+        lists = self.postingLists(name, **filters)
+        if not lists:
+            return []
+        first, rest = lists[0], lists[1:]
+        if not rest:
+            return list(first)
+        # intersect as sets, then keep the order of the smallest list
+        common = self.intersect(lists)
+        return [providerID for providerID in first if providerID in common]
+
+    # the providerIDs query() would return as a set, in no particular order
+    @timed("index.matching")
+    def matching(self, name=None, **filters) -> set:
+        lists = self.postingLists(name, **filters)
+        if not lists:
+            return set()
+        if len(lists) == 1:
+            return set(lists[0])
+        return self.intersect(lists)
+
+    # how many providers query() would return, without building the list
+    @timed("index.count")
+    def count(self, name=None, **filters) -> int:
+        lists = self.postingLists(name, **filters)
+        if not lists:
+            return 0
+        if len(lists) == 1:
+            return len(lists[0])
+        return len(self.intersect(lists))
+
+    # set of the providerIDs in every one of `lists`, sorted smallest first.
+    # A keys view & set walks whichever side is smaller.
+    def intersect(self, lists) -> set:
+        common = lists[0].keys() & lists[1].keys()
+        for other in lists[2:]:
+            common = other.keys() & common
+        return common
+
+    # {value: providers with it} of one field, read off the posting lists
+    @timed("index.facets")
+    def facets(self, field) -> dict:
+        labels = self.labels[field]
+        return {facetLabel(labels[key]):len(ids) for key, ids in self.postings[field].items()}
+
+    # the posting list of every filter, smallest first
+    def postingLists(self, name=None, **filters) -> list:
+        lists = []
+        if name is not None:
+            lists.append(self.names.get(foldValue(name), {}))
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if field in tokenFields:
+                tokens = splitTokens(value)
+                lists.extend(self.postings[field].get(token, {}) for token in tokens)
+            else:
+                lists.append(self.postings[field].get(foldValue(value), {}))
+        lists.sort(key=len)
+        return lists
+
+
+# facet values are JSON object keys
+def facetLabel(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def discard(postings:dict, key, providerID):
+    ids = postings.get(key)
+    if ids is None:
+        return
+    ids.pop(providerID, None)
+    if not ids:
+        del postings[key]
@@ -0,0 +1,180 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from .metrics import registry, Gauge, Histogram, latencyBuckets, sizeBuckets
+
+log = logging.getLogger(__name__)
+
+
+#*--------------------------*#
+#*     REQUEST METRICS      *#
+#*--------------------------*#
+
+# ASGI middleware around the whole app. Per route template (not raw path,
+# so /?providerID=... is one series), method and status it records
+#
+#   http_request_duration_seconds     until the last body byte was sent
+#   http_request_size_bytes           request body
+#   http_response_size_bytes          response body
+#
+# and the number of requests in flight. Requests that match no route are
+# labelled "unmatched". Streams (/changes/stream, ...) count for as long as
+# they stay open.
+
+requestSeconds = registry.register(Histogram("http_request_duration_seconds", "Request latency", latencyBuckets, ("route", "method", "status")))
+requestBytes = registry.register(Histogram("http_request_size_bytes", "Request body size", sizeBuckets, ("route", "method")))
+responseBytes = registry.register(Histogram("http_response_size_bytes", "Response body size", sizeBuckets, ("route", "method")))
+inFlight = registry.register(Gauge("http_requests_in_flight", "Requests being handled"))
+
+
+class RequestMetrics:
+
+    def __init__(self, app, router, profiler=None):
+        self.app = app
+        self.router = router
+        self.profiler = profiler
+        self.paths = None
+
+    # route template of what the router matched
+    def routeOf(self, scope) -> str:
+        if self.paths is None:
+            self.paths = {getattr(route, "endpoint", None) or route.app:route.path for route in self.router.routes}
+        return self.paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+        received = sent = 0
+
+        async def receiveCounted():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def sendCounted(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            else:
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        inFlight.inc()
+        if self.profiler is not None:
+            self.profiler.begin()
+        try:
+            await self.app(scope, receiveCounted, sendCounted)
+        finally:
+            inFlight.dec()
+            elapsed = time.perf_counter() - start
+            route, method = self.routeOf(scope), scope["method"]
+            requestSeconds.observe(elapsed, route, method, status)
+            requestBytes.observe(received, route, method)
+            responseBytes.observe(sent, route, method)
+            if self.profiler is not None:
+                self.profiler.end(elapsed, route, method)
+
+
+#*--------------------------*#
+#*    SAMPLING PROFILER     *#
+#*--------------------------*#
+
+# Opt-in (PROVIDER_PROFILE_SLOW_MS). While requests are in flight a thread
+# samples the stack of every other thread each `interval` seconds. When a
+# request took at least `threshold` seconds, the samples taken during it
+# are written to `directory` as folded stacks, one "thread;frame;...;frame
+# count" line per distinct stack, ready for flamegraph.pl or speedscope.
+#
+# Samples are not tied to a request: concurrent requests show up in each
+# other's profiles, and threads parked in a wait are left out.
+
+# leaf frames of idle threads
+idleFrames = {"threading.py:wait", "selectors.py:select", "thread.py:_worker", "queue.py:get"}
+
+
+class SamplingProfiler:
+
+    def __init__(self, threshold:float, interval=0.005, directory="profiles", keep=100, window=60.0):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self.keep = keep
+        self.window = window
+        # (monotonic time, folded stack)
+        self.samples = deque()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        if self.thread is None:
+            self.stopping = False
+            os.makedirs(self.directory, exist_ok=True)
+            self.thread = threading.Thread(target=self.run, name="provider-profiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping = True
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping:
+            time.sleep(self.interval)
+            if self.active:
+                self.sample(me)
+
+    def sample(self, me):
+        now = time.monotonic()
+        names = {thread.ident:thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            if not frames or frames[0] in idleFrames:
+                continue
+            frames.append(names.get(ident, "thread-%d" % ident))
+            stacks.append(";".join(reversed(frames)))
+        with self.lock:
+            self.samples.extend((now, stack) for stack in stacks)
+            while self.samples and self.samples[0][0] < now - self.window:
+                self.samples.popleft()
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+
+    def end(self, elapsed, route, method):
+        with self.lock:
+            self.active -= 1
+            if elapsed < self.threshold:
+                return
+            since = time.monotonic() - elapsed
+            stacks = Counter(stack for at, stack in self.samples if at >= since)
+        if stacks:
+            # off the event loop
+            threading.Thread(target=self.dump, args=(stacks, elapsed, route, method), daemon=True).start()
+
+    def dump(self, stacks, elapsed, route, method):
+        name = "%d-%s%s-%dms.folded" % (time.time() * 1000, method, route.replace("/", "_") or "_", elapsed * 1000)
+        try:
+            with open(os.path.join(self.directory, name), "w") as pf:
+                pf.writelines("%s %d\n" % (stack, count) for stack, count in stacks.most_common())
+            profiles = sorted(entry for entry in os.listdir(self.directory) if entry.endswith(".folded"))
+            for old in profiles[:-self.keep]:
+                os.remove(os.path.join(self.directory, old))
+        except OSError:
+            log.exception("could not write profile %s", name)
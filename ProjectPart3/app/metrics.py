@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+
+#*--------------------------*#
+#*          METRICS         *#
+#*--------------------------*#
+
+# Minimal Prometheus-style registry: collectors render themselves in the
+# text exposition format and /metrics concatenates them.
+
+class Registry:
+
+    def __init__(self):
+        self.collectors = []
+
+    def register(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        return "".join(collector.render() for collector in self.collectors)
+
+
+class Gauge:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self) -> str:
+        return "# HELP %s %s\n# TYPE %s gauge\n%s %r\n" % (self.name, self.help, self.name, self.name, float(self.value))
+
+
+class Counter(Gauge):
+
+    def render(self) -> str:
+        return "# HELP %s %s\n# TYPE %s counter\n%s %r\n" % (self.name, self.help, self.name, self.name, float(self.value))
+
+
+def labelText(names, values) -> str:
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in zip(names, values))
+
+
+# Observations counted into `buckets` (upper bounds), one series per
+# combination of label values
+class Histogram:
+
+    def __init__(self, name, help, buckets, labelNames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelNames = tuple(labelNames)
+        # label values -> [count per bucket, then +Inf], and their sum
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def render(self) -> str:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.items())
+        for labels, counts, total in series:
+            prefix = labelText(self.labelNames, labels)
+            prefix += "," if prefix else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, "+Inf" if bound == float("inf") else repr(float(bound)), cumulative))
+            labelled = "{%s}" % prefix.rstrip(",") if prefix else ""
+            lines.append("%s_sum%s %r" % (self.name, labelled, total))
+            lines.append("%s_count%s %d" % (self.name, labelled, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+latencyBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+sizeBuckets = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+#*--------------------------*#
+#*       TIMING SPANS       *#
+#*--------------------------*#
+
+# Time spent in storage, index and template code, one series per span name.
+# A span costs two clock reads and an uncontended lock.
+
+spanSeconds = registry.register(Histogram("span_duration_seconds", "Time spent in instrumented storage, index and template code", latencyBuckets, ("span",)))
+
+
+class span:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spanSeconds.observe(time.perf_counter() - self.start, self.name)
+
+
+# decorator form of span
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                spanSeconds.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorate
+
+
+# Event-loop lag: a task asks to sleep `interval` seconds and records how
+# much later than that it actually woke up. Anything blocking the loop
+# shows up directly as lag. `max` is the worst lag since the last scrape.
+class LoopLagMonitor:
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.task = None
+        self.lag = registry.register(Gauge("event_loop_lag_seconds", "Delay of the last event-loop wakeup"))
+        self.maxLag = registry.register(Gauge("event_loop_lag_max_seconds", "Worst event-loop wakeup delay since the last scrape"))
+
+    async def watch(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - start - self.interval, 0.0)
+            self.lag.set(lag)
+            if lag > self.maxLag.value:
+                self.maxLag.set(lag)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.watch())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def scraped(self):
+        self.maxLag.set(self.lag.value)
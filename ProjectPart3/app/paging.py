@@ -0,0 +1,95 @@
+import base64
+import json
+from bisect import bisect_left, bisect_right
+
+#*--------------------------*#
+#*        PAGINATION        *#
+#*--------------------------*#
+
+# Listings are ordered by (sort value, providerID), which is unique, so the
+# order is stable and a page can resume right after the last entry it
+# returned. The cursor is that entry, base64-encoded. It stays valid while
+# providers are added or removed around it.
+
+sortFields = ("providerID", "name", "organization", "department", "location", "active")
+defaultLimit = 50
+maxLimit = 1000
+
+
+# None sorts before every value, strings compare case-insensitively
+def sortKey(value) -> tuple:
+    if value is None:
+        return (0, "")
+    return (1, str(value).casefold())
+
+
+def encodeCursor(entry:tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(entry).encode()).decode()
+
+
+# a cursor is compared against the sort keys, so anything but a number
+# and two strings is refused here rather than failing in bisect
+def decodeCursor(cursor:str) -> tuple:
+    try:
+        (flag, value), providerID = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if isinstance(flag, bool) or not isinstance(flag, (int, float)) or not isinstance(value, str) or not isinstance(providerID, str):
+        raise ValueError("invalid cursor")
+    return ((flag, value), providerID)
+
+
+# "-name" -> ("name", True)
+def parseSort(sort:str) -> tuple:
+    descending = sort.startswith("-")
+    field = sort.lstrip("-")
+    if field not in sortFields:
+        raise ValueError("sort must be one of " + ", ".join(sortFields))
+    return field, descending
+
+
+# `fields` as a comma-separated string or a list of names, None for all
+def parseFields(fields):
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    elif not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated string or a list of names")
+    return [field.strip() for field in fields if field.strip()]
+
+
+# providerIDs from repeated and/or comma-separated values, first occurrence
+# order, without duplicates
+def parseIDs(values) -> list:
+    ids = {}
+    for value in values or ():
+        for providerID in value.split(","):
+            if providerID.strip():
+                ids[providerID.strip()] = None
+    return list(ids)
+
+
+# keep only `fields`, providerID is always included
+def project(provider:dict, fields) -> dict:
+    if fields is None:
+        return provider
+    return {key:provider[key] for key in ["providerID", *fields] if key in provider}
+
+
+# one page out of `entries`, a sorted list of (sortKey, providerID).
+# Returns the page entries and the cursor for the next page, or None.
+def pageOf(entries:list, limit:int, cursor:str = None, descending:bool = False) -> tuple:
+    if not 1 <= limit <= maxLimit:
+        raise ValueError("limit must be between 1 and %d" % maxLimit)
+    if descending:
+        end = bisect_left(entries, decodeCursor(cursor)) if cursor else len(entries)
+        start = max(end - limit, 0)
+        page = entries[start:end][::-1]
+        more = start > 0
+    else:
+        start = bisect_right(entries, decodeCursor(cursor)) if cursor else 0
+        page = entries[start:start + limit]
+        more = start + limit < len(entries)
+    nextCursor = encodeCursor(page[-1]) if page and more else None
+    return page, nextCursor
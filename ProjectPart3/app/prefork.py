@@ -0,0 +1,378 @@
+import argparse
+import gc
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from . import config
+from .backends import SharedJsonFileBackend
+from .store import ProviderStore
+
+log = logging.getLogger(__name__)
+
+
+#*--------------------------*#
+#*     PREFORK LAUNCHER     *#
+#*--------------------------*#
+
+# Production entry point. `python main.py` runs one reloading dev server,
+# and `uvicorn --workers N` has every worker load and index the providers
+# on its own. Here a master process loads and indexes them once, with the
+# collector off, then moves everything it allocated out of the collector's
+# reach (gc.freeze) and forks the workers. The workers serve the same
+# listening socket and share the master's copy of the providers
+# copy-on-write: a page is only copied once a worker writes to it, and the
+# collector no longer writes to every object it scans.
+#
+#     python -m app.prefork --workers 4 --port 8000
+#
+# Storage is shared between the workers as with several uvicorn workers
+# (see backends.py). Every PROVIDER_PREFORK_REFRESH seconds the master
+# catches up on what the workers wrote. Each change a worker applies
+# copies pages it used to share, so once the master has seen
+# PROVIDER_PREFORK_ROLL_CHANGES of them, or the JSON log has reached
+# PROVIDER_COMPACT_THRESHOLD, it compacts the log, freezes its fresh copy
+# and restarts the workers from it one by one. Only the master compacts:
+# a new log file makes every process reload all providers, which in a
+# worker would copy every page it shares.
+#
+# At boot the master logs its load time and, for each worker, how long it
+# took to get ready and its memory: resident, proportional (PSS, shared
+# pages split between the processes sharing them), shared and private.
+#
+#     SIGHUP    restart the workers one by one, each new worker ready
+#               before the old one gets SIGTERM
+#     SIGUSR1   log the memory of every worker
+#     SIGTERM   stop the workers gracefully, then the master
+#     SIGINT
+#
+# A worker that stops on its own is replaced. A stopping worker finishes
+# its requests for up to PROVIDER_GRACEFUL_TIMEOUT seconds before it is
+# killed. Forking needs Linux or another Unix, memory figures need
+# /proc/<pid>/smaps_rollup.
+
+# MB of memory of a process: rss, pss, shared and private. {} when unknown.
+def memoryOf(pid="self") -> dict:
+    fields = {}
+    try:
+        with open("/proc/%s/smaps_rollup" % pid) as rollup:
+            for line in rollup:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0]) / 1024
+    except OSError:
+        return {}
+    return {"rss":fields.get("Rss", 0.0), "pss":fields.get("Pss", 0.0),
+            "shared":fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+            "private":fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0)}
+
+
+def describeMemory(memory:dict) -> str:
+    if not memory:
+        return "memory unknown"
+    return "rss %(rss).1f MB, pss %(pss).1f MB, shared %(shared).1f MB, private %(private).1f MB" % memory
+
+
+# providers that differ between two loads of the store
+def changedBetween(old, new) -> int:
+    changed = sum(1 for providerID in old if providerID not in new)
+    for providerID in new:
+        if old.get(providerID) != new.get(providerID):
+            changed += 1
+    return changed
+
+
+def listen(host, port, backlog=2048) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+#*--------------------------*#
+#*          WORKER          *#
+#*--------------------------*#
+
+# write to `notify` once the server accepts requests
+def announce(server, notify):
+    while not server.started and not server.should_exit:
+        time.sleep(0.01)
+    os.write(notify, b"1" if server.started else b"0")
+    os.close(notify)
+
+
+# runs in the forked child, never returns to the master's code
+def runWorker(sock, notify):
+    import uvicorn
+    from .app import app, asyncStore
+
+    gc.enable()
+    asyncStore.afterFork()
+    server = uvicorn.Server(uvicorn.Config(app, lifespan="on", timeout_graceful_shutdown=config.gracefulTimeout))
+    threading.Thread(target=announce, args=(server, notify), name="prefork-announce", daemon=True).start()
+    server.run(sockets=[sock])
+
+
+#*--------------------------*#
+#*          MASTER          *#
+#*--------------------------*#
+
+class Master:
+
+    def __init__(self, sock, count:int, store, startTimeout=120.0):
+        self.sock = sock
+        self.count = count
+        self.store = store
+        self.startTimeout = startTimeout
+        # pid -> monotonic time it was forked
+        self.workers = {}
+        # pids sent SIGTERM on purpose, not replaced when they exit
+        self.retiring = set()
+        self.stopping = False
+        self.rollRequested = False
+        self.reportRequested = False
+        # changes the workers applied on top of what they were forked with
+        self.changes = 0
+        # signals only wake the loop, it does the work
+        self.wakeup, wakeupWrite = os.pipe()
+        os.set_blocking(self.wakeup, False)
+        os.set_blocking(wakeupWrite, False)
+        signal.set_wakeup_fd(wakeupWrite)
+        signal.signal(signal.SIGTERM, self.onStop)
+        signal.signal(signal.SIGINT, self.onStop)
+        signal.signal(signal.SIGHUP, self.onRoll)
+        signal.signal(signal.SIGUSR1, self.onReport)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def onStop(self, signum, frame):
+        self.stopping = True
+
+    def onRoll(self, signum, frame):
+        self.rollRequested = True
+
+    def onReport(self, signum, frame):
+        self.reportRequested = True
+
+    # fork a worker, its pid once it is ready or None
+    def spawn(self):
+        ready, notify = os.pipe()
+        start = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(ready)
+                signal.set_wakeup_fd(-1)
+                os.close(self.wakeup)
+                for signum in (signal.SIGHUP, signal.SIGUSR1):
+                    signal.signal(signum, signal.SIG_IGN)
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                runWorker(self.sock, notify)
+                code = 0
+            except BaseException:
+                log.exception("worker %d failed", os.getpid())
+            finally:
+                os._exit(code)
+        os.close(notify)
+        self.workers[pid] = start
+        try:
+            readable, _, _ = select.select([ready], [], [], self.startTimeout)
+            started = bool(readable) and os.read(ready, 1) == b"1"
+        finally:
+            os.close(ready)
+        if not started:
+            log.error("worker %d did not start within %.0f s", pid, self.startTimeout)
+            self.retire(pid)
+            return None
+        log.info("worker %d ready in %.2f s, %s", pid, time.monotonic() - start, describeMemory(memoryOf(pid)))
+        return pid
+
+    # SIGTERM, then SIGKILL once it has had its graceful timeout
+    def retire(self, pid):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + config.gracefulTimeout + 5
+        while pid in self.workers:
+            if time.monotonic() > deadline:
+                log.warning("worker %d did not stop in time, killing it", pid)
+                os.kill(pid, signal.SIGKILL)
+                deadline = float("inf")
+            self.reap()
+            time.sleep(0.05)
+
+    # collect exited workers, replacing those that were not retired. Only
+    # workers: shard processes are children too, and their Popen waits.
+    def reap(self):
+        for pid in list(self.workers):
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                exited, status = pid, 0
+            if not exited:
+                continue
+            started = self.workers.pop(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            log.warning("worker %d exited with status %d", pid, os.waitstatus_to_exitcode(status))
+            if not self.stopping:
+                # a worker failing right away would otherwise be forked in a loop
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+                self.spawn()
+
+    # restart the workers one at a time, each replaced by a ready new one
+    def roll(self, reason):
+        log.info("restarting %d workers (%s)", len(self.workers), reason)
+        self.rebuild()
+        for pid in list(self.workers):
+            if self.stopping:
+                return
+            if pid not in self.workers or pid in self.retiring:
+                continue
+            if self.spawn() is None:
+                log.error("restart abandoned, the old workers keep running")
+                return
+            self.retire(pid)
+        self.report()
+
+    # catch up on the workers' writes
+    def catchUp(self):
+        if not isinstance(self.store, ProviderStore):
+            # sharded: the providers live in the shard processes
+            return
+        old, epoch, version = self.store.data, self.store.epoch, self.store.version
+        self.store.refresh()
+        if self.store.epoch != epoch:
+            # reloaded, the changelog was pruned past what we had seen
+            self.store.waitIndexed()
+            self.changes += changedBetween(old, self.store.data)
+        else:
+            self.changes += self.store.version - version
+
+    # the copy the next workers are forked from: current, with the log
+    # folded into the snapshot so they start on a fresh one, and frozen
+    # again once the records it replaced are gone
+    def rebuild(self):
+        self.catchUp()
+        if isinstance(self.store, ProviderStore) and isinstance(self.store.backend, SharedJsonFileBackend):
+            self.store.backend.compact()
+        self.changes = 0
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+
+    # roll the workers once enough changes or log piled up
+    def refresh(self):
+        self.catchUp()
+        backend = getattr(self.store, "backend", None)
+        if self.changes >= config.preforkRollChanges:
+            self.roll("%d changes since the workers started" % self.changes)
+        elif isinstance(backend, SharedJsonFileBackend) and config.compactThreshold and backend.bytes >= config.compactThreshold:
+            self.roll("log at %d bytes" % backend.bytes)
+
+    def report(self):
+        total = memoryOf()
+        log.info("master %d: %s", os.getpid(), describeMemory(total))
+        for pid in sorted(self.workers):
+            memory = memoryOf(pid)
+            log.info("worker %d: %s", pid, describeMemory(memory))
+            total = {name:value + memory.get(name, 0.0) for name, value in total.items()}
+        if total:
+            log.info("%d workers and master: pss %.1f MB in total", len(self.workers), total["pss"])
+
+    def run(self):
+        start = time.monotonic()
+        for _ in range(self.count):
+            if self.spawn() is None:
+                self.stopping = True
+                break
+        if not self.stopping:
+            log.info("%d workers ready in %.2f s", len(self.workers), time.monotonic() - start)
+            self.report()
+        nextRefresh = time.monotonic() + config.preforkRefresh
+        while not self.stopping:
+            select.select([self.wakeup], [], [], max(0.0, nextRefresh - time.monotonic()))
+            try:
+                while os.read(self.wakeup, 512):
+                    pass
+            except BlockingIOError:
+                pass
+            self.reap()
+            if self.reportRequested:
+                self.reportRequested = False
+                self.report()
+            if self.rollRequested:
+                self.rollRequested = False
+                self.roll("SIGHUP")
+            if time.monotonic() >= nextRefresh:
+                self.refresh()
+                nextRefresh = time.monotonic() + config.preforkRefresh
+        self.stopAll()
+
+    def stopAll(self):
+        log.info("stopping %d workers", len(self.workers))
+        for pid in list(self.workers):
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + config.gracefulTimeout + 5
+        while self.workers:
+            if time.monotonic() > deadline:
+                for pid in self.workers:
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float("inf")
+            self.reap()
+            time.sleep(0.05)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m app.prefork")
+    parser.add_argument("--workers", type=int, default=max(1, config.workers))
+    parser.add_argument("--host", default=config.host)
+    parser.add_argument("--port", type=int, default=config.port)
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    # read by app.py as it builds the store
+    config.prefork = True
+    config.workers = args.workers
+    # no collections while loading: every one would walk the providers
+    # loaded so far, and the workers would inherit its bookkeeping writes
+    gc.disable()
+    start = time.monotonic()
+    from .app import store
+    if isinstance(store, ProviderStore):
+        store.waitIndexed()
+    # the JSON log is compacted by rebuild(), SQLite's changelog pruned here
+    store.start()
+    for thread in threading.enumerate():
+        if thread.name == "provider-indexer":
+            thread.join()
+    log.info("master %d loaded %d providers in %.2f s, %s", os.getpid(), len(store), time.monotonic() - start, describeMemory(memoryOf()))
+    gc.collect()
+    gc.freeze()
+
+    sock = listen(args.host, args.port)
+    log.info("listening on %s:%d with %d workers", args.host, args.port, args.workers)
+    try:
+        Master(sock, args.workers, store).run()
+    finally:
+        sock.close()
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
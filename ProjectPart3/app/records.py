@@ -0,0 +1,180 @@
+from array import array
+from collections.abc import MutableMapping
+from .address import addressFields
+
+
+#*--------------------------*#
+#*      COMPACT RECORDS     *#
+#*--------------------------*#
+
+# Drop-in replacement for the {providerID: provider dict} that ProviderStore
+# keeps in `data`, for datasets where per-provider memory is what limits a
+# worker. Providers are stored by column, one row each:
+#
+#   organization, department,    dictionary-encoded: a code per row in an
+#   location, qualification,     array("I"), each distinct value held once
+#   speciality, town/city/state  in the field's Categories
+#   name, phone, address,        lists of the strings themselves
+#   street
+#   active                       one bit per row in a bytearray
+#
+# Reading a provider decodes a fresh dict, so callers see the same records
+# as before. Records whose shape does not fit the columns (extra or missing
+# keys, a non-bool `active`, ...) are kept as they are in `irregular`.
+# Freed rows are reused; category values are never dropped, which is fine
+# for fields with few distinct values.
+
+categoricalFields = ("qualification", "speciality", "department", "organization", "location")
+textFields = ("name", "phone", "address")
+recordFields = ("providerID", "active", "name", "qualification", "speciality", "phone",
+                "department", "organization", "location", "address", "addressParts")
+categoricalParts = ("town", "city", "state")
+
+
+class Categories:
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+# does `provider` fit the columns
+def isRegular(providerID, provider:dict) -> bool:
+    if len(provider) != len(recordFields) or provider.get("providerID") != providerID:
+        return False
+    if not isinstance(provider.get("active"), bool):
+        return False
+    if not all(isinstance(provider.get(field), str) for field in textFields):
+        return False
+    if not all(isinstance(provider.get(field, 0), (str, type(None))) for field in categoricalFields):
+        return False
+    parts = provider.get("addressParts")
+    if not isinstance(parts, dict) or len(parts) != len(addressFields):
+        return False
+    return all(isinstance(parts.get(field, 0), (str, type(None))) for field in addressFields)
+
+
+class CompactRecords(MutableMapping):
+
+    def __init__(self):
+        # providerID -> row
+        self.rows = {}
+        self.free = []
+        self.categories = {field:Categories() for field in categoricalFields + categoricalParts}
+        self.codes = {field:array("I") for field in categoricalFields + categoricalParts}
+        # field -> the Categories' list of values, code -> value
+        self.labels = {field:categories.values for field, categories in self.categories.items()}
+        self.text = {field:[] for field in textFields + ("street",)}
+        self.active = bytearray()
+        # row -> provider dict that did not fit the columns
+        self.irregular = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __contains__(self, providerID):
+        return providerID in self.rows
+
+    def keys(self):
+        return self.rows.keys()
+
+    def get(self, providerID, default=None):
+        row = self.rows.get(providerID)
+        if row is None:
+            return default
+        return self.decode(providerID, row)
+
+    def __getitem__(self, providerID):
+        return self.decode(providerID, self.rows[providerID])
+
+    def decode(self, providerID, row) -> dict:
+        irregular = self.irregular.get(row)
+        if irregular is not None:
+            return irregular
+        labels, codes, text = self.labels, self.codes, self.text
+        return {
+            "providerID":providerID,
+            "active":bool(self.active[row >> 3] & (1 << (row & 7))),
+            "name":text["name"][row],
+            "qualification":labels["qualification"][codes["qualification"][row]],
+            "speciality":labels["speciality"][codes["speciality"][row]],
+            "phone":text["phone"][row],
+            "department":labels["department"][codes["department"][row]],
+            "organization":labels["organization"][codes["organization"][row]],
+            "location":labels["location"][codes["location"][row]],
+            "address":text["address"][row],
+            "addressParts":{"street":text["street"][row], "town":labels["town"][codes["town"][row]],
+                            "city":labels["city"][codes["city"][row]], "state":labels["state"][codes["state"][row]]},
+        }
+
+    def __setitem__(self, providerID, provider:dict):
+        row = self.rows.get(providerID)
+        if row is None:
+            row = self.rows[providerID] = self.free.pop() if self.free else self.grow()
+        if not isRegular(providerID, provider):
+            self.irregular[row] = provider
+            self.clear(row)
+            return
+        self.irregular.pop(row, None)
+        parts = provider["addressParts"]
+        for field in categoricalFields:
+            self.codes[field][row] = self.categories[field].encode(provider[field])
+        for field in categoricalParts:
+            self.codes[field][row] = self.categories[field].encode(parts[field])
+        for field in textFields:
+            self.text[field][row] = provider[field]
+        self.text["street"][row] = parts["street"]
+        if provider["active"]:
+            self.active[row >> 3] |= 1 << (row & 7)
+        else:
+            self.active[row >> 3] &= ~(1 << (row & 7)) & 0xFF
+
+    def __delitem__(self, providerID):
+        row = self.rows.pop(providerID)
+        self.irregular.pop(row, None)
+        self.clear(row)
+        self.free.append(row)
+
+    # a new row at the end of every column
+    def grow(self) -> int:
+        row = self.size
+        self.size += 1
+        for column in self.codes.values():
+            column.append(0)
+        for column in self.text.values():
+            column.append(None)
+        if row >> 3 >= len(self.active):
+            self.active.append(0)
+        return row
+
+    # let go of the strings a row refers to
+    def clear(self, row):
+        for column in self.text.values():
+            column[row] = None
+
+    # a consistent copy for writing out while the store moves on. Strings
+    # are shared and the Categories only ever grow, so copying the columns
+    # is enough.
+    def copy(self) -> "CompactRecords":
+        other = CompactRecords.__new__(CompactRecords)
+        other.rows = dict(self.rows)
+        other.free = list(self.free)
+        other.categories = self.categories
+        other.labels = self.labels
+        other.codes = {field:array("I", column) for field, column in self.codes.items()}
+        other.text = {field:list(column) for field, column in self.text.items()}
+        other.active = bytearray(self.active)
+        other.irregular = dict(self.irregular)
+        other.size = self.size
+        return other
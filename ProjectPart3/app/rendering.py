@@ -0,0 +1,126 @@
+import time
+from jinja2 import Template
+from markupsafe import Markup, escape
+from .metrics import spanSeconds
+
+
+#*--------------------------*#
+#*     SERVER-SIDE PAGES    *#
+#*--------------------------*#
+
+# Pages are rendered from the in-memory store with Jinja's generate(), so a
+# table of every provider starts reaching the client after its first few
+# bytes instead of after the last row.
+#
+# The expensive parts are cached as fragments:
+#
+#   rows       providerID -> rendered <tr>, valid while the store still holds
+#              the same record object (records are replaced, never mutated),
+#              or an equal one when compact records decode a new dict
+#   options    <option> lists of every providerID / name, valid for one
+#              change marker of the store
+#
+# Fragments are built lazily, when the template reaches them, so the page
+# head is already on its way while a cold cache is filled. Write handlers
+# drop what they touched through invalidate().
+#
+# Rendering is timed per template: render() as "template:<name>", a streamed
+# page as "stream:<name>", counting only the time spent generating it.
+
+
+# Jinja template class that times render(), see Jinja2Templates.env
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs) -> str:
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            spanSeconds.observe(time.perf_counter() - start, "template:%s" % self.name)
+
+# flush the first chunk right away, then in `chunkBytes` pieces
+def streamTemplate(template, context:dict, chunkBytes=16384):
+    buffer = []
+    size = 0
+    first = True
+    busy = 0.0
+    start = time.perf_counter()
+    for piece in template.generate(context):
+        data = piece.encode()
+        buffer.append(data)
+        size += len(data)
+        if first or size >= chunkBytes:
+            busy += time.perf_counter() - start
+            yield b"".join(buffer)
+            start = time.perf_counter()
+            buffer, size = [], 0
+            first = False
+    busy += time.perf_counter() - start
+    spanSeconds.observe(busy, "stream:%s" % template.name)
+    if buffer:
+        yield b"".join(buffer)
+
+
+# renders when Jinja outputs it, not when the context is built
+class LazyFragment:
+
+    def __init__(self, render):
+        self.render = render
+
+    def __html__(self) -> str:
+        return self.render()
+
+    def __str__(self) -> str:
+        return self.render()
+
+
+# <option> lists, by name, and the provider field each one lists
+optionFields = {"providerOptions":"providerID", "nameOptions":"name"}
+
+
+class Fragments:
+
+    def __init__(self, store, env):
+        self.store = store
+        self.rowTemplate = env.get_template("providerRow.html")
+        self.rows = {}
+        self.options = {}
+
+    def row(self, provider:dict) -> Markup:
+        providerID = provider["providerID"]
+        cached = self.rows.get(providerID)
+        if cached is not None and (cached[0] is provider or cached[0] == provider):
+            return cached[1]
+        html = Markup(self.rowTemplate.render(value=provider))
+        self.rows[providerID] = (provider, html)
+        return html
+
+    def rowsOf(self, providers):
+        for provider in providers:
+            yield self.row(provider)
+
+    # every provider as a table row in `sortField` order, read from the store
+    # a chunk at a time while the page streams
+    def allRows(self, sortField="providerID", descending=False):
+        entries = self.store.sortedEntries(sortField)
+        ids = [providerID for _, providerID in (reversed(entries) if descending else entries)]
+        yield from self.rowsOf(self.store.iterProviders(ids))
+
+    def optionList(self, name) -> Markup:
+        marker, _ = self.store.collectionState()
+        cached = self.options.get(name)
+        if cached is not None and cached[0] == marker:
+            return cached[1]
+        field = optionFields[name]
+        html = Markup("".join('<option value="%s">%s</option>\n' % (escape(value), escape(value))
+                              for value in (provider.get(field) for provider in self.store.iterProviders())))
+        self.options[name] = (marker, html)
+        return html
+
+    def lazyOptions(self, name) -> LazyFragment:
+        return LazyFragment(lambda: self.optionList(name))
+
+    def invalidate(self, *providerIDs):
+        for providerID in providerIDs:
+            self.rows.pop(providerID, None)
+        self.options.clear()
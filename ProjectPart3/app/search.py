@@ -0,0 +1,195 @@
+import heapq
+from collections import Counter
+from .metrics import timed
+
+
+#*--------------------------*#
+#*        NAME SEARCH       *#
+#*--------------------------*#
+
+# Fuzzy and prefix search over provider names, kept up to date by
+# ProviderIndex as names appear and disappear. It works on distinct
+# case-folded names; ProviderIndex.names maps them back to providerIDs.
+#
+#   trie       every word start of a name -> the names, for autocomplete
+#   words      word -> the names containing it
+#   grams      trigram -> the words containing it, for misspellings
+#
+# Misspellings are matched word by word: each query word expands to the
+# similar words of the vocabulary, which is far smaller than the set of
+# names, and a name matches when every query word found one of its words.
+#
+# A name's score decides its rank:
+#
+#   1.0        the query is the whole name
+#   0.9        the name starts with the query
+#   0.8        one of the name's later words starts with the query
+#   < 0.8      mean similarity of the query words to the name's words,
+#              times 0.8. Words sharing a trigram are compared by trigram
+#              overlap, or by edit distance when that scores higher, which
+#              catches swapped letters in short words
+#
+# so completions always rank above guesses.
+
+minSimilarity = 0.4
+# most vocabulary words a query word expands to
+maxExpansions = 16
+# most names a short prefix collects from the trie
+maxCandidates = 1000
+
+
+# same folding as the name index
+def normalise(text) -> str:
+    return str(text).strip().casefold() if text is not None else ""
+
+
+# trigrams of `word` padded so short words and word starts count too
+def trigrams(word:str) -> set:
+    padded = "  " + word + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# 1 - optimal string alignment distance / length of the longer word
+def editSimilarity(a:str, b:str) -> float:
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return 1.0 - current[-1] / max(len(a), len(b))
+
+
+# positions where a word of `text` starts
+def wordStarts(text:str) -> list:
+    return [i for i, char in enumerate(text) if char != " " and (i == 0 or text[i - 1] == " ")]
+
+
+class NameSearch:
+
+    def __init__(self):
+        # node: {char: child node, None: {name: None} of names ending here}
+        self.trie = {}
+        self.names = {}
+        self.words = {}
+        self.grams = {}
+        self.gramCount = {}
+
+    def add(self, name:str):
+        if not isinstance(name, str) or not name or name in self.names:
+            return
+        self.names[name] = None
+        for start in wordStarts(name):
+            node = self.trie
+            for char in name[start:]:
+                node = node.setdefault(char, {})
+            node.setdefault(None, {})[name] = None
+        for word in set(name.split()):
+            if word not in self.words:
+                grams = trigrams(word)
+                for gram in grams:
+                    self.grams.setdefault(gram, set()).add(word)
+                self.gramCount[word] = len(grams)
+            self.words.setdefault(word, {})[name] = None
+
+    def remove(self, name:str):
+        if name not in self.names:
+            return
+        del self.names[name]
+        for start in wordStarts(name):
+            self.removeKey(self.trie, name[start:], name)
+        for word in set(name.split()):
+            names = self.words.get(word, {})
+            names.pop(name, None)
+            if names:
+                continue
+            self.words.pop(word, None)
+            del self.gramCount[word]
+            for gram in trigrams(word):
+                words = self.grams[gram]
+                words.discard(word)
+                if not words:
+                    del self.grams[gram]
+
+    # drop `name` under `key` and prune the nodes left empty
+    def removeKey(self, node:dict, key:str, name:str) -> bool:
+        if not key:
+            ending = node.get(None, {})
+            ending.pop(name, None)
+            if not ending:
+                node.pop(None, None)
+        else:
+            child = node.get(key[0])
+            if child is not None and self.removeKey(child, key[1:], name):
+                del node[key[0]]
+        return not node
+
+    # names with a word starting with `prefix`, at most `limit`
+    def completions(self, prefix:str, limit:int = maxCandidates) -> list:
+        node = self.trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        found = {}
+        stack = [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            for name in node.get(None, ()):
+                found[name] = None
+            stack.extend(child for char, child in node.items() if char is not None)
+        return list(found)[:limit]
+
+    # {word: similarity} of the `maxExpansions` vocabulary words most like `word`
+    def similarWords(self, word:str) -> dict:
+        queryGrams = trigrams(word)
+        letters = set(word)
+        shared = Counter()
+        for gram in queryGrams:
+            shared.update(self.grams.get(gram, ()))
+        similar = {}
+        for other, count in shared.items():
+            # mean of how much of the query word `other` contains and how
+            # much the two overlap, so a partial word still matches
+            similarity = (count / len(queryGrams) + count / (len(queryGrams) + self.gramCount[other] - count)) / 2
+            if similarity < minSimilarity and abs(len(other) - len(word)) <= 2 and len(letters ^ set(other)) <= 2:
+                similarity = max(similarity, editSimilarity(word, other))
+            if similarity >= minSimilarity:
+                similar[other] = similarity
+        if len(similar) > maxExpansions:
+            similar = dict(heapq.nlargest(maxExpansions, similar.items(), key=lambda item: item[1]))
+        return similar
+
+    # {name: score} of the names matching `query`. Without `fuzzy` only the
+    # completions, which outrank every fuzzy match.
+    @timed("index.search")
+    def rank(self, query, fuzzy=True) -> dict:
+        query = normalise(query)
+        if not query:
+            return {}
+        scores = {}
+        for name in self.completions(query):
+            scores[name] = 1.0 if name == query else 0.9 if name.startswith(query) else 0.8
+        if not fuzzy:
+            return scores
+
+        expansions = [self.similarWords(word) for word in query.split()]
+        if not all(expansions):
+            return scores
+        # a candidate has a match for every query word
+        candidates = set.intersection(*(set().union(*(self.words[word] for word in similar)) for similar in expansions))
+        for name in candidates:
+            if name in scores:
+                continue
+            nameWords = name.split()
+            total = 0.0
+            for similar in expansions:
+                best = max((similar.get(word, 0.0) for word in nameWords), default=0.0)
+                if not best:
+                    break
+                total += best
+            else:
+                scores[name] = round(total / len(expansions) * 0.8, 4)
+        return scores
@@ -0,0 +1,53 @@
+import json
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+#*--------------------------*#
+#*       SERIALIZATION      *#
+#*--------------------------*#
+
+# One JSON encoder for responses, the write-ahead log and snapshots: orjson
+# when it is installed, otherwise compact stdlib json. Both produce bytes.
+
+
+# handlers return HTTPException objects inside their response bodies
+def encodeDefault(obj):
+    if isinstance(obj, HTTPException):
+        return {"status_code":obj.status_code, "detail":obj.detail, "headers":obj.headers}
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=encodeDefault)
+
+    loads = orjson.loads
+else:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':'), default=encodeDefault).encode()
+
+    loads = json.loads
+
+
+def dumpsPretty(obj) -> bytes:
+    return json.dumps(obj, indent=4, default=encodeDefault).encode()
+
+
+# response class for app-wide fast serialization, an ORJSONResponse that
+# degrades to compact stdlib json
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+# {"response": "success", "data": <already encoded provider>}
+def successBytes(encodedData:bytes) -> bytes:
+    return b'{"response":"success","data":' + encodedData + b'}'
@@ -0,0 +1,571 @@
+import argparse
+import asyncio
+import heapq
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
+from multiprocessing.connection import Client, Listener
+from . import config
+from .backends import JsonFileBackend, SqliteBackend, readData, writeData
+from .columnar import ColumnarSnapshot
+from .dedup import normalizePhone, phoneClaims
+from .paging import encodeCursor
+from .serialization import dumps, loads
+from .store import ProviderStore, phoneTaken
+
+log = logging.getLogger(__name__)
+
+
+#*--------------------------*#
+#*         SHARDING         *#
+#*--------------------------*#
+
+# With PROVIDER_SHARDS=N, providers are split over N shard processes by
+# crc32(providerID) mod N. Each shard runs its own ProviderStore with its
+# own files, e.g. data-shard0of4.json with its log and snapshot, or its own
+# SQLite database. A shard answers calls over a Unix socket in
+# PROVIDER_SHARD_DIR. Writes to different shards share no lock, log or
+# fsync, so write throughput grows with the number of shards.
+#
+# In the web app a ShardedStore stands in for the ProviderStore. A call
+# about one provider goes to its shard. Anything else is sent to every
+# shard at once and the answers are merged.
+#
+#     python -m app.shards                 run every shard until stopped
+#     python -m app.shards --index 2       run shard 2 only
+#
+# A single web worker, or the prefork master (see prefork.py), starts any
+# shard that is not running itself. On its first start a shard takes its
+# part of PROVIDER_DATA. From then on its own files are the data, so
+# changing N means an /export and a re-import.
+#
+# The sockets take pickled calls. They are only as private as their
+# directory, which is kept at mode 0700.
+
+def shardOf(providerID, count:int) -> int:
+    return zlib.crc32(providerID.encode()) % count
+
+
+# data.json -> data-shard2of4.json
+def shardFile(fileName, index:int, count:int) -> str:
+    root, ext = os.path.splitext(fileName)
+    return "%s-shard%dof%d%s" % (root, index, count, ext)
+
+
+# the socket directory, created if needed. An existing one must be ours
+# and is made private again, or anyone could reach the pickled calls.
+def socketDirectory(directory):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid():
+        raise RuntimeError("shard directory %s belongs to another user" % directory)
+    if stat.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+def socketPath(directory, index:int) -> str:
+    return os.path.join(directory, "shard-%d.sock" % index)
+
+
+# is a shard listening at `address`
+def answers(address) -> bool:
+    try:
+        with Client(address, family="AF_UNIX") as conn:
+            conn.send(("ping", (), {}))
+            return conn.recv()[0]
+    except (OSError, EOFError):
+        return False
+
+
+
+#*--------------------------*#
+#*       SHARD PROCESS      *#
+#*--------------------------*#
+
+# ProviderStore methods a router may call on its shard
+storeCalls = {"get", "etag", "encoded", "collectionState", "changeMarker", "findByName", "query", "matching", "count",
+              "facets", "sortedEntries", "pageEntries", "searchEntries", "duplicatesOf", "phoneHolders", "check", "create", "put", "update", "delete", "mutate"}
+
+
+class ShardService:
+
+    def __init__(self, store:ProviderStore):
+        self.store = store
+
+    def ping(self):
+        return os.getpid()
+
+    def contains(self, providerID) -> bool:
+        return providerID in self.store
+
+    def size(self) -> int:
+        return len(self.store)
+
+    def keys(self) -> list:
+        return list(self.store.keys())
+
+    # ProviderStore.fetch and deletedSince, with `since` as this shard's
+    # change marker
+    def fetch(self, ids, since=None, encoded=False) -> list:
+        return self.store.fetch(ids, self.store.versionOf(since), encoded)
+
+    def deletedSince(self, since=None, encoded=False) -> list:
+        return self.store.deletedSince(self.store.versionOf(since), encoded)
+
+    def feedMarker(self) -> str:
+        return self.store.changes.marker()
+
+    def feedSince(self, marker, limit:int):
+        return self.store.changes.since(marker, limit)
+
+    def handle(self, method, args, kwargs):
+        if method in storeCalls:
+            return getattr(self.store, method)(*args, **kwargs)
+        if method in ("ping", "contains", "size", "keys", "fetch", "deletedSince", "feedMarker", "feedSince"):
+            return getattr(self, method)(*args, **kwargs)
+        raise AttributeError("shards have no call %r" % method)
+
+    # answer one router connection until it closes
+    def serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = (True, self.handle(method, args, kwargs))
+                except Exception as e:
+                    reply = (False, e)
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+                except Exception as e:
+                    # an exception that does not pickle
+                    conn.send((False, RuntimeError(repr(e))))
+
+
+# the store of shard `index`, cutting its part out of PROVIDER_DATA the
+# first time
+def openShardStore(index:int, count:int) -> ProviderStore:
+    jsonFileName = shardFile(config.jsonFileName, index, count)
+    sqliteFileName = shardFile(config.sqliteFileName, index, count)
+    ownFiles = (jsonFileName, os.path.splitext(jsonFileName)[0] + ".snap", sqliteFileName)
+    if not any(os.path.exists(fileName) for fileName in ownFiles):
+        data = readData(config.jsonFileName) if os.path.exists(config.jsonFileName) else {}
+        part = {providerID:provider for providerID, provider in data.items() if shardOf(providerID, count) == index}
+        writeData(part, jsonFileName)
+        log.info("shard %d of %d took %d of %d providers from %s", index, count, len(part), len(data), config.jsonFileName)
+    if config.storageBackend == "sqlite":
+        backend = SqliteBackend(sqliteFileName, config.poolSize, config.syncCommit, importFrom=jsonFileName)
+    else:
+        backend = JsonFileBackend(jsonFileName, config.commitInterval, config.syncCommit, config.compactInterval, config.compactThreshold, config.prettyJSON, config.snapshotFormat == "binary")
+    return ProviderStore(backend, 0.0, config.compactRecords, config.changeFeedSize, config.uniquePhones)
+
+
+def stopProcess(signum, frame):
+    raise SystemExit(0)
+
+
+def runShard(index:int, count:int, directory):
+    socketDirectory(directory)
+    address = socketPath(directory, index)
+    if answers(address):
+        raise SystemExit("shard %d is already running at %s" % (index, address))
+    if os.path.exists(address):
+        os.remove(address)
+    store = openShardStore(index, count)
+    store.start()
+    service = ShardService(store)
+    listener = Listener(address, family="AF_UNIX")
+    signal.signal(signal.SIGTERM, stopProcess)
+    log.info("shard %d of %d serving %d providers at %s", index, count, len(store), address)
+    try:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=service.serve, args=(conn,), name="shard-connection", daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        store.close()
+
+
+def startShard(index:int) -> subprocess.Popen:
+    packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (packageRoot, os.environ.get("PYTHONPATH")))))
+    return subprocess.Popen([sys.executable, "-m", "app.shards", "--index", str(index)], env=env)
+
+
+def stopShards(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        process.wait()
+
+
+# every shard in a child process, until one of them exits or we are stopped
+def runAll(count:int):
+    processes = [startShard(index) for index in range(count)]
+    signal.signal(signal.SIGTERM, stopProcess)
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopShards(processes)
+
+
+
+#*--------------------------*#
+#*       SHARDED STORE      *#
+#*--------------------------*#
+
+# connections to one shard, each carrying one call at a time
+class ShardClient:
+
+    def __init__(self, address):
+        self.address = address
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = Client(self.address, family="AF_UNIX")
+        try:
+            conn.send((method, args, kwargs))
+            ok, result = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+        with self.lock:
+            self.idle.append(conn)
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+# The change feeds of every shard as one. A marker is the shards' markers
+# joined with "_", and each event carries the marker that resumes after it.
+# Events from different shards are interleaved by time. Nothing tells the
+# web worker about shard writes, so waiting is polling (see changesAfter).
+class ShardedChanges:
+
+    def __init__(self, store):
+        self.store = store
+
+    def marker(self) -> str:
+        return "_".join(self.store.scatter("feedMarker"))
+
+    def since(self, marker, limit:int):
+        parts = (marker or "").split("_")
+        if len(parts) != self.store.shardCount:
+            return None
+        results = self.store.gather([(shard, "feedSince", (part, limit)) for shard, part in zip(self.store.shards, parts)])
+        if any(events is None for events in results):
+            return None
+        tagged = [[(loads(blob), index, shardMarker) for shardMarker, blob in events] for index, events in enumerate(results)]
+        merged = []
+        for event, index, shardMarker in islice(heapq.merge(*tagged, key=lambda item: item[0]["at"]), limit):
+            parts[index] = shardMarker
+            event["marker"] = "_".join(parts)
+            merged.append((event["marker"], dumps(event)))
+        return merged
+
+    async def wait(self, marker, timeout:float) -> bool:
+        await asyncio.sleep(timeout)
+        return True
+
+
+# What the web app uses in place of a ProviderStore when sharded. Paged
+# listings and search ask every shard for a full page after the cursor and
+# keep the best `limit` entries, so cursors work as they do unsharded.
+# A search falls back to fuzzy matches per shard.
+class ShardedStore:
+
+    # every read is a call to another process
+    shared = True
+
+    def __init__(self, count:int, directory, spawn=False, startTimeout=600.0):
+        self.shardCount = count
+        socketDirectory(directory)
+        self.shards = [ShardClient(socketPath(directory, index)) for index in range(count)]
+        self.fanout = ThreadPoolExecutor(max_workers=4 * count, thread_name_prefix="shard-fanout")
+        self.changes = ShardedChanges(self)
+        self.snapshot = None
+        # the shards this worker started, and stops on close()
+        self.processes = []
+        if spawn:
+            self.processes = [startShard(index) for index, shard in enumerate(self.shards) if not answers(shard.address)]
+        self.waitForShards(startTimeout)
+
+    def waitForShards(self, timeout:float):
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            while not answers(shard.address):
+                if time.monotonic() > deadline or any(process.poll() is not None for process in self.processes):
+                    stopShards(self.processes)
+                    raise RuntimeError("shard at %s is not running, start the shards with python -m app.shards" % shard.address)
+                time.sleep(0.1)
+
+    def shardFor(self, providerID) -> ShardClient:
+        return self.shards[shardOf(providerID, self.shardCount)]
+
+    # [(shard, method, args)] called in parallel, results in that order
+    def gather(self, calls) -> list:
+        futures = [self.fanout.submit(shard.call, method, *args) for shard, method, args in calls]
+        return [future.result() for future in futures]
+
+    def scatter(self, method, *args, **kwargs) -> list:
+        futures = [self.fanout.submit(shard.call, method, *args, **kwargs) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    # READ
+
+    # shards are the only writers of their files, there is nothing to poll
+    def refresh(self):
+        pass
+
+    def __contains__(self, providerID):
+        return self.shardFor(providerID).call("contains", providerID)
+
+    def __len__(self):
+        return sum(self.scatter("size"))
+
+    def get(self, providerID):
+        return self.shardFor(providerID).call("get", providerID)
+
+    def etag(self, providerID):
+        return self.shardFor(providerID).call("etag", providerID)
+
+    def encoded(self, providerID):
+        return self.shardFor(providerID).call("encoded", providerID)
+
+    def keys(self) -> list:
+        return list(chain.from_iterable(self.scatter("keys")))
+
+    def findByName(self, name):
+        return next((provider for provider in self.scatter("findByName", name) if provider is not None), None)
+
+    def query(self, name=None, **filters) -> list:
+        return list(chain.from_iterable(self.scatter("query", name, **filters)))
+
+    def matching(self, name=None, **filters) -> set:
+        return set().union(*self.scatter("matching", name, **filters))
+
+    def count(self, name=None, **filters) -> int:
+        return sum(self.scatter("count", name, **filters))
+
+    def facets(self, fields) -> dict:
+        merged = {field:{} for field in fields}
+        for facets in self.scatter("facets", fields):
+            for field, counts in facets.items():
+                for value, count in counts.items():
+                    merged[field][value] = merged[field].get(value, 0) + count
+        return merged
+
+    def duplicatesOf(self, providerID, provider=None) -> list:
+        provider = provider or self.get(providerID)
+        if provider is None:
+            return []
+        return list(dict.fromkeys(chain.from_iterable(self.scatter("duplicatesOf", providerID, provider))))
+
+    def phoneHolders(self, phones) -> dict:
+        merged = {phone:[] for phone in phones}
+        for holders in self.scatter("phoneHolders", phones):
+            for phone, ids in holders.items():
+                merged[phone].extend(ids)
+        return merged
+
+    def columnar(self, maxAge=0.0) -> ColumnarSnapshot:
+        marker = self.changeMarker()
+        snapshot = self.snapshot
+        if snapshot is None or (snapshot.marker != marker and time.monotonic() - snapshot.builtAt >= maxAge):
+            snapshot = self.snapshot = ColumnarSnapshot(marker, self.iterProviders())
+        return snapshot
+
+    def sortedEntries(self, sortField) -> list:
+        return list(heapq.merge(*self.scatter("sortedEntries", sortField)))
+
+    # the first `limit` of every shard's page, and a cursor after the last
+    def mergePages(self, pages, limit, descending=False) -> tuple:
+        merged = sorted(chain.from_iterable(page for page, _ in pages), key=itemgetter(0), reverse=descending)
+        more = len(merged) > limit or any(nextCursor for _, nextCursor in pages)
+        page = merged[:limit]
+        return [item for _, item in page], encodeCursor(page[-1][0]) if page and more else None
+
+    def page(self, limit, cursor=None, sortField="providerID", descending=False, fields=None) -> tuple:
+        return self.mergePages(self.scatter("pageEntries", limit, cursor, sortField, descending, fields), limit, descending)
+
+    def search(self, query, limit, cursor=None, fields=None) -> tuple:
+        return self.mergePages(self.scatter("searchEntries", query, limit, cursor, fields), limit)
+
+    # the shards' markers joined, see ShardedChanges
+    def changeMarker(self) -> str:
+        return "_".join(self.scatter("changeMarker"))
+
+    def collectionState(self) -> tuple:
+        states = self.scatter("collectionState")
+        return "_".join(marker for marker, _ in states), max(modified for _, modified in states)
+
+    # not a version but the shards' markers, which iterProviders() hands
+    # each shard as its `since`. Anything else means everything.
+    def versionOf(self, marker):
+        parts = (marker or "").split("_")
+        return parts if len(parts) == self.shardCount else None
+
+    def iterProviders(self, ids=None, since=None, chunkSize=500, encoded=False):
+        sinceOf = since or [None] * self.shardCount
+        if ids is None:
+            for shard, shardSince in zip(self.shards, sinceOf):
+                shardIDs = shard.call("keys")
+                for start in range(0, len(shardIDs), chunkSize):
+                    for provider in shard.call("fetch", shardIDs[start:start + chunkSize], shardSince, encoded):
+                        if provider is not None:
+                            yield provider
+            return
+        ids = list(ids)
+        for start in range(0, len(ids), chunkSize):
+            for provider in self.fetch(ids[start:start + chunkSize], since, encoded):
+                if provider is not None:
+                    yield provider
+
+    # ProviderStore.fetch, one call per shard involved
+    def fetch(self, ids, since=None, encoded=False) -> list:
+        sinceOf = since or [None] * self.shardCount
+        groups = {}
+        for providerID in ids:
+            groups.setdefault(shardOf(providerID, self.shardCount), []).append(providerID)
+        found = {}
+        for group, providers in zip(groups.values(), self.gather([(self.shards[index], "fetch", (group, sinceOf[index], encoded)) for index, group in groups.items()])):
+            found.update(zip(group, providers))
+        return [found.get(providerID) for providerID in ids]
+
+    def deletedSince(self, since=None, encoded=False) -> list:
+        if since is None:
+            return []
+        return list(chain.from_iterable(self.gather([(shard, "deletedSince", (shardSince, encoded)) for shard, shardSince in zip(self.shards, since)])))
+
+    # WRITE
+
+    # through mutate(), for the phone check across shards
+
+    def create(self, providerID, provider:dict):
+        return self.mutate([("create", providerID, provider)])[0]
+
+    def put(self, providerID, provider:dict):
+        return self.mutate([("put", providerID, provider)])[0]
+
+    def update(self, providerID, fields:dict, ifMatch=None):
+        return self.mutate([("update", providerID, fields)], ifMatch={providerID:ifMatch} if ifMatch else None)[0]
+
+    def delete(self, providerID, ifMatch=None):
+        return self.shardFor(providerID).call("delete", providerID, ifMatch)
+
+    # ProviderStore.mutate. Each shard keeps phones unique among its own
+    # providers, so the phones the ops set are first looked up on every
+    # shard. Like the check below, that cannot stop a write racing in
+    # between.
+    def mutate(self, ops:list, partial=False, ifMatch=None) -> list:
+        phones = {normalizePhone(fields["phone"]) for op, _, fields in ops if op != "delete" and fields and "phone" in fields} - {None}
+        if not config.uniquePhones or not phones or self.shardCount == 1:
+            return self.mutateShards(ops, partial, ifMatch)
+        holders = self.phoneHolders(list(phones))
+        taken = phoneClaims(ops, lambda phone: holders.get(phone, ()))
+        errors = [phoneTaken if phoneTakenByOther else None for phoneTakenByOther in taken]
+        if not any(taken):
+            return self.mutateShards(ops, partial, ifMatch)
+        if not partial:
+            return errors
+        rest = [position for position, error in enumerate(errors) if error is None]
+        for position, error in zip(rest, self.mutateShards([ops[position] for position in rest], partial, ifMatch)):
+            errors[position] = error
+        return errors
+
+    # ProviderStore.mutate over the shards the ops belong to. All-or-nothing
+    # holds within each shard. A batch spanning shards is checked on all of
+    # them before any applies it, so a batch that would fail is applied
+    # nowhere, but a write racing in between the check and the apply can
+    # still leave it applied on some shards only.
+    def mutateShards(self, ops:list, partial=False, ifMatch=None) -> list:
+        groups = {}
+        for position, (_, providerID, _) in enumerate(ops):
+            groups.setdefault(shardOf(providerID, self.shardCount), []).append(position)
+        ifMatch = ifMatch or {}
+
+        def calls(method, *extra):
+            return [(self.shards[index], method, ([ops[position] for position in positions], *extra,
+                     {providerID:etag for providerID, etag in ifMatch.items() if shardOf(providerID, self.shardCount) == index}))
+                    for index, positions in groups.items()]
+
+        errors = [None] * len(ops)
+
+        def collect(results):
+            for positions, shardErrors in zip(groups.values(), results):
+                for position, error in zip(positions, shardErrors):
+                    errors[position] = error
+
+        if len(groups) > 1 and not partial:
+            collect(self.gather(calls("check")))
+            if any(errors):
+                return errors
+        collect(self.gather(calls("mutate", partial)))
+        return errors
+
+    # LIFECYCLE
+
+    def start(self):
+        pass
+
+    # in a forked worker: its own connections and fan-out threads, and the
+    # shard processes stay with the parent that started them
+    def afterFork(self):
+        for shard in self.shards:
+            shard.lock = threading.Lock()
+            shard.close()
+        self.fanout = ThreadPoolExecutor(max_workers=4 * self.shardCount, thread_name_prefix="shard-fanout")
+        self.processes = []
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.fanout.shutdown(wait=True)
+        stopShards(self.processes)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m app.shards")
+    parser.add_argument("--index", type=int, help="run this shard only")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    if config.shards < 1:
+        print("set PROVIDER_SHARDS to the number of shards")
+        return 2
+    if args.index is None:
+        runAll(config.shards)
+    else:
+        runShard(args.index, config.shards, config.shardDir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
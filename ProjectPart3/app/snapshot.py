@@ -0,0 +1,259 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import MutableMapping
+from .address import withAddress
+from .metrics import timed
+from .serialization import dumps, loads
+
+
+#*--------------------------*#
+#*      BINARY SNAPSHOT     *#
+#*--------------------------*#
+
+# data.snap, the binary counterpart of data.json. It is memory-mapped rather
+# than read, so opening it costs the same at any size, workers mapping the
+# same file share its pages, and a provider is only decoded when it is first
+# asked for. Layout, little-endian:
+#
+#   header     magic, provider count, hash table size
+#   entries    per provider in file order: offset, key length, record length
+#   table      open-addressing hash table of entry number + 1 (0 = empty),
+#              slot crc32(providerID) modulo the table size, linear probing
+#   records    per provider: its providerID, then its record as JSON
+#
+# The file is written once and never changed. SnapshotRecords layers the
+# changes made since on top of it and is what ProviderStore keeps in `data`.
+#
+#     python -m app.snapshot to-binary data.json data.snap
+#     python -m app.snapshot to-json data.snap data.json
+
+snapshotMagic = b"PROVSNP1"
+headerFormat = struct.Struct("<8sQQ")
+entryFormat = struct.Struct("<QII")
+slotFormat = struct.Struct("<I")
+
+
+# a power of two with at least twice as many slots as providers
+def tableSizeFor(count:int) -> int:
+    size = 8
+    while size < 2 * count:
+        size *= 2
+    return size
+
+
+# (providerID, JSON bytes) of every provider in `data`
+def encodedItems(data):
+    if hasattr(data, "encodedItems"):
+        return data.encodedItems()
+    return ((providerID, dumps(data[providerID])) for providerID in data)
+
+
+# write `data` to sFile as a snapshot, a provider at a time. A crash
+# leaves either the old or the new file.
+@timed("storage.writeSnapshot")
+def writeSnapshot(data, sFile):
+    count = len(data)
+    tableSize = tableSizeFor(count)
+    mask = tableSize - 1
+    table = array("I", bytes(4 * tableSize))
+    entries = bytearray()
+    offset = headerFormat.size + entryFormat.size * count + 4 * tableSize
+    tmpFile = sFile + ".tmp"
+    with open(tmpFile, 'wb') as sf:
+        sf.seek(offset)
+        for providerID, blob in encodedItems(data):
+            key = providerID.encode()
+            sf.write(key)
+            sf.write(blob)
+            entries += entryFormat.pack(offset, len(key), len(blob))
+            offset += len(key) + len(blob)
+            slot = zlib.crc32(key) & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = len(entries) // entryFormat.size
+        if len(entries) != entryFormat.size * count:
+            raise RuntimeError("providers changed while writing %s" % sFile)
+        if sys.byteorder == "big":
+            table.byteswap()
+        sf.seek(0)
+        sf.write(headerFormat.pack(snapshotMagic, count, tableSize))
+        sf.write(entries)
+        sf.write(table.tobytes())
+        sf.flush()
+        os.fsync(sf.fileno())
+    os.replace(tmpFile, sFile)
+
+
+# a provider as stored in a snapshot, with its address parsed if it was
+# written before addresses were
+def decodeRecord(blob:bytes) -> dict:
+    provider = loads(blob)
+    if "addressParts" not in provider:
+        provider = withAddress(provider)
+    return provider
+
+
+# read-only view of a snapshot file
+class Snapshot:
+
+    def __init__(self, sFile):
+        self.sFile = sFile
+        with open(sFile, 'rb') as sf:
+            self.buffer = mmap.mmap(sf.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.tableSize = headerFormat.unpack_from(self.buffer, 0)
+        if magic != snapshotMagic:
+            raise ValueError("%s is not a provider snapshot" % sFile)
+        self.entriesAt = headerFormat.size
+        self.tableAt = self.entriesAt + entryFormat.size * self.count
+
+    def __len__(self):
+        return self.count
+
+    # entry number of `providerID`, or -1
+    def find(self, providerID:str) -> int:
+        key = providerID.encode()
+        mask = self.tableSize - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            entry, = slotFormat.unpack_from(self.buffer, self.tableAt + 4 * slot)
+            if not entry:
+                return -1
+            offset, keyLength, _ = entryFormat.unpack_from(self.buffer, self.entriesAt + entryFormat.size * (entry - 1))
+            if keyLength == len(key) and self.buffer[offset:offset + keyLength] == key:
+                return entry - 1
+            slot = (slot + 1) & mask
+
+    def keyAt(self, entry:int) -> str:
+        offset, keyLength, _ = entryFormat.unpack_from(self.buffer, self.entriesAt + entryFormat.size * entry)
+        return self.buffer[offset:offset + keyLength].decode()
+
+    # (providerID, JSON bytes) of an entry
+    def itemAt(self, entry:int) -> tuple:
+        offset, keyLength, recordLength = entryFormat.unpack_from(self.buffer, self.entriesAt + entryFormat.size * entry)
+        start = offset + keyLength
+        return self.buffer[offset:start].decode(), self.buffer[start:start + recordLength]
+
+
+# {providerID: provider} over a Snapshot: providers put or deleted since it
+# was written live in `changed` and `deleted` (tombstones), the rest is
+# decoded from the file on first access and kept in `cache`.
+class SnapshotRecords(MutableMapping):
+
+    def __init__(self, base:Snapshot):
+        self.base = base
+        self.changed = {}
+        self.deleted = set()
+        self.cache = {}
+        self.size = len(base)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, providerID):
+        if providerID in self.changed:
+            return True
+        if providerID in self.deleted or not isinstance(providerID, str):
+            return False
+        return providerID in self.cache or self.base.find(providerID) >= 0
+
+    def __getitem__(self, providerID):
+        provider = self.changed.get(providerID)
+        if provider is None:
+            provider = self.cache.get(providerID)
+        if provider is not None:
+            return provider
+        if providerID in self.deleted or not isinstance(providerID, str):
+            raise KeyError(providerID)
+        entry = self.base.find(providerID)
+        if entry < 0:
+            raise KeyError(providerID)
+        provider = self.cache[providerID] = decodeRecord(self.base.itemAt(entry)[1])
+        return provider
+
+    def get(self, providerID, default=None):
+        try:
+            return self[providerID]
+        except KeyError:
+            return default
+
+    def __setitem__(self, providerID, provider:dict):
+        if providerID not in self:
+            self.size += 1
+        self.changed[providerID] = provider
+        self.deleted.discard(providerID)
+        self.cache.pop(providerID, None)
+
+    def __delitem__(self, providerID):
+        if providerID not in self:
+            raise KeyError(providerID)
+        self.changed.pop(providerID, None)
+        self.cache.pop(providerID, None)
+        self.deleted.add(providerID)
+        self.size -= 1
+
+    # snapshot order first, then what was added since
+    def __iter__(self):
+        base, changed, deleted = self.base, self.changed, self.deleted
+        for entry in range(len(base)):
+            providerID = base.keyAt(entry)
+            if providerID not in deleted:
+                yield providerID
+        for providerID in list(changed):
+            if base.find(providerID) < 0:
+                yield providerID
+
+    # the entries of the file that are still current, for indexing without
+    # filling the cache
+    def baseItems(self, start=0, stop=None):
+        base, changed, deleted = self.base, self.changed, self.deleted
+        for entry in range(start, len(base) if stop is None else min(stop, len(base))):
+            providerID, blob = base.itemAt(entry)
+            if providerID not in changed and providerID not in deleted:
+                yield providerID, blob
+
+    # unchanged providers go out as the bytes they were read from
+    def encodedItems(self):
+        for entry in range(len(self.base)):
+            providerID, blob = self.base.itemAt(entry)
+            if providerID in self.changed:
+                yield providerID, dumps(self.changed[providerID])
+            elif providerID not in self.deleted:
+                yield providerID, blob
+        for providerID, provider in list(self.changed.items()):
+            if self.base.find(providerID) < 0:
+                yield providerID, dumps(provider)
+
+    # a consistent copy for writing out while the store moves on
+    def copy(self) -> "SnapshotRecords":
+        other = SnapshotRecords(self.base)
+        other.changed = dict(self.changed)
+        other.deleted = set(self.deleted)
+        other.size = self.size
+        return other
+
+    # move onto `base`, a new snapshot of `written` (a copy() of this
+    # mapping), keeping only the changes made after that copy
+    def rebase(self, base:Snapshot, written:"SnapshotRecords"):
+        self.changed = {providerID:provider for providerID, provider in self.changed.items() if written.changed.get(providerID) is not provider}
+        self.deleted = self.deleted - written.deleted
+        self.base = base
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] not in ("to-binary", "to-json"):
+        print("usage: python -m app.snapshot to-binary data.json data.snap | to-json data.snap data.json")
+        return 2
+    from .backends import readData, writeData
+    if argv[1] == "to-binary":
+        writeSnapshot(readData(argv[2]), argv[3])
+    else:
+        writeData(SnapshotRecords(Snapshot(argv[2])), argv[3])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
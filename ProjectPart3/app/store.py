@@ -0,0 +1,504 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from uuid import uuid4
+from .address import withAddress
+from .changes import ChangeFeed
+from .columnar import ColumnarSnapshot
+from .dedup import phoneClaims
+from .index import ProviderIndex
+from .paging import sortKey, pageOf, project
+from .records import CompactRecords
+from .snapshot import SnapshotRecords, decodeRecord
+from .serialization import dumps
+
+log = logging.getLogger(__name__)
+
+# mutation errors, see ProviderStore.mutate
+notFound = "providerID not found"
+alreadyExists = "ProviderID already exist"
+preconditionFailed = "provider was modified since the given ETag"
+phoneTaken = "phone already belongs to another provider"
+
+
+# version of a provider for ETag/If-Match: a hash of its content, so every
+# worker and every restart agrees on it without storing anything
+def providerETag(provider:dict) -> str:
+    return '"%s"' % hashlib.blake2b(json.dumps(provider, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+# does an If-Match / If-None-Match header value cover `etag`
+def etagMatches(header:str, etag:str) -> bool:
+    if etag is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+# what an export since a marker sends for a provider deleted after it
+def tombstone(providerID, encoded=False):
+    deleted = {"providerID":providerID, "deleted":True}
+    return dumps(deleted) if encoded else deleted
+
+
+#*--------------------------*#
+#*      PROVIDER STORE      *#
+#*--------------------------*#
+
+# Serves every read from memory and persists mutations through a
+# StorageBackend (see backends.py). When the backend is shared with other
+# worker processes the store replays their changes, at most every
+# `pollInterval` seconds before a read and always before a write.
+#
+# Records are never mutated in place (update() swaps in a new dict), so a
+# shallow copy of `data` is a consistent snapshot. `index` is updated under
+# the same lock as `data` (see index.py). With `compact`, `data` is a
+# CompactRecords that decodes providers on access (see records.py).
+#
+# A backend may load a memory-mapped SnapshotRecords (see snapshot.py). The
+# store serves from it at once and builds `index` in a background thread;
+# reads that need the index wait for it (`indexed`).
+#
+# Every applied mutation is also published to `changes`, a ring buffer of
+# the last `feedSize` events (see changes.py).
+#
+# With `uniquePhones` a write may not give a provider a phone another one
+# already has (see dedup.py). Checking that needs the whole index, so
+# writes wait for it like index reads do.
+class ProviderStore:
+
+    def __init__(self, backend, pollInterval=0.0, compact=False, feedSize=10000, uniquePhones=True):
+        self.backend = backend
+        self.pollInterval = pollInterval
+        self.compact = compact
+        self.uniquePhones = uniquePhones
+        self.changes = ChangeFeed(feedSize)
+        self.lastPoll = 0.0
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.loadLocked()
+
+    # (re)build memory and indexes from the backend
+    def loadLocked(self):
+        loaded = self.backend.load()
+        self.index = ProviderIndex()
+        self.indexed = threading.Event()
+        if isinstance(loaded, SnapshotRecords):
+            self.data = loaded
+        else:
+            self.data = CompactRecords() if self.compact else {}
+            # popped one by one so a loaded dict is freed once it is encoded
+            for providerID in list(loaded):
+                provider = loaded.pop(providerID)
+                # records written before addresses were parsed
+                if "addressParts" not in provider:
+                    provider = withAddress(provider)
+                self.data[providerID] = provider
+                self.index.add(providerID, provider)
+            self.indexed.set()
+        # sort field -> sorted [(sortKey, providerID)], rebuilt lazily
+        self.sortCache = {}
+        # providerID -> ETag and providerID -> encoded JSON, filled lazily
+        self.etags = {}
+        self.blobs = {}
+        # change markers: every mutation bumps `version` and stamps the
+        # provider with it. A new `epoch` tells markers from before apart.
+        # Deletes are stamped in `deletedAt` until the ID is created again.
+        self.epoch = uuid4().hex[:8]
+        self.version = 0
+        self.changedAt = {}
+        self.deletedAt = {}
+        self.changes.reset(self.epoch)
+        # wall-clock time of the last change, per provider and overall, for
+        # Last-Modified. Providers untouched since the load date from it.
+        self.loadedAt = self.lastModified = time.time()
+        self.modifiedAt = {}
+        if not self.indexed.is_set():
+            threading.Thread(target=self.buildIndex, args=(self.data, self.index, self.indexed), name="provider-indexer", daemon=True).start()
+
+    # index a freshly loaded SnapshotRecords, `chunkSize` providers per lock
+    # acquisition so reads by ID and writes go on meanwhile. Writes index
+    # what they touch themselves, so only providers untouched since the load
+    # are added here. Gives up when the store is reloaded.
+    def buildIndex(self, data, index, indexed, chunkSize=1000):
+        with self.lock:
+            replayed = list(data.changed)
+        for start in range(0, len(replayed), chunkSize):
+            with self.lock:
+                if self.index is not index:
+                    return
+                for providerID in replayed[start:start + chunkSize]:
+                    if providerID in data and providerID not in self.changedAt:
+                        index.add(providerID, data[providerID])
+        for start in range(0, len(data.base), chunkSize):
+            with self.lock:
+                if self.index is not index:
+                    return
+                for providerID, blob in data.baseItems(start, start + chunkSize):
+                    index.add(providerID, decodeRecord(blob))
+        indexed.set()
+        log.info("indexed %d providers", len(data))
+
+    def waitIndexed(self):
+        # re-read: a reload replaces the event
+        while not self.indexed.wait(0.05):
+            pass
+
+    # reads may block on other processes and belong off the event loop
+    @property
+    def shared(self) -> bool:
+        return self.backend.shared
+
+    # pick up what other workers wrote
+    def refresh(self):
+        if not self.backend.shared or time.monotonic() - self.lastPoll < self.pollInterval:
+            return
+        with self.lock:
+            self.syncLocked()
+
+    def syncLocked(self):
+        entries = self.backend.poll()
+        self.lastPoll = time.monotonic()
+        if entries is None:
+            log.warning("other workers changed storage beyond replay, reloading every provider")
+            self.loadLocked()
+            return
+        for entry in entries:
+            if entry["op"] == "put":
+                self.applyLocked("put", entry["id"], entry["data"])
+            elif entry["id"] in self.data:
+                self.applyLocked("delete", entry["id"], None)
+
+    # READ
+
+    def __contains__(self, providerID):
+        self.refresh()
+        return providerID in self.data
+
+    def __len__(self):
+        self.refresh()
+        return len(self.data)
+
+    def get(self, providerID):
+        self.refresh()
+        return self.data.get(providerID)
+
+    def keys(self):
+        self.refresh()
+        return self.data.keys()
+
+    def values(self):
+        self.refresh()
+        return self.data.values()
+
+    # first provider with this name, case-insensitive
+    def findByName(self, name):
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            ids = self.index.byName(name)
+            return self.data[ids[0]] if ids else None
+
+    # providers matching every given filter, see ProviderIndex.query
+    def query(self, name=None, **filters) -> list:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            ids = self.index.query(name, **filters)
+            return [self.data[providerID] for providerID in ids]
+
+    def matching(self, name=None, **filters) -> set:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            return self.index.matching(name, **filters)
+
+    def count(self, name=None, **filters) -> int:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            return self.index.count(name, **filters)
+
+    # likely duplicates of a provider, the stored one or `provider` as given:
+    # the others sharing its phone or identity key, see dedup.py
+    def duplicatesOf(self, providerID, provider=None) -> list:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            provider = provider or self.data.get(providerID)
+            return self.index.duplicates(providerID, provider) if provider else []
+
+    # {normalised phone: providerIDs holding it}
+    def phoneHolders(self, phones) -> dict:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            return {phone:list(self.index.phones.get(phone, ())) for phone in phones}
+
+    # {field: {value: count}} over every provider, straight from the index
+    def facets(self, fields) -> dict:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            return {field:self.index.facets(field) for field in fields}
+
+    # the columnar snapshot, rebuilt once the store changed and the current
+    # one is more than `maxAge` seconds old. Built outside the lock.
+    def columnar(self, maxAge=0.0) -> ColumnarSnapshot:
+        marker = self.changeMarker()
+        snapshot = self.snapshot
+        if snapshot is None or (snapshot.marker != marker and time.monotonic() - snapshot.builtAt >= maxAge):
+            self.refresh()
+            marker = self.changeMarker()
+            snapshot = self.snapshot = ColumnarSnapshot(marker, self.iterProviders())
+        return snapshot
+
+    # sorted (sortKey, providerID) entries for listing by `sortField`
+    def sortedEntries(self, sortField) -> list:
+        self.refresh()
+        with self.lock:
+            entries = self.sortCache.get(sortField)
+            if entries is None:
+                if sortField == "providerID":
+                    entries = sorted((sortKey(providerID), providerID) for providerID in self.data)
+                else:
+                    entries = sorted((sortKey(provider.get(sortField)), providerID) for providerID, provider in self.data.items())
+                self.sortCache[sortField] = entries
+            return entries
+
+    # one page of providers and the cursor of the next one, see paging.py
+    def page(self, limit, cursor=None, sortField="providerID", descending=False, fields=None) -> tuple:
+        page, nextCursor = self.pageEntries(limit, cursor, sortField, descending, fields)
+        return [provider for _, provider in page], nextCursor
+
+    # the same page as [(entry, provider)], for merging pages of several stores
+    def pageEntries(self, limit, cursor=None, sortField="providerID", descending=False, fields=None) -> tuple:
+        entries, nextCursor = pageOf(self.sortedEntries(sortField), limit, cursor, descending)
+        with self.lock:
+            page = [(entry, project(self.data[entry[1]], fields)) for entry in entries if entry[1] in self.data]
+        return page, nextCursor
+
+    # one page of name search results, best first, see search.py. Each
+    # result is the provider (or its `fields`) plus its "score". Fuzzy
+    # matches rank below every completion, so they are only looked for when
+    # the completions run out before the end of the page.
+    def search(self, query, limit, cursor=None, fields=None) -> tuple:
+        page, nextCursor = self.searchEntries(query, limit, cursor, fields)
+        return [result for _, result in page], nextCursor
+
+    # the same page as [(entry, result)]
+    def searchEntries(self, query, limit, cursor=None, fields=None) -> tuple:
+        self.refresh()
+        self.waitIndexed()
+        with self.lock:
+            for fuzzy in (False, True):
+                scores = self.index.search.rank(query, fuzzy)
+                entries = sorted(((-score, name), providerID) for name, score in scores.items() for providerID in self.index.names.get(name, ()))
+                page, nextCursor = pageOf(entries, limit, cursor)
+                if nextCursor:
+                    break
+            results = [(entry, {**project(self.data[entry[1]], fields), "score":-entry[0][0]}) for entry in page]
+        return results, nextCursor
+
+    def changeMarker(self) -> str:
+        return "%s.%d" % (self.epoch, self.version)
+
+    # version a marker stands for; markers from another run or garbage give
+    # None so callers fall back to everything
+    def versionOf(self, marker):
+        epoch, _, version = (marker or "").partition(".")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    # yield providers one at a time, `chunkSize` per lock acquisition, so an
+    # export never holds the lock or a copy of the dataset for long. Only
+    # the list of IDs to visit is taken up front.
+    # With `encoded` they come as JSON bytes from the blob cache.
+    def iterProviders(self, ids=None, since=None, chunkSize=500, encoded=False):
+        self.refresh()
+        with self.lock:
+            ids = list(self.data) if ids is None else list(ids)
+        for start in range(0, len(ids), chunkSize):
+            for provider in self.fetch(ids[start:start + chunkSize], since, encoded):
+                if provider is not None:
+                    yield provider
+
+    # the providers (or JSON bytes) of `ids` in that order, None for those
+    # missing or not changed after version `since`
+    def fetch(self, ids, since=None, encoded=False) -> list:
+        with self.lock:
+            get = self.encodedLocked if encoded else self.data.get
+            return [get(providerID) if since is None or self.changedAt.get(providerID, 0) > since else None for providerID in ids]
+
+    # tombstones of the providers deleted after version `since`, oldest
+    # first, none without `since` as a full export has nothing to remove
+    def deletedSince(self, since=None, encoded=False) -> list:
+        if since is None:
+            return []
+        self.refresh()
+        with self.lock:
+            deleted = sorted((version, providerID) for providerID, version in self.deletedAt.items() if version > since)
+        return [tombstone(providerID, encoded) for _, providerID in deleted]
+
+    def etag(self, providerID):
+        self.refresh()
+        with self.lock:
+            return self.etagLocked(providerID)
+
+    def etagLocked(self, providerID):
+        etag = self.etags.get(providerID)
+        if etag is None and providerID in self.data:
+            etag = self.etags[providerID] = providerETag(self.data[providerID])
+        return etag
+
+    # (JSON bytes, ETag, last modified) of a provider, or None. Encoded once
+    # per version so hot reads skip the serializer.
+    def encoded(self, providerID):
+        self.refresh()
+        with self.lock:
+            blob = self.encodedLocked(providerID)
+            if blob is None:
+                return None
+            return blob, self.etagLocked(providerID), self.modifiedAt.get(providerID, self.loadedAt)
+
+    # (change marker, last modified) of the whole collection
+    def collectionState(self) -> tuple:
+        self.refresh()
+        with self.lock:
+            return self.changeMarker(), self.lastModified
+
+    def encodedLocked(self, providerID):
+        blob = self.blobs.get(providerID)
+        if blob is None and providerID in self.data:
+            blob = self.blobs[providerID] = dumps(self.data[providerID])
+        return blob
+
+    def touch(self, providerID):
+        self.version += 1
+        self.changedAt[providerID] = self.version
+        self.deletedAt.pop(providerID, None)
+        self.modifiedAt[providerID] = self.lastModified = time.time()
+
+    # WRITE
+
+    # the single-provider writes return None or the error from mutate()
+
+    def create(self, providerID, provider:dict):
+        return self.mutate([("create", providerID, provider)])[0]
+
+    def put(self, providerID, provider:dict):
+        return self.mutate([("put", providerID, provider)])[0]
+
+    def update(self, providerID, fields:dict, ifMatch=None):
+        return self.mutate([("update", providerID, fields)], ifMatch={providerID:ifMatch} if ifMatch else None)[0]
+
+    def delete(self, providerID, ifMatch=None):
+        return self.mutate([("delete", providerID, None)], ifMatch={providerID:ifMatch} if ifMatch else None)[0]
+
+    # Apply (op, providerID, fields) mutations all-or-nothing: under one lock
+    # acquisition, as one backend write and one commit. op is "create"
+    # (must not exist yet), "put" (upsert), "update" (merge `fields`, must
+    # exist) or "delete" (must exist); earlier ops in the batch count.
+    # `ifMatch` maps providerIDs to the ETag they must still have, which
+    # makes the write a compare-and-swap against concurrent writers.
+    #
+    # Returns one error (notFound, alreadyExists, preconditionFailed,
+    # phoneTaken) or None per op. Nothing is applied unless every entry is
+    # None, or with `partial` only the ops without an error.
+    #
+    # The check, the in-memory apply and the backend write all happen under
+    # `lock` and inside the backend transaction, which serialises
+    # read-modify-write between threads here and, for shared backends,
+    # between worker processes.
+    def mutate(self, ops:list, partial=False, ifMatch=None) -> list:
+        if self.uniquePhones:
+            self.waitIndexed()
+        with self.lock:
+            try:
+                with self.backend.transaction():
+                    if self.backend.shared:
+                        self.syncLocked()
+                    errors = self.checkLocked(ops, ifMatch or {})
+                    if any(errors) and not partial:
+                        return errors
+                    entries = [self.applyLocked(op, providerID, fields) for (op, providerID, fields), error in zip(ops, errors) if error is None]
+                    if not entries:
+                        return errors
+                    token = self.backend.write(entries)
+            except Exception:
+                # memory may be ahead of storage now, start over from storage
+                self.loadLocked()
+                raise
+        self.backend.durable(token)
+        return errors
+
+    # the errors mutate() would return right now, without applying anything
+    def check(self, ops:list, ifMatch=None) -> list:
+        self.refresh()
+        if self.uniquePhones:
+            self.waitIndexed()
+        with self.lock:
+            return self.checkLocked(ops, ifMatch or {})
+
+    def checkLocked(self, ops:list, ifMatch:dict) -> list:
+        exists = {}
+        errors = []
+        taken = phoneClaims(ops, lambda phone: self.index.phones.get(phone, {})) if self.uniquePhones else [False] * len(ops)
+        for (op, providerID, _), phoneTakenByOther in zip(ops, taken):
+            present = exists.get(providerID, providerID in self.data)
+            if op == "create" and present:
+                errors.append(alreadyExists)
+            elif op in ("update", "delete") and not present:
+                errors.append(notFound)
+            elif ifMatch.get(providerID) and not etagMatches(ifMatch[providerID], self.etagLocked(providerID)):
+                errors.append(preconditionFailed)
+            elif phoneTakenByOther:
+                errors.append(phoneTaken)
+            else:
+                errors.append(None)
+                exists[providerID] = op != "delete"
+        return errors
+
+    # apply one mutation to memory and indexes and return its log entry,
+    # the caller holds the lock
+    def applyLocked(self, op, providerID, fields) -> dict:
+        self.etags.pop(providerID, None)
+        self.blobs.pop(providerID, None)
+        if op == "delete":
+            self.index.remove(providerID, self.data.pop(providerID))
+            self.sortCache.clear()
+            self.version += 1
+            self.changedAt.pop(providerID, None)
+            self.deletedAt[providerID] = self.version
+            self.modifiedAt.pop(providerID, None)
+            self.lastModified = time.time()
+            self.changes.publish(self.version, "delete", providerID)
+            return {"op":"delete", "id":providerID}
+
+        old = self.data.get(providerID)
+        if op == "update":
+            provider = withAddress({**old, **fields})
+            for field in fields:
+                self.sortCache.pop(field, None)
+        else:
+            provider = withAddress(fields)
+            self.sortCache.clear()
+        self.index.replace(providerID, old, provider)
+        self.data[providerID] = provider
+        self.touch(providerID)
+        self.changes.publish(self.version, op, providerID, provider)
+        return {"op":"put", "id":providerID, "data":provider}
+
+    # LIFECYCLE
+
+    def start(self):
+        self.backend.start(self)
+
+    def afterFork(self):
+        self.backend.afterFork()
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from .metrics import span, timed
+from .serialization import dumps, loads
+
+log = logging.getLogger(__name__)
+
+
+#*--------------------------*#
+#*     WRITE-AHEAD LOG      *#
+#*--------------------------*#
+
+# Append-only JSONL log of provider mutations. Each line is one operation:
+#
+#     {"op": "put", "id": "<providerID>", "data": {...full record...}}
+#     {"op": "delete", "id": "<providerID>"}
+#     {"op": "batch", "ops": [...]}
+#
+# A batch is a single line, so a torn write drops the whole batch, never part
+# of it.
+# Puts always carry the whole record, so replaying a line twice is harmless.
+# That is what makes compaction crash-safe (see JsonFileBackend.compact).
+#
+# append() only queues the line. A committer thread picks up everything queued
+# within `commitInterval` seconds, writes it with one write() and one fsync(),
+# then wakes every caller waiting on those sequence numbers (group commit).
+class WriteAheadLog:
+
+    def __init__(self, logFile, commitInterval=0.002):
+        self.logFile = logFile
+        self.commitInterval = commitInterval
+
+        self.pending = []
+        self.nextSeq = 0
+        self.durableSeq = 0
+        self.cond = threading.Condition()
+        self.stopping = False
+
+        self.fh = open(logFile, 'ab')
+        self.bytes = self.fh.tell()
+        self.committer = threading.Thread(target=self.runCommitter, name="wal-committer", daemon=True)
+        self.committer.start()
+
+    # queue one operation, returns its sequence number
+    def append(self, op:dict) -> int:
+        line = dumps(op) + b"\n"
+        with self.cond:
+            self.nextSeq += 1
+            self.pending.append(line)
+            self.bytes += len(line)
+            self.cond.notify_all()
+            return self.nextSeq
+
+    # block until `seq` has been fsynced
+    def waitDurable(self, seq):
+        with self.cond:
+            while self.durableSeq < seq:
+                if self.stopping and not self.committer.is_alive():
+                    raise RuntimeError("write-ahead log closed before commit")
+                self.cond.wait()
+
+    def runCommitter(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if not self.pending and self.stopping:
+                    return
+            # let concurrent writers pile on to this commit
+            if self.commitInterval:
+                time.sleep(self.commitInterval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+                lastSeq = self.nextSeq
+            try:
+                with span("storage.walCommit"):
+                    self.fh.write(b"".join(batch))
+                    self.fh.flush()
+                    os.fsync(self.fh.fileno())
+            except Exception:
+                log.exception("write-ahead log commit to %s failed", self.logFile)
+                with self.cond:
+                    self.pending[:0] = batch
+                time.sleep(0.1)
+                continue
+            with self.cond:
+                self.durableSeq = lastSeq
+                self.cond.notify_all()
+
+    # make everything appended so far durable
+    def sync(self):
+        with self.cond:
+            seq = self.nextSeq
+        self.waitDurable(seq)
+
+    # move the current log aside to `rotatedFile` and start an empty one,
+    # the caller must make sure nothing is appended meanwhile
+    def rotate(self, rotatedFile):
+        self.sync()
+        with self.cond:
+            self.fh.close()
+            if os.path.exists(rotatedFile):
+                # an earlier compaction failed after rotating, keep its ops
+                with open(rotatedFile, 'ab') as rf, open(self.logFile, 'rb') as lf:
+                    shutil.copyfileobj(lf, rf)
+                    rf.flush()
+                    os.fsync(rf.fileno())
+                os.remove(self.logFile)
+            else:
+                os.replace(self.logFile, rotatedFile)
+            self.fh = open(self.logFile, 'ab')
+            self.bytes = 0
+
+    def close(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.committer.join()
+        self.fh.close()
+
+
+# apply every complete line of `logFile` to `data`
+@timed("storage.replayLog")
+def replayLog(data:dict, logFile) -> int:
+    if not os.path.exists(logFile):
+        return 0
+    applied = 0
+    goodBytes = 0
+    with open(logFile, 'rb') as lf:
+        for line in lf:
+            try:
+                op = loads(line)
+            except ValueError:
+                # torn write from a crash, everything after it is unusable
+                log.warning("ignoring truncated tail of %s at byte %d", logFile, goodBytes)
+                break
+            applyOp(data, op)
+            applied += 1
+            goodBytes += len(line)
+    if goodBytes != os.path.getsize(logFile):
+        with open(logFile, 'r+b') as lf:
+            lf.truncate(goodBytes)
+    return applied
+
+
+def applyOp(data:dict, op:dict):
+    if op["op"] == "put":
+        data[op["id"]] = op["data"]
+    elif op["op"] == "delete":
+        data.pop(op["id"], None)
+    elif op["op"] == "batch":
+        for each in op["ops"]:
+            applyOp(data, each)
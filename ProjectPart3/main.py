@@ -1,4 +1,6 @@
 import uvicorn
 
+# development server, reloads on code changes. In production run
+# `python -m app.prefork` instead (see app/prefork.py).
 if __name__=="__main__":
     uvicorn.run("app.app:app", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from app.backends import JsonFileBackend
+from app.dedup import phoneClaims
+from app.store import ProviderStore, phoneTaken
+
+
+def provider(phone:str) -> dict:
+    return {"active":True, "name":"John Cooper", "qualification":"deg1", "speciality":"spec1", "phone":phone,
+            "department":None, "organization":"Organization_Z", "location":None, "address":"Street 5, Town 2"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    jFile = tmp_path / "data.json"
+    jFile.write_text(json.dumps({"a":{"providerID":"a", **provider("1234567890")}, "b":{"providerID":"b", **provider("5550001111")}}))
+    store = ProviderStore(JsonFileBackend(str(jFile)))
+    store.start()
+    yield store
+    store.close()
+
+
+def test_phoneClaims_releases_phones_freed_earlier_in_the_batch():
+    holders = {"1234567890":{"a"}}
+    def lookup(phone):
+        return holders.get(phone, set())
+    assert phoneClaims([("delete", "a", None), ("update", "b", {"phone":"1234567890"})], lookup) == [False, False]
+    assert phoneClaims([("update", "a", {"phone":"9999999999"}), ("update", "b", {"phone":"1234567890"})], lookup) == [False, False]
+    assert phoneClaims([("update", "b", {"phone":"1234567890"}), ("delete", "a", None)], lookup) == [True, False]
+
+
+def test_bulk_reuses_a_deleted_providers_phone(store):
+    assert store.mutate([("delete", "a", None), ("update", "b", {"phone":"1234567890"})]) == [None, None]
+    assert store.get("b")["phone"] == "1234567890"
+
+
+def test_bulk_reuses_a_phone_changed_away_from(store):
+    assert store.mutate([("update", "a", {"phone":"9999999999"}), ("update", "b", {"phone":"1234567890"})]) == [None, None]
+    assert store.get("a")["phone"] == "9999999999"
+    assert store.get("b")["phone"] == "1234567890"
+
+
+def test_bulk_still_rejects_a_phone_in_use(store):
+    assert store.mutate([("update", "b", {"phone":"1234567890"})]) == [phoneTaken]
+    assert store.get("b")["phone"] == "5550001111"
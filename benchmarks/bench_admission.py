@@ -0,0 +1,104 @@
+# Latency of point lookups (GET /?providerID=...) while a dashboard-style
+# flood of expensive reads piles up on ProjectPart3: --flood tasks keep
+# requesting the full dump (/viewall?limit=0), /export and the same
+# filtered query, while a writer invalidates the response cache every
+# --write-every seconds so the queries keep missing it. Runs once with
+# admission control off (PROVIDER_ADMIT_ACTIVE=0) and once on, and
+# reports lookup percentiles, flood throughput, 503s shed and queries
+# coalesced by the response cache.
+#
+#     python benchmarks/bench_admission.py --size 20000 --flood 64 --duration 10
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import httpx
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from dataset import writeDataset
+from harness import freePort, percentile, startServer
+
+floodPaths = [("/viewall", {"limit":0}), ("/export", None), ("/", {"department":"Department_A"}),
+              ("/", {"department":"Department_A"}), ("/", {"department":"Department_A"})]
+
+
+def metric(text, name) -> float:
+    match = re.search(r"^%s (\S+)$" % name, text, re.M)
+    return float(match.group(1)) if match else 0.0
+
+
+async def run(url, ids, args) -> dict:
+    deadline = time.perf_counter() + args.duration
+    lookups = []
+    flood = {"done":0, "shed":0, "failed":0}
+    limits = httpx.Limits(max_connections=args.flood + 8)
+
+    async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits) as client:
+        async def flooder(n):
+            rng = random.Random(n)
+            while time.perf_counter() < deadline:
+                path, params = rng.choice(floodPaths)
+                try:
+                    response = await client.get(path, params=params)
+                    flood["shed" if response.status_code == 503 else "done"] += 1
+                    if response.status_code == 503:
+                        await asyncio.sleep(float(response.headers.get("retry-after", 1)))
+                except httpx.HTTPError:
+                    flood["failed"] += 1
+
+        async def prober():
+            rng = random.Random("probe")
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.get("/", params={"providerID":rng.choice(ids)})
+                if response.status_code == 200:
+                    lookups.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        async def writer():
+            while time.perf_counter() < deadline:
+                await client.put("/", params={"providerID":ids[0]}, json={"location":"L%f" % time.time()})
+                await asyncio.sleep(args.write_every)
+
+        await asyncio.gather(prober(), writer(), *(flooder(n) for n in range(args.flood)))
+        text = (await client.get("/metrics")).text
+    lookups.sort()
+    return {"lookups":len(lookups),
+            **{name:percentile(lookups, p) * 1e3 if lookups else float("nan") for name, p in (("p50", 0.5), ("p99", 0.99))},
+            "max":lookups[-1] * 1e3 if lookups else float("nan"),
+            "flood":flood["done"] / args.duration, "shed":flood["shed"], "failed":flood["failed"],
+            "coalesced":metric(text, "response_cache_coalesced_total")}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--flood", type=int, default=64, help="concurrent expensive requests")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--write-every", type=float, default=0.25)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ids = list(writeDataset(args.size, os.path.join(tmp, "data.json")))
+        for label, admitActive in (("admission off", 0), ("admission on", 64)):
+            port = freePort()
+            server = startServer(tmp, port, PROVIDER_ADMIT_ACTIVE=str(admitActive))
+            try:
+                result = asyncio.run(run("http://127.0.0.1:%d" % port, ids, args))
+            finally:
+                server.terminate()
+                server.wait(60)
+            print("%-14s lookups p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms   flood %6.1f req/s  %5d shed  %d failed  %d coalesced"
+                  % (label, result["p50"], result["p99"], result["max"], result["flood"], result["shed"], result["failed"], result["coalesced"]))
+
+
+if __name__ == "__main__":
+    main()
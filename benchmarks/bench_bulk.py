@@ -0,0 +1,52 @@
+# Records/sec through ProjectPart3's POST /bulk, in-process over ASGI.
+#
+#     python benchmarks/bench_bulk.py --records 50000 --batch 5000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+projectDir = os.path.join(here, "..", "ProjectPart3")
+sys.path.insert(0, projectDir)
+sys.path.insert(0, here)
+
+from dataset import makeDataset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--ndjson", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["PROVIDER_DATA"] = os.path.join(tmp, "data.json")
+        with open(os.environ["PROVIDER_DATA"], 'w') as jf:
+            jf.write("{}")
+        os.chdir(projectDir)
+        from fastapi.testclient import TestClient
+        from app.app import app
+
+        providers = list(makeDataset(args.records).values())
+        ops = [{"op":"create", "providerID":p.pop("providerID"), "data":p} for p in providers]
+        with TestClient(app) as client:
+            start = time.perf_counter()
+            for offset in range(0, len(ops), args.batch):
+                batch = ops[offset:offset + args.batch]
+                if args.ndjson:
+                    body = "\n".join(json.dumps(op) for op in batch)
+                    response = client.post("/bulk", content=body, headers={"content-type":"application/x-ndjson"})
+                else:
+                    response = client.post("/bulk", json=batch)
+                assert response.json()["applied"] == len(batch), response.text[:500]
+            elapsed = time.perf_counter() - start
+    print("%d records in %.2fs: %.0f records/s" % (args.records, elapsed, args.records / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Change feed under load: PUT throughput against a uvicorn server with no
+# subscribers, then with --subscribers SSE streams reading along and
+# --stalled ones that never read. Every reading subscriber must see every
+# write in order; stalled ones must not slow the writes down.
+#
+#     python benchmarks/bench_changes.py --writes 2000 --subscribers 8 --stalled 4
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dataset import writeDataset
+from harness import freePort, putAll, startServer
+
+
+# read an SSE stream from `since`, collecting event seqs until `count`
+def subscribe(url, since, count, seen):
+    with httpx.Client(base_url=url, timeout=60) as client:
+        with client.stream("GET", "/changes/stream", params={"since":since}) as stream:
+            for line in stream.iter_lines():
+                if line.startswith("data: "):
+                    seen.append(json.loads(line[6:])["seq"])
+                    if len(seen) >= count:
+                        return
+                elif line.startswith("event: reset"):
+                    seen.append(None)
+                    return
+
+
+# open an SSE stream and never read from it
+def stall(port):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.sendall(b"GET /changes/stream HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--subscribers", type=int, default=8)
+    parser.add_argument("--stalled", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ids = list(writeDataset(1000, os.path.join(tmp, "data.json")))
+        port = freePort()
+        url = "http://127.0.0.1:%d" % port
+        server = startServer(tmp, port)
+        try:
+            baseline, _ = putAll(url, ids, args.writes, args.threads)
+            print("no subscribers:           %6.0f PUT/s" % baseline)
+
+            since = httpx.get(url + "/changes").json()["next"]
+            stalled = [stall(port) for _ in range(args.stalled)]
+            seen = [[] for _ in range(args.subscribers)]
+            readers = [threading.Thread(target=subscribe, args=(url, since, args.writes, s)) for s in seen]
+            for thread in readers:
+                thread.start()
+            time.sleep(0.5)
+            loaded, _ = putAll(url, ids, args.writes, args.threads)
+            for thread in readers:
+                thread.join(60)
+            print("%d reading, %d stalled:   %6.0f PUT/s" % (args.subscribers, args.stalled, loaded))
+
+            first = int(since.partition(".")[2]) + 1
+            complete = all(s == list(range(first, first + args.writes)) for s in seen)
+            print("every reading subscriber got all %d events in order: %s" % (args.writes, "yes" if complete else "NO"))
+            for sock in stalled:
+                sock.close()
+        finally:
+            server.terminate()
+            server.wait(30)
+    sys.exit(0 if complete else 1)
+
+
+if __name__ == "__main__":
+    main()
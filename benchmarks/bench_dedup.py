@@ -0,0 +1,79 @@
+# The duplicate report of ProjectPart3 (dedup.duplicateReport) against
+# comparing every pair, on a synthetic dataset with --dups near-duplicates
+# planted in it: names re-cased with an honorific, address parts reordered,
+# and every other one with its phone reformatted rather than changed.
+# Reports time, pairs compared and how many of the planted duplicates were
+# found. All-pairs only runs up to --all-pairs-max providers.
+#
+#     python benchmarks/bench_dedup.py --size 20000 --dups 200 --workers 1,4
+
+import argparse
+import os
+import random
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "ProjectPart3"))
+sys.path.insert(0, here)
+
+from dataset import makeDataset
+from app.address import withAddress
+from app.dedup import duplicateReport, features, similarity
+
+
+# a copy of `provider` under a new ID, written the way a second clerk would
+def plant(rng, provider, providerID, keepPhone) -> dict:
+    copy = dict(provider, providerID=providerID, name="Dr. " + provider["name"].upper())
+    parts = provider["address"].split(", ")
+    rng.shuffle(parts)
+    copy["address"] = ", ".join(parts)
+    copy["phone"] = "+91 " + provider["phone"] if keepPhone else str(rng.randint(10**9, 10**10 - 1))
+    return withAddress(copy)
+
+
+def allPairs(providers, threshold) -> set:
+    entries = [features(provider) for provider in providers]
+    found = set()
+    for i, a in enumerate(entries):
+        for b in entries[i + 1:]:
+            if (a[4] and a[4] == b[4]) or similarity(a, b) >= threshold:
+                found.add(frozenset((a[0], b[0])))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--dups", type=int, default=200)
+    parser.add_argument("--workers", default="1,4", help="comma-separated worker counts")
+    parser.add_argument("--threshold", type=float, default=0.9)
+    parser.add_argument("--all-pairs-max", type=int, default=3000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    providers = [withAddress(provider) for provider in makeDataset(args.size).values()]
+    planted = set()
+    for n, original in enumerate(rng.sample(providers, args.dups)):
+        copy = plant(rng, original, "dup%d" % n, n % 2 == 0)
+        providers.append(copy)
+        planted.add(frozenset((original["providerID"], copy["providerID"])))
+    pairCount = len(providers) * (len(providers) - 1) // 2
+
+    for workers in [int(count) for count in args.workers.split(",")]:
+        report = duplicateReport(providers, workers, args.threshold)
+        found = {frozenset(pair["providerIDs"]) for group in report["groups"] for pair in group["pairs"]}
+        print("blocked, %d workers  %7.2f s  %10d pairs compared  %d of %d planted found  %d groups"
+              % (workers, report["seconds"], report["compared"], len(planted & found), len(planted), len(report["groups"])))
+
+    if len(providers) <= args.all_pairs_max:
+        start = time.perf_counter()
+        found = allPairs(providers, args.threshold)
+        print("all pairs            %7.2f s  %10d pairs compared  %d of %d planted found"
+              % (time.perf_counter() - start, pairCount, len(planted & found), len(planted)))
+    else:
+        print("all pairs            skipped, %d pairs (--all-pairs-max %d)" % (pairCount, args.all_pairs_max))
+
+
+if __name__ == "__main__":
+    main()
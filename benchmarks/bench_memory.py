@@ -0,0 +1,74 @@
+# Bytes per provider held in memory, with providers as plain dicts (before)
+# and as CompactRecords (after, PROVIDER_COMPACT_RECORDS=1): the records
+# alone, as traced by tracemalloc, and the whole store including indexes.
+# Also times a full decode of every record in each layout.
+#
+#     python benchmarks/bench_memory.py --size 200000
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ProjectPart3"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.backends import JsonFileBackend, readData
+from app.address import withAddress
+from app.records import CompactRecords
+from app.store import ProviderStore
+from dataset import writeDataset
+
+
+# bytes still allocated after `build()`, and what it built
+def traced(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def records(jFile, compact):
+    data = CompactRecords() if compact else {}
+    loaded = readData(jFile)
+    for providerID in list(loaded):
+        data[providerID] = withAddress(loaded.pop(providerID))
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jFile = os.path.join(tmp, "data.json")
+        writeDataset(args.size, jFile)
+        print("%d providers" % args.size)
+        results = {}
+        for label, compact in (("dicts (before)", False), ("compact (after)", True)):
+            size, data = traced(lambda: records(jFile, compact))
+            start = time.perf_counter()
+            for provider in data.values():
+                pass
+            decode = time.perf_counter() - start
+            del data
+            storeSize, store = traced(lambda: ProviderStore(JsonFileBackend(jFile), compact=compact))
+            store.close()
+            del store
+            results[label] = size
+            print("%-16s records %6.0f B/provider   store with indexes %6.0f B/provider   read all %6.1f ms"
+                  % (label, size / args.size, storeSize / args.size, decode * 1e3))
+        before, after = results.values()
+        print("records take %.0f%% of the memory they did" % (after / before * 100))
+
+
+if __name__ == "__main__":
+    main()
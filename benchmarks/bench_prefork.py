@@ -0,0 +1,110 @@
+# Boot time and memory of ProjectPart3 under `uvicorn --workers N`, where
+# every worker loads and indexes the providers itself, against the prefork
+# launcher (python -m app.prefork), where the master loads them once and
+# forks the workers. Reports the time until all N workers completed their
+# startup, and the proportional memory (PSS) of the whole process tree
+# after boot and again after --requests lookups spread over every worker.
+# Needs Linux (/proc/<pid>/smaps_rollup).
+#
+#     python benchmarks/bench_prefork.py --size 100000 --workers 4
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+here = os.path.dirname(os.path.abspath(__file__))
+projectDir = os.path.join(here, "..", "ProjectPart3")
+sys.path.insert(0, projectDir)
+sys.path.insert(0, here)
+
+from app.prefork import memoryOf
+from dataset import writeDataset
+from harness import freePort
+
+
+def descendants(root:int) -> list:
+    children = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open("/proc/%s/stat" % name) as stat:
+                    # the parent pid follows the ")" closing the command name
+                    ppid = int(stat.read().rpartition(")")[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+    found, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        found.append(pid)
+        todo.extend(children.get(pid, ()))
+    return found
+
+
+def treePss(root:int) -> float:
+    return sum(memoryOf(pid).get("pss", 0.0) for pid in descendants(root))
+
+
+# (server, seconds until `workers` startups completed)
+def bootServer(command, env, workers):
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=projectDir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    booted = threading.Event()
+
+    def watch():
+        started = 0
+        for line in server.stderr:
+            if "Application startup complete" in line:
+                started += 1
+                if started == workers:
+                    booted.set()
+
+    threading.Thread(target=watch, daemon=True).start()
+    if not booted.wait(600):
+        server.kill()
+        raise RuntimeError("server did not start")
+    return server, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ids = list(writeDataset(args.size, os.path.join(tmp, "data.json")))
+        print("%d providers, %d workers" % (args.size, args.workers))
+        launchers = (("uvicorn --workers", ["-m", "uvicorn", "app.app:app", "--workers", str(args.workers), "--port"]),
+                     ("prefork", ["-m", "app.prefork", "--workers", str(args.workers), "--port"]))
+        for label, command in launchers:
+            for leftover in ("data.json.log", "data.json.lock"):
+                if os.path.exists(os.path.join(tmp, leftover)):
+                    os.remove(os.path.join(tmp, leftover))
+            port = freePort()
+            env = dict(os.environ, PROVIDER_DATA=os.path.join(tmp, "data.json"), WEB_CONCURRENCY=str(args.workers))
+            server, boot = bootServer([sys.executable] + command + [str(port)], env, args.workers)
+            try:
+                booted = treePss(server.pid)
+                rng = random.Random(1)
+                # a new connection per request, so the kernel spreads them over the workers
+                for _ in range(args.requests):
+                    httpx.get("http://127.0.0.1:%d/" % port, params={"providerID":rng.choice(ids)})
+                served = treePss(server.pid)
+            finally:
+                server.terminate()
+                server.wait(120)
+            print("%-18s all workers up in %6.2f s   pss %7.1f MB after boot   %7.1f MB after %d lookups"
+                  % (label, boot, booted, served, args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Per-query latency of the name search (ProviderStore.search) for prefix
+# and misspelled queries, and a paging check: walking every page of a
+# query must return each match exactly once. Names are made distinct by
+# adding a generated surname, so the index holds about one name per
+# provider. Exits non-zero when p99 exceeds --target milliseconds.
+#
+#     python benchmarks/bench_search.py --size 100000 --target 25
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ProjectPart3"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.backends import JsonFileBackend, writeData
+from app.store import ProviderStore
+from dataset import makeDataset
+from harness import percentile
+
+SYLLABLES = ["ka", "ri", "to", "men", "sa", "lo", "vin", "dra", "ne", "sh", "pa", "tel", "gu", "ra", "jan", "de"]
+
+
+def misspell(rng, name):
+    i = rng.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--target", type=float, default=25.0, help="p99 latency target in milliseconds")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    data = makeDataset(args.size)
+    for provider in data.values():
+        provider["name"] += " " + "".join(rng.choice(SYLLABLES) for _ in range(3)).capitalize()
+    names = [provider["name"] for provider in data.values()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jFile = os.path.join(tmp, "data.json")
+        writeData(data, jFile)
+        start = time.perf_counter()
+        store = ProviderStore(JsonFileBackend(jFile))
+        print("loaded and indexed %d providers (%d distinct names) in %.2fs" % (len(store), len(store.index.search.names), time.perf_counter() - start))
+
+        kinds = {
+            "prefix": lambda: rng.choice(names)[:rng.randint(2, 6)],
+            "word prefix": lambda: rng.choice(names).split()[-1][:rng.randint(3, 6)],
+            "misspelled": lambda: misspell(rng, rng.choice(names)),
+        }
+        worst = 0.0
+        for kind, makeQuery in kinds.items():
+            latencies = []
+            for _ in range(args.queries):
+                query = makeQuery()
+                start = time.perf_counter()
+                store.search(query, args.limit)
+                latencies.append((time.perf_counter() - start) * 1000)
+            p99 = percentile(latencies, 0.99)
+            worst = max(worst, p99)
+            print("%-12s p50 %.2f ms  p99 %.2f ms  max %.2f ms" % (kind, percentile(latencies, 0.5), p99, max(latencies)))
+
+        query = names[0].split()[0][:3]
+        seen = []
+        cursor = None
+        while True:
+            results, cursor = store.search(query, 100, cursor)
+            seen.extend(result["providerID"] for result in results)
+            if not cursor:
+                break
+        pagesOK = len(seen) == len(set(seen))
+        print("paged %r: %d results, %s" % (query, len(seen), "no duplicates" if pagesOK else "DUPLICATES"))
+
+    ok = worst <= args.target and pagesOK
+    print("worst p99 %.2f ms, target %.2f ms: %s" % (worst, args.target, "OK" if ok else "FAILED"))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
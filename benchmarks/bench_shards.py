@@ -0,0 +1,57 @@
+# Write throughput of ProjectPart3 against the number of shards
+# (PROVIDER_SHARDS): PUTs spread over every provider from --threads client
+# threads, against one uvicorn worker that starts its own shards. Also
+# checks that after the writes every provider reads back what was last
+# written to it.
+#
+#     python benchmarks/bench_shards.py --shards 0,1,2,4 --writes 4000
+
+import argparse
+import os
+import sys
+import tempfile
+
+import httpx
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from dataset import writeDataset
+from harness import freePort, putAll, startServer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", default="0,1,2,4", help="comma-separated shard counts, 0 = unsharded")
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--writes", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+
+    consistent = True
+    base = None
+    for shards in [int(count) for count in args.shards.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            ids = list(writeDataset(args.size, os.path.join(tmp, "data.json")))
+            # a multiple of the thread count, so each provider has one writer
+            ids = ids[:len(ids) - len(ids) % args.threads]
+            port = freePort()
+            url = "http://127.0.0.1:%d" % port
+            server = startServer(tmp, port, PROVIDER_SHARDS=str(shards))
+            try:
+                rate, written = putAll(url, ids, args.writes, args.threads)
+                with httpx.Client(base_url=url) as client:
+                    wrong = sum(client.get("/", params={"providerID":providerID}).json()["data"]["department"] != value
+                                for providerID, value in written.items())
+            finally:
+                server.terminate()
+                server.wait(60)
+            base = base or rate
+            consistent = consistent and not wrong
+            print("%-10s %7.0f PUT/s  x%.2f   %d of %d providers read back wrong"
+                  % ("%d shards" % shards if shards else "unsharded", rate, rate / base, wrong, len(written)))
+    sys.exit(0 if consistent else 1)
+
+
+if __name__ == "__main__":
+    main()
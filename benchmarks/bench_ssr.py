@@ -0,0 +1,68 @@
+# Time-to-first-byte and total time of the streamed all-providers page
+# (/viewall?limit=0) against a real uvicorn server. The first request
+# renders every row, later ones reuse the cached row fragments. Exits
+# non-zero when the first byte takes longer than --budget seconds.
+#
+#     python benchmarks/bench_ssr.py --size 100000 --budget 0.25
+
+import argparse
+import os
+import signal
+import sys
+import tempfile
+import time
+
+import httpx
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from dataset import writeDataset
+from harness import freePort, startServer
+
+
+# (seconds to the first body byte, seconds to the last, bytes)
+def timePage(client, path):
+    start = time.perf_counter()
+    firstByte = None
+    size = 0
+    with client.stream("GET", path) as response:
+        for chunk in response.iter_bytes():
+            if firstByte is None:
+                firstByte = time.perf_counter() - start
+            size += len(chunk)
+    return firstByte, time.perf_counter() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.25, help="time-to-first-byte budget in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        writeDataset(args.size, os.path.join(tmp, "data.json"))
+        port = freePort()
+        server = startServer(tmp, port)
+        worst = 0.0
+        try:
+            with httpx.Client(base_url="http://127.0.0.1:%d" % port, timeout=300) as client:
+                for run in range(args.runs):
+                    firstByte, total, size = timePage(client, "/viewall?limit=0")
+                    worst = max(worst, firstByte)
+                    print("%s: first byte %.1f ms, complete %.1f ms, %.1f MB" % ("cold" if run == 0 else "warm", firstByte * 1000, total * 1000, size / 1e6))
+                for path in ("/views", "/update", "/delete"):
+                    firstByte, total, size = timePage(client, path)
+                    print("%s: first byte %.1f ms, complete %.1f ms, %.1f MB" % (path, firstByte * 1000, total * 1000, size / 1e6))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait(30)
+
+    ok = worst <= args.budget
+    print("worst first byte %.1f ms, budget %.1f ms: %s" % (worst * 1000, args.budget * 1000, "OK" if ok else "FAILED"))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Startup time of ProviderStore from data.json against the memory-mapped
+# data.snap (PROVIDER_SNAPSHOT_FORMAT=binary): time until the store can
+# serve a provider by ID, and until its indexes are built and filtered
+# queries are answered. Also checks the JSON -> binary -> JSON round trip.
+#
+#     python benchmarks/bench_startup.py --size 200000
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ProjectPart3"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.backends import JsonFileBackend, readData, writeData
+from app.snapshot import Snapshot, SnapshotRecords, writeSnapshot
+from app.store import ProviderStore
+from dataset import writeDataset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jFile = os.path.join(tmp, "data.json")
+        writeDataset(args.size, jFile)
+        start = time.perf_counter()
+        writeSnapshot(readData(jFile), os.path.join(tmp, "data.snap"))
+        print("%d providers, converted to data.snap in %.2fs (%.1f MB json, %.1f MB snap)"
+              % (args.size, time.perf_counter() - start, os.path.getsize(jFile) / 1e6, os.path.getsize(os.path.join(tmp, "data.snap")) / 1e6))
+        someID = next(iter(readData(jFile)))
+
+        for label, binary in (("data.json (before)", False), ("data.snap (after)", True)):
+            start = time.perf_counter()
+            store = ProviderStore(JsonFileBackend(jFile, binary=binary))
+            store.get(someID)
+            serving = time.perf_counter() - start
+            store.count(active=True)
+            indexed = time.perf_counter() - start
+            print("%-20s serving by ID after %8.1f ms   indexed after %8.1f ms" % (label, serving * 1e3, indexed * 1e3))
+            store.close()
+            # free the last store before timing the next one
+            del store
+            gc.collect()
+
+        back = os.path.join(tmp, "back.json")
+        writeData(SnapshotRecords(Snapshot(os.path.join(tmp, "data.snap"))), back)
+        print("round trip to JSON: %s" % ("identical" if readData(back) == readData(jFile) else "DIFFERENT"))
+
+
+if __name__ == "__main__":
+    main()
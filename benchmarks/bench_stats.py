@@ -0,0 +1,78 @@
+# Latency of provider statistics: facet counts read off the index counters,
+# the columnar snapshot build, and filtered facets / group-bys on it,
+# against the old way of aggregating every provider dict client-side.
+#
+#     python benchmarks/bench_stats.py --size 200000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ProjectPart3"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.backends import JsonFileBackend
+from app.columnar import statsFields
+from app.store import ProviderStore
+from dataset import writeDataset
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def report(label, seconds):
+    if seconds < 1e-3:
+        print("%-40s %8.1f us" % (label, seconds * 1e6))
+    else:
+        print("%-40s %8.1f ms" % (label, seconds * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jFile = os.path.join(tmp, "data.json")
+        writeDataset(args.size, jFile)
+        store = ProviderStore(JsonFileBackend(jFile))
+        print("%d providers" % len(store))
+
+        seconds, _ = timed(lambda: store.facets(["organization", "department", "location", "active"]), args.repeat * 100)
+        report("facets, 4 fields (index counters)", seconds)
+        seconds, _ = timed(lambda: store.facets(statsFields), args.repeat * 100)
+        report("facets, every field (index counters)", seconds)
+
+        seconds, snapshot = timed(lambda: store.columnar(maxAge=0) if store.snapshot is None else store.snapshot, 1)
+        report("columnar snapshot build", seconds)
+
+        rows = snapshot.rowsOf(store.matching(state="Karnataka", active=True, speciality="spec1"))
+        seconds, _ = timed(lambda: snapshot.rowsOf(store.matching(state="Karnataka", active=True, speciality="spec1")), args.repeat)
+        report("filter Karnataka+active+spec1 (%d rows)" % len(rows), seconds)
+        seconds, _ = timed(lambda: snapshot.facet("organization", rows), args.repeat)
+        report("facet organization over the filter", seconds)
+        seconds, _ = timed(lambda: snapshot.groupBy(["organization", "department"], rows), args.repeat)
+        report("group by organization, department", seconds)
+        seconds, _ = timed(lambda: snapshot.groupBy(["organization", "active"]), args.repeat)
+        report("group by organization, active (all)", seconds)
+
+        def scan():
+            counts = {field:Counter() for field in ("organization", "department", "location", "active")}
+            for provider in store.values():
+                for field, counter in counts.items():
+                    counter[provider.get(field)] += 1
+            return counts
+        seconds, _ = timed(scan, max(args.repeat // 10, 1))
+        report("scan every provider dict (before)", seconds)
+
+
+if __name__ == "__main__":
+    main()
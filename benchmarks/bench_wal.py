@@ -0,0 +1,77 @@
+# Mutations/sec of ProviderStore (write-ahead log + group commit) against the
+# old strategy of rewriting the whole data.json per mutation, for growing
+# dataset sizes. The store's rate should stay flat; the rewrite's should fall
+# roughly linearly with size.
+#
+#     python benchmarks/bench_wal.py --sizes 1000 10000 100000 --writers 16
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ProjectPart3"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.backends import JsonFileBackend, readData, writeData
+from app.store import ProviderStore
+from dataset import writeDataset
+
+
+def benchStore(jFile, ids, ops, writers):
+    store = ProviderStore(JsonFileBackend(jFile, compactInterval=3600, compactThreshold=0))
+    store.start()
+    perWriter = ops // writers
+
+    def writer(n):
+        rng = random.Random(n)
+        for _ in range(perWriter):
+            store.update(rng.choice(ids), {"active": rng.random() < 0.5})
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    store.close()
+    return perWriter * writers / elapsed
+
+
+def benchRewrite(jFile, ids, ops):
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for _ in range(ops):
+        data = readData(jFile)
+        data[rng.choice(ids)]["active"] = rng.random() < 0.5
+        writeData(data, jFile)
+    return ops / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--writers", type=int, default=16)
+    parser.add_argument("--rewrite-ops", type=int, default=20)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            jFile = os.path.join(tmp, "data.json")
+            ids = list(writeDataset(size, jFile))
+            walRate = benchStore(jFile, ids, args.ops, args.writers)
+            rewriteRate = benchRewrite(jFile, ids, args.rewrite_ops)
+        results.append({"providers": size, "wal_mutations_per_sec": round(walRate, 1), "rewrite_mutations_per_sec": round(rewriteRate, 1)})
+        print("%8d providers   wal %9.1f ops/s   full rewrite %9.1f ops/s" % (size, walRate, rewriteRate))
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import json
+import random
+from uuid import UUID
+
+# Synthetic providers shaped like ProjectPart3/data.json. Categorical fields
+# draw from small pools so they repeat the way production data does.
+
+FIRST_NAMES = ["John", "Alice", "Kevin", "Melissa", "Jonathan", "Bob", "Keanu", "Priya", "Arjun", "Meera", "Rahul", "Sara"]
+LAST_NAMES = ["Cooper", "Barmer", "Pitt", "Anderson", "Jostar", "Tres", "Reeves", "Sharma", "Iyer", "Khan", "Das", "Rao"]
+CITIES = [("Bengaluru", "Karnataka"), ("Mumbai", "Maharashtra"), ("Pune", "Maharashtra"), ("New Delhi", "Delhi"), ("Chennai", "Tamil Nadu"), ("Mysuru", "Karnataka")]
+
+
+def makeProvider(rng:random.Random, providerID:str) -> dict:
+    city, state = rng.choice(CITIES)
+    return {
+        "providerID": providerID,
+        "active": rng.random() < 0.8,
+        "name": rng.choice(FIRST_NAMES) + " " + rng.choice(LAST_NAMES),
+        "qualification": ",".join(sorted(rng.sample(["deg1", "deg2", "deg3", "deg4", "deg5"], rng.randint(1, 3)))),
+        "speciality": ",".join(sorted(rng.sample(["spec1", "spec2", "spec3", "spec4", "spec5", "spec6"], rng.randint(1, 3)))),
+        "phone": str(rng.randint(10**9, 10**10 - 1)),
+        "department": "Department_" + rng.choice("ABCDEFGH"),
+        "organization": "Organization_" + rng.choice("UVWXYZ"),
+        "location": city,
+        "address": "Street %d, Town %d, %s, %s" % (rng.randint(1, 99), rng.randint(1, 30), city, state),
+    }
+
+
+# deterministic for a given seed, so runs are comparable. Phones are
+# unique, as ProjectPart3 requires.
+def makeDataset(size:int, seed:int = 0) -> dict:
+    rng = random.Random(seed)
+    data = {}
+    phones = set()
+    while len(data) < size:
+        providerID = UUID(int=rng.getrandbits(128)).hex
+        provider = makeProvider(rng, providerID)
+        if provider["phone"] not in phones:
+            phones.add(provider["phone"])
+            data[providerID] = provider
+    return data
+
+
+def writeDataset(size:int, jFile, seed:int = 0) -> dict:
+    data = makeDataset(size, seed)
+    with open(jFile, 'w') as jf:
+        json.dump(data, jf)
+    return data
@@ -0,0 +1,71 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+# Helpers shared by the benchmarks that run ProjectPart3 as a server.
+
+projectDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ProjectPart3")
+
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# poll until `server` answers on `port`, kill it if it never does
+def waitForServer(server, port, timeout=600, label="server"):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("%s exited with %d" % (label, server.returncode))
+        try:
+            httpx.get("http://127.0.0.1:%d/?providerID=x" % port)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("%s did not start" % label)
+
+
+# ProjectPart3 under uvicorn on the data.json in `tmp`, with any further
+# settings as environment variables, e.g. PROVIDER_SHARDS="2"
+def startServer(tmp, port, workers=1, **settings):
+    env = dict(os.environ, PROVIDER_DATA=os.path.join(tmp, "data.json"), PROVIDER_SQLITE=os.path.join(tmp, "data.db"),
+               PROVIDER_SHARD_DIR=os.path.join(tmp, "shards"), WEB_CONCURRENCY=str(workers), **settings)
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.app:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+                              cwd=projectDir, env=env)
+    return waitForServer(server, port)
+
+
+# PUT/s, and {providerID: last value written}. Thread n writes every
+# `threads`-th provider from n, so with as many IDs as a multiple of
+# `threads` each provider has one writer and its last value is known.
+def putAll(url, ids, writes, threads):
+    written = {}
+
+    def worker(n):
+        with httpx.Client(base_url=url, timeout=60) as client:
+            for i in range(n, writes, threads):
+                providerID = ids[i % len(ids)]
+                value = "D%d" % i
+                client.put("/", params={"providerID":providerID}, json={"department":value}).raise_for_status()
+                written[providerID] = value
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return writes / (time.perf_counter() - start), written
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
@@ -0,0 +1,137 @@
+# Lost-update stress test for ProjectPart3 under several uvicorn workers.
+#
+#   1. disjoint updates: every thread PUTs its own set of providers as fast
+#      as it can; afterwards each provider must hold the last value its
+#      thread wrote, both over HTTP and in what was persisted to disk.
+#   2. contended compare-and-swap: every thread increments one shared
+#      counter with GET + PUT If-Match, retrying on 412; the final value
+#      must equal the number of successful increments.
+#
+#     python benchmarks/stress_concurrency.py --workers 4 --threads 32 --storage json
+#     python benchmarks/stress_concurrency.py --workers 4 --threads 32 --storage sqlite
+#     python benchmarks/stress_concurrency.py --workers 4 --threads 32 --snapshot binary
+
+import argparse
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+here = os.path.dirname(os.path.abspath(__file__))
+projectDir = os.path.join(here, "..", "ProjectPart3")
+sys.path.insert(0, projectDir)
+sys.path.insert(0, here)
+
+from dataset import writeDataset
+from harness import freePort, startServer
+
+
+def disjointUpdates(url, ids, threads, rounds):
+    expected = {}
+    lock = threading.Lock()
+
+    def worker(n):
+        mine = ids[n::threads]
+        with httpx.Client(base_url=url, timeout=30) as client:
+            for r in range(rounds):
+                for providerID in mine:
+                    value = "t%d-r%d" % (n, r)
+                    body = client.put("/", params={"providerID":providerID}, json={"department":value}).json()
+                    assert body["response"] == "success", body
+                    with lock:
+                        expected[providerID] = value
+
+    runThreads(worker, threads)
+    return expected
+
+
+def contendedCounter(url, providerID, threads, increments):
+    done = [0]
+    conflicts = [0]
+    lock = threading.Lock()
+
+    def worker(n):
+        with httpx.Client(base_url=url, timeout=30) as client:
+            for _ in range(increments):
+                while True:
+                    response = client.get("/", params={"providerID":providerID})
+                    value = int(response.json()["data"]["department"])
+                    response = client.put("/", params={"providerID":providerID}, json={"department":str(value + 1)},
+                                          headers={"If-Match":response.headers["etag"]})
+                    if response.status_code != 412:
+                        assert response.json()["response"] == "success", response.text
+                        break
+                    with lock:
+                        conflicts[0] += 1
+                with lock:
+                    done[0] += 1
+
+    runThreads(worker, threads)
+    return done[0], conflicts[0]
+
+
+def runThreads(target, count):
+    threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--providers", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--increments", type=int, default=20)
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--snapshot", choices=["json", "binary"], default="json")
+    args = parser.parse_args()
+    os.environ["PROVIDER_SNAPSHOT_FORMAT"] = args.snapshot
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ids = list(writeDataset(args.providers, os.path.join(tmp, "data.json")))
+        port = freePort()
+        url = "http://127.0.0.1:%d" % port
+        server = startServer(tmp, port, args.workers, PROVIDER_STORAGE=args.storage)
+        try:
+            start = time.perf_counter()
+            expected = disjointUpdates(url, ids, args.threads, args.rounds)
+            elapsed = time.perf_counter() - start
+            requests = args.rounds * len(ids)
+            with httpx.Client(base_url=url) as client:
+                lost = [providerID for providerID, value in expected.items()
+                        if client.get("/", params={"providerID":providerID}).json()["data"]["department"] != value]
+            print("disjoint: %d PUTs at %.0f req/s, %d lost updates" % (requests, requests / elapsed, len(lost)))
+
+            counterID = ids[0]
+            with httpx.Client(base_url=url) as client:
+                client.put("/", params={"providerID":counterID}, json={"department":"0"})
+            done, conflicts = contendedCounter(url, counterID, args.threads, args.increments)
+            with httpx.Client(base_url=url) as client:
+                final = int(client.get("/", params={"providerID":counterID}).json()["data"]["department"])
+            print("counter: %d increments, %d If-Match retries, final value %d" % (done, conflicts, final))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait(30)
+
+        # what the workers persisted must agree too
+        os.environ["PROVIDER_DATA"] = os.path.join(tmp, "data.json")
+        from app.backends import JsonFileBackend, SqliteBackend
+        backend = SqliteBackend(os.path.join(tmp, "data.db")) if args.storage == "sqlite" else JsonFileBackend(os.path.join(tmp, "data.json"), binary=args.snapshot == "binary")
+        persisted = backend.load()
+        lostOnDisk = [providerID for providerID, value in expected.items() if providerID != counterID and persisted[providerID]["department"] != value]
+        print("persisted: %d lost updates, counter %s" % (len(lostOnDisk), persisted[counterID]["department"]))
+
+    ok = not lost and not lostOnDisk and final == done and int(persisted[counterID]["department"]) == done
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+# Benchmark suite for the provider API of all three parts. For every
+# dataset size, app and mode it measures throughput and latency
+# percentiles of each CRUD route and of a mixed workload, and writes the
+# results as JSON that later runs can be compared against.
+#
+#   apps     part1 (in-memory dict), part2 (data.json per request),
+#            part3 (ProviderStore)
+#   modes    asgi      requests go straight into the app in-process,
+#                      no sockets, so the numbers are the app's own cost
+#            uvicorn   a real server in its own process, over HTTP
+#   routes   view      GET /?providerID=...
+#            list      GET /viewall (part1: everything, part2: one page
+#                      of 100) or GET /list?limit=100 (part3)
+#            update    PUT /?providerID=...
+#            create    POST /
+#            delete    DELETE /?providerID=...
+#            mixed     60% view, 15% list, 15% update, 5% create,
+#                      5% delete
+#
+# Datasets come from dataset.py with a fixed seed and the request mix from
+# a seeded generator, so two runs send the same requests. Every app, mode
+# and size runs in a fresh process on a fresh copy of the data. A route
+# stops after --requests requests or --duration seconds, whichever comes
+# first, so part2 at 1M providers still finishes.
+#
+#     python benchmarks/suite.py run --sizes 1000,10000,100000 --out results.json
+#     python benchmarks/suite.py run --apps part3 --modes uvicorn --sizes 1000000 --out big.json
+#     python benchmarks/suite.py compare results.json baseline.json --tolerance 0.25
+#     python benchmarks/suite.py run --out results.json --baseline baseline.json
+#
+# Keep a baseline.json from a known-good commit on the same machine;
+# compare exits non-zero when any route lost more than --tolerance of its
+# throughput or its p99 grew by more than that.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from uuid import UUID
+
+import httpx
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from dataset import makeProvider, writeDataset
+from harness import freePort, percentile, waitForServer
+
+projectDirs = {app:os.path.join(here, "..", "ProjectPart%s" % app[-1]) for app in ("part1", "part2", "part3")}
+listPaths = {"part1":"/viewall", "part2":"/viewall?limit=100", "part3":"/list?limit=100"}
+workloads = ("view", "list", "update", "create", "delete", "mixed")
+mixedWeights = (("view", 60), ("list", 15), ("update", 15), ("create", 5), ("delete", 5))
+success = b'{"response":"success"'
+
+
+#*--------------------------*#
+#*          TARGETS         *#
+#*--------------------------*#
+
+# import the ASGI app of `app` over the data.json in workdir
+def loadApp(app, workdir):
+    dataFile = os.path.join(os.path.abspath(workdir), "data.json")
+    projectDir = os.path.abspath(projectDirs[app])
+    sys.path.insert(0, projectDir)
+    if app == "part1":
+        import app.app as module
+        with open(dataFile) as jf:
+            module.data.clear()
+            module.data.update(json.load(jf))
+    elif app == "part2":
+        # reads and writes ./data.json on every request
+        os.chdir(workdir)
+        import app.app as module
+    else:
+        os.environ["PROVIDER_DATA"] = dataFile
+        os.environ["PROVIDER_SQLITE"] = os.path.join(os.path.abspath(workdir), "data.db")
+        # templates and static files are looked up relative to the project
+        os.chdir(projectDir)
+        import app.app as module
+    return module.app
+
+
+def startServer(app, workdir, port, timeout=600):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--app", app, "--workdir", workdir, "--port", str(port)],
+                              stdout=subprocess.DEVNULL)
+    return waitForServer(server, port, timeout, "%s server" % app)
+
+
+#*--------------------------*#
+#*         WORKLOADS        *#
+#*--------------------------*#
+
+# Requests as (method, path, params, json body). Deletes take IDs from a
+# reserved quarter of the dataset that nothing else reads, so reads and
+# updates always hit a provider that exists.
+class Requests:
+
+    def __init__(self, app, ids, seed=0):
+        self.rng = random.Random(seed)
+        # not the dataset's seed, or new IDs would repeat existing ones
+        self.newIDs = random.Random("create-%d" % seed)
+        self.newProviders = random.Random("create-provider-%d" % seed)
+        self.created = 0
+        ids = list(ids)
+        self.rng.shuffle(ids)
+        reserved = max(len(ids) // 4, 1)
+        self.deletable = iter(ids[:reserved])
+        self.readable = ids[reserved:] or ids
+        self.listPath = listPaths[app]
+
+    def view(self):
+        return "GET", "/", {"providerID":self.rng.choice(self.readable)}, None
+
+    def list(self):
+        return "GET", self.listPath, None, None
+
+    def update(self):
+        return "PUT", "/", {"providerID":self.rng.choice(self.readable)}, {"department":"Department_" + self.rng.choice("ABCDEFGH")}
+
+    # part3 takes the new ID as a parameter, part1 and part2 ignore it.
+    # Dataset phones never start with 0, so numbering new ones from
+    # 0000000000 keeps them clear of ProjectPart3's unique phone check.
+    def create(self):
+        providerID = UUID(int=self.newIDs.getrandbits(128)).hex
+        provider = makeProvider(self.newProviders, providerID)
+        del provider["providerID"]
+        provider["phone"] = "%010d" % self.created
+        self.created += 1
+        return "POST", "/", {"providerID":providerID}, provider
+
+    # None once the reserved IDs are used up
+    def delete(self):
+        providerID = next(self.deletable, None)
+        if providerID is None:
+            return None
+        return "DELETE", "/", {"providerID":providerID}, None
+
+    def mixed(self):
+        kind = self.rng.choices([kind for kind, _ in mixedWeights], [weight for _, weight in mixedWeights])[0]
+        return getattr(self, kind)() or self.view()
+
+
+# send `make()` requests from `concurrency` tasks until `requests` were
+# sent, `duration` seconds passed or make() runs dry
+async def drive(client, make, requests, duration, concurrency) -> dict:
+    latencies = []
+    errors = 0
+    issued = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors, issued
+        while issued < requests and time.perf_counter() < deadline:
+            request = make()
+            if request is None:
+                return
+            issued += 1
+            method, path, params, body = request
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params, json=body)
+                ok = response.status_code < 400 and response.content.startswith(success)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    result = {"requests":len(latencies), "errors":errors, "seconds":round(seconds, 3),
+              "throughput":round(len(latencies) / seconds, 1) if seconds else 0.0}
+    if latencies:
+        result["latencyMs"] = {"mean":round(sum(latencies) / len(latencies) * 1e3, 3),
+                               **{name:round(percentile(latencies, p) * 1e3, 3) for name, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))},
+                               "max":round(latencies[-1] * 1e3, 3)}
+    return result
+
+
+async def runWorkloads(client, app, ids, args) -> list:
+    requests = Requests(app, ids, args.seed)
+    # warm caches and connections before anything is timed
+    await drive(client, requests.view, args.warmup, args.duration, args.concurrency)
+    results = []
+    for workload in args.workloads:
+        result = await drive(client, getattr(requests, workload), args.requests, args.duration, args.concurrency)
+        results.append({"workload":workload, **result})
+        print("  %-7s %7d req %6d err %9.1f req/s   p50 %8.2f ms   p99 %8.2f ms" % (
+            workload, result["requests"], result["errors"], result["throughput"],
+            result.get("latencyMs", {}).get("p50", 0.0), result.get("latencyMs", {}).get("p99", 0.0)), file=sys.stderr)
+    return results
+
+
+async def runAsgi(app, workdir, ids, args) -> list:
+    asgiApp = loadApp(app, workdir)
+    # on_event("startup") hooks run as they would under a server
+    async with asgiApp.router.lifespan_context(asgiApp):
+        transport = httpx.ASGITransport(app=asgiApp)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            return await runWorkloads(client, app, ids, args)
+
+
+async def runUvicorn(app, workdir, ids, args) -> list:
+    port = freePort()
+    server = startServer(app, workdir, port)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url="http://127.0.0.1:%d" % port, limits=limits, timeout=None) as client:
+            return await runWorkloads(client, app, ids, args)
+    finally:
+        server.terminate()
+        server.wait(60)
+
+
+#*--------------------------*#
+#*          COMPARE         *#
+#*--------------------------*#
+
+def resultKey(result) -> tuple:
+    return result["app"], result["mode"], result["size"], result["workload"]
+
+
+# print every result next to its baseline, and return the regressions
+def compare(current, baseline, tolerance) -> list:
+    before = {resultKey(result):result for result in baseline["results"]}
+    regressions = []
+    print("%-6s %-8s %8s %-7s %12s %9s %12s %9s" % ("app", "mode", "size", "route", "req/s", "change", "p99 ms", "change"))
+    for result in current["results"]:
+        old = before.get(resultKey(result))
+        if old is None or not old.get("throughput") or "latencyMs" not in old or "latencyMs" not in result:
+            continue
+        speed = result["throughput"] / old["throughput"] - 1
+        p99 = result["latencyMs"]["p99"] / old["latencyMs"]["p99"] - 1 if old["latencyMs"]["p99"] else 0.0
+        regressed = speed < -tolerance or p99 > tolerance or result["errors"] > old["errors"]
+        print("%-6s %-8s %8d %-7s %12.1f %+8.1f%% %12.2f %+8.1f%%%s" % (
+            *resultKey(result), result["throughput"], speed * 100, result["latencyMs"]["p99"], p99 * 100, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(resultKey(result))
+    return regressions
+
+
+#*--------------------------*#
+#*          COMMANDS        *#
+#*--------------------------*#
+
+def commandRun(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            dataFile = os.path.join(tmp, "data-%d.json" % size)
+            writeDataset(size, dataFile, args.seed)
+            for app in args.apps:
+                for mode in args.modes:
+                    workdir = os.path.join(tmp, "%s-%s-%d" % (app, mode, size))
+                    os.makedirs(workdir)
+                    shutil.copyfile(dataFile, os.path.join(workdir, "data.json"))
+                    resultFile = os.path.join(workdir, "result.json")
+                    print("%s %s, %d providers" % (app, mode, size), file=sys.stderr)
+                    # a process of its own, the three apps are all called `app`
+                    subprocess.run([sys.executable, os.path.abspath(__file__), "target", "--app", app, "--mode", mode,
+                                    "--workdir", workdir, "--result", resultFile, *targetArgs(args)], stdout=subprocess.DEVNULL, check=True)
+                    with open(resultFile) as rf:
+                        results.extend({"app":app, "mode":mode, "size":size, **result} for result in json.load(rf))
+                    shutil.rmtree(workdir)
+            os.remove(dataFile)
+
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.out, 'w') as of:
+        json.dump(report, of, indent=2)
+    print("wrote %d results to %s" % (len(results), args.out), file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as bf:
+            return 1 if compare(report, json.load(bf), args.tolerance) else 0
+    return 0
+
+
+def targetArgs(args) -> list:
+    return ["--requests", str(args.requests), "--duration", str(args.duration), "--concurrency", str(args.concurrency),
+            "--warmup", str(args.warmup), "--seed", str(args.seed), "--workloads", ",".join(args.workloads)]
+
+
+def commandTarget(args):
+    with open(os.path.join(args.workdir, "data.json")) as jf:
+        ids = list(json.load(jf))
+    run = runAsgi if args.mode == "asgi" else runUvicorn
+    results = asyncio.run(run(args.app, args.workdir, ids, args))
+    with open(args.result, 'w') as rf:
+        json.dump(results, rf)
+    return 0
+
+
+def commandServe(args):
+    import uvicorn
+    uvicorn.run(loadApp(args.app, args.workdir), port=args.port, log_level="warning")
+    return 0
+
+
+def commandCompare(args):
+    with open(args.current) as cf, open(args.baseline) as bf:
+        regressions = compare(json.load(cf), json.load(bf), args.tolerance)
+    print("%d regression(s) beyond %.0f%%" % (len(regressions), args.tolerance * 100))
+    return 1 if regressions else 0
+
+
+def listOf(kind, choices=None):
+    def parse(text):
+        values = [kind(value.strip()) for value in text.split(",") if value.strip()]
+        if choices is not None and any(value not in choices for value in values):
+            raise argparse.ArgumentTypeError("choose from " + ", ".join(choices))
+        return values
+    return parse
+
+
+def addLoadOptions(parser):
+    parser.add_argument("--requests", type=int, default=2000, help="requests per route")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per route at most")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workloads", type=listOf(str, workloads), default=list(workloads))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run")
+    run.add_argument("--apps", type=listOf(str, projectDirs), default=list(projectDirs))
+    run.add_argument("--modes", type=listOf(str, ("asgi", "uvicorn")), default=["asgi", "uvicorn"])
+    run.add_argument("--sizes", type=listOf(int), default=[1000, 10000, 100000])
+    run.add_argument("--out", default="results.json")
+    run.add_argument("--baseline")
+    run.add_argument("--tolerance", type=float, default=0.25)
+    addLoadOptions(run)
+
+    compareParser = commands.add_parser("compare")
+    compareParser.add_argument("current")
+    compareParser.add_argument("baseline")
+    compareParser.add_argument("--tolerance", type=float, default=0.25)
+
+    # internal: one app and mode in a process of its own, and its server
+    target = commands.add_parser("target")
+    target.add_argument("--app", choices=projectDirs, required=True)
+    target.add_argument("--mode", choices=("asgi", "uvicorn"), required=True)
+    target.add_argument("--workdir", required=True)
+    target.add_argument("--result", required=True)
+    addLoadOptions(target)
+
+    serve = commands.add_parser("serve")
+    serve.add_argument("--app", choices=projectDirs, required=True)
+    serve.add_argument("--workdir", required=True)
+    serve.add_argument("--port", type=int, required=True)
+
+    args = parser.parse_args()
+    handlers = {"run":commandRun, "compare":commandCompare, "target":commandTarget, "serve":commandServe}
+    sys.exit(handlers[args.command](args))
+
+
+if __name__ == "__main__":
+    main()